@@ -1,62 +1,96 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import html
 import logging
 import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
 from telegram.constants import ParseMode
 
 import g_sheets
+import outbound
+import search_index
+import utils
+from models import Application, ApplicationStatus
 from constants import (
-    SheetCols, AWAIT_REJECT_REASON, CALLBACK_APPROVE_PREFIX,
-    CALLBACK_REJECT_PREFIX
+    SheetCols, AWAIT_REJECT_REASON, AWAIT_BULK_REJECT_REASON, CALLBACK_APPROVE_PREFIX,
+    CALLBACK_REJECT_PREFIX, CALLBACK_PENDING_PREFIX
 )
 
 logger = logging.getLogger(__name__)
 
-def format_admin_notification(row_data: dict, row_index: int) -> dict:
-    """Форматирует сообщение и клавиатуру для уведомления админа."""
-    # Логгируем входные данные для отладки
-    logger.info(f"format_admin_notification вызвана с row_data: {row_data}")
-    logger.info(f"format_admin_notification вызвана с row_index: {row_index}")
-    
-    # Проверяем, какой формат данных у нас: из Google Sheets или из context.user_data
-    if 'initiator_fio' in row_data:
-        # Данные из context.user_data (form_handlers)
-        initiator_info = f"{row_data.get('initiator_fio', 'N/A')} ({row_data.get('initiator_username', 'N/A')})"
-        owner_info = f"{row_data.get('owner_first_name', '')} {row_data.get('owner_last_name', '')}".strip()
-        amount_val = row_data.get('amount', '-')
-        card_type_str = row_data.get('card_type')
-        card_number = row_data.get('card_number')
-        category = row_data.get('category')
-        issue_location = row_data.get('issue_location')
-        reason = row_data.get('reason', 'Не указана')  # Добавляем причину выдачи
-        logger.info("Используем формат данных из context.user_data")
-    else:
-        # Данные из Google Sheets (с константами SheetCols)
-        initiator_info = f"{row_data.get(SheetCols.FIO_INITIATOR, 'N/A')} ({row_data.get(SheetCols.TG_TAG, 'N/A')})"
-        owner_info = f"{row_data.get(SheetCols.OWNER_FIRST_NAME_COL, '')} {row_data.get(SheetCols.OWNER_LAST_NAME_COL, '')}".strip()
-        amount_val = row_data.get(SheetCols.AMOUNT_COL, '-')
-        card_type_str = row_data.get(SheetCols.CARD_TYPE_COL)
-        card_number = row_data.get(SheetCols.CARD_NUMBER_COL)
-        category = row_data.get(SheetCols.CATEGORY_COL)
-        issue_location = row_data.get(SheetCols.ISSUE_LOCATION_COL)
-        reason = row_data.get(SheetCols.REASON_COL, 'Не указана')  # Добавляем причину выдачи
-        logger.info("Используем формат данных из Google Sheets")
-    
-    # Обрабатываем пустые значения
-    if not owner_info.strip():
-        owner_info = "Не указано"
-    if not card_number:
-        card_number = "Не указан"
-    if not category:
-        category = "Не указана"
-    if not issue_location:
-        issue_location = "Не указан"
-    
-    amount_text = f"{amount_val}{'%' if card_type_str == 'Скидка' else ' ₽'}"
+# Сколько заявок показывается на одной странице очереди на согласование
+PENDING_PAGE_SIZE = 8
+
+
+def next_activation_date(now: Optional[datetime] = None) -> str:
+    """Дата ближайшей активации карты: четверг после 22:00 (если сегодня четверг после 22:00 - следующий)."""
+    today = now or datetime.now()
+    days_until_thursday = (3 - today.weekday()) % 7  # 3 = четверг (понедельник = 0)
+    if days_until_thursday == 0 and today.hour >= 22:  # Если сегодня четверг после 22:00
+        days_until_thursday = 7  # Следующий четверг
+    return (today + timedelta(days=days_until_thursday)).strftime("%d.%m.%Y")
+
+
+def admin_display_name(admin_user) -> str:
+    """Имя руководителя для уведомлений."""
+    admin_name = f"{admin_user.first_name} {admin_user.last_name or ''}".strip()
+    return admin_name or admin_user.username or "Руководитель"
+
+
+def format_approval_message(app: Application, admin_name: str) -> str:
+    """Уведомление инициатору об одобрении заявки."""
+    owner_name = app.owner_name or "Не указано"
+    card_number = app.card_number or "Не указан"
+    amount = app.amount_text if app.amount is not None else "Не указана"
+    return (
+        f"🎉 <b>Заявка одобрена руководителем!</b>\n\n"
+        f"📋 <b>Детали заявки:</b>\n"
+        f"👤 Владелец карты: <b>{owner_name}</b>\n"
+        f"💳 Номер карты: <code>{card_number}</code>\n"
+        f"💰 Сумма/Скидка: <b>{amount}</b>\n\n"
+        f"✅ <b>Согласовано:</b> {admin_name}\n"
+        f"📅 <b>Активация:</b> {next_activation_date()} (четверг) после 22:00\n\n"
+        f"ℹ️ <i>Карта будет активирована автоматически в указанную дату.\n"
+        f"До этого времени средства недоступны для использования.</i>"
+    )
+
+
+def format_rejection_message(app: Application, reason: str) -> str:
+    """Уведомление инициатору об отклонении заявки."""
+    return (
+        f"😔 <b>Заявка отклонена</b>\n\n"
+        f"📋 <b>Детали заявки:</b>\n"
+        f"👤 Владелец карты: <b>{app.owner_name}</b>\n"
+        f"💳 Номер карты: <code>{app.card_number or 'Не указан'}</code>\n\n"
+        f"❌ <b>К сожалению, ваша заявка была отклонена.</b>\n\n"
+        f"📝 <b>Причина отклонения:</b>\n"
+        f"<i>{html.escape(reason)}</i>\n\n"
+        f"� <b>Что делать дальше?</b>\n"
+        f"• Изучите причину отклонения\n"
+        f"• Исправьте указанные замечания\n"
+        f"• Подайте новую заявку\n\n"
+        f"💡 <i>Мы всегда готовы помочь! Обращайтесь, если есть вопросы.</i>"
+    )
+
+
+def format_admin_notification(app: Application) -> dict:
+    """Форматирует сообщение и клавиатуру для уведомления админа. Кнопки несут постоянный ID заявки."""
+    logger.info(f"format_admin_notification вызвана для {app!r}")
+
+    initiator_info = f"{app.initiator_fio or 'N/A'} ({app.initiator_username or 'N/A'})"
+    owner_info = app.owner_name or "Не указано"
+    card_number = app.card_number or "Не указан"
+    category = app.category or "Не указана"
+    issue_location = app.issue_location or "Не указан"
+    reason = app.reason or "Не указана"
+    amount_text = app.amount_text
     
     text = (
-        f"🔔 <b>Новая заявка на согласование (№{row_index + 1})</b> 🔔\n\n"
+        f"🔔 <b>Новая заявка на согласование (№{app.public_id})</b> 🔔\n\n"
         f"<b>Инициатор:</b> {initiator_info}\n"
         f"<b>Владелец карты:</b> {owner_info}\n"
         f"<b>Номер карты:</b> <code>{card_number}</code>\n"
@@ -71,31 +105,180 @@ def format_admin_notification(row_data: dict, row_index: int) -> dict:
     
     keyboard = InlineKeyboardMarkup([
         [
-            InlineKeyboardButton("✅ Одобрить", callback_data=f"{CALLBACK_APPROVE_PREFIX}{row_index}"),
-            InlineKeyboardButton("❌ Отклонить", callback_data=f"{CALLBACK_REJECT_PREFIX}{row_index}")
+            InlineKeyboardButton("✅ Одобрить", callback_data=f"{CALLBACK_APPROVE_PREFIX}{app.public_id}"),
+            InlineKeyboardButton("❌ Отклонить", callback_data=f"{CALLBACK_REJECT_PREFIX}{app.public_id}")
         ]
     ])
     
     return {"text": text, "reply_markup": keyboard}
 
+
+def application_label(app: Application) -> str:
+    """Как называть заявку в сообщениях руководителю."""
+    return app.public_id or f"строка {app.sheet_row}"
+
+
+def find_application(ref: str) -> Optional[Application]:
+    """
+    Заявка по ссылке из кнопки уведомления.
+    Постоянный ID ищется в индексе ID -> строка таблицы, без чтения таблицы; столбец ID читается,
+    только если заявка подана после последней синхронизации. Числовая ссылка - порядковый номер
+    записи из уведомлений, отправленных до появления постоянных ID.
+    Строка из индекса могла устареть - перед записью решения ее сверяет g_sheets.update_rows_batch.
+    """
+    if ref.isdigit():
+        return g_sheets.get_row_data(int(ref))
+    app = search_index.name_index.get_by_public_id(ref)
+    if app is not None and app.sheet_row is not None:
+        return app
+    _, sheet_row = g_sheets.find_sheet_row_by_public_id(ref)
+    if sheet_row is None:
+        return None
+    if app is None:
+        return g_sheets.get_row_data(sheet_row - 2)
+    app.sheet_row = sheet_row
+    return app
+
+
+# === ЗАЩИТА ОТ ПОВТОРНЫХ РЕШЕНИЙ ===
+# Решения, которые выполняются прямо сейчас: ключ заявки -> future, завершающийся вместе с решением.
+# Повторное нажатие (или второе действие по той же заявке) ждет его, а не пишет в таблицу еще раз.
+_in_flight: Dict[str, asyncio.Future] = {}
+
+
+def decision_key(app: Application) -> str:
+    """Ключ заявки для записи решения: постоянный ID, для старых строк без ID - номер строки."""
+    return app.public_id or f"row:{app.sheet_row}"
+
+
+def _ref_key(ref: str) -> str:
+    """Ключ заявки по ссылке из кнопки (до поиска самой заявки)."""
+    return f"row:{int(ref) + 2}" if ref.isdigit() else ref
+
+
+def describe_decision(decision: Dict) -> str:
+    """Ответ на повторное действие по уже рассмотренной заявке."""
+    if decision.get('state') == 'pending':
+        return "⏳ Заявка уже обрабатывается."
+    if not decision.get('status'):
+        return "⚠️ Не удалось проверить, рассмотрена ли заявка. Попробуйте позже."
+    by = f" ({decision['decided_by']})" if decision.get('decided_by') else ""
+    return f"Заявка уже рассмотрена: {decision['status']}{by}."
+
+
+async def existing_decision(key: str) -> Optional[Dict]:
+    """
+    Решение по заявке: если оно как раз выполняется, сначала дожидается его результата.
+    Брошенное незавершенное решение (например, бот перезапустился посреди записи) не возвращается -
+    его перехватит decide_once.
+    """
+    running = _in_flight.get(key)
+    if running is not None:
+        await asyncio.shield(running)
+    decision = await asyncio.to_thread(utils.get_decision, key)
+    return decision if utils.is_decision_active(decision) else None
+
+
+async def decide_once(apps: List[Application], status: str, decided_by: str, reason: Optional[str] = None,
+                      extra_columns: Optional[dict] = None) -> Tuple[List[Application], Dict[str, Dict], bool]:
+    """
+    Выполняет решение по заявкам не больше одного раза на заявку.
+    Заявки, по которым решение уже выполняется в этом процессе или записано в БД, пропускаются.
+    Возвращает (решенные заявки, пропущенные: ключ -> решение, успех записи в таблицу).
+    """
+    loop = asyncio.get_running_loop()
+    skipped: Dict[str, Dict] = {}
+    mine: Dict[str, Application] = {}
+    for app in apps:
+        key = decision_key(app)
+        if key in _in_flight or key in mine:
+            skipped[key] = {'app_key': key, 'state': 'pending'}
+        else:
+            _in_flight[key] = loop.create_future()
+            mine[key] = app
+
+    decided: List[Application] = []
+    success = True
+    try:
+        if mine:
+            existing = await asyncio.to_thread(utils.claim_decisions, list(mine), status, decided_by, reason)
+            skipped.update(existing)
+            decided = [app for key, app in mine.items() if key not in existing]
+            if decided:
+                try:
+                    success = await _apply_decision(decided, status, extra_columns)
+                except Exception as e:
+                    logger.error(f"Ошибка при записи решения '{status}': {e}", exc_info=True)
+                    success = False
+                await asyncio.to_thread(utils.finish_decisions, [decision_key(app) for app in decided], success)
+    finally:
+        for key in mine:
+            future = _in_flight.pop(key)
+            if not future.done():
+                future.set_result(None)
+
+    if skipped:
+        logger.info(f"Решение '{status}': пропущены уже рассмотренные заявки {sorted(skipped)}")
+    return decided if success else [], skipped, success
+
+
+def _callback_ref(data: str) -> str:
+    """Ссылка на заявку из callback_data вида 'approve:<ID>'."""
+    ref = data.split(':', 1)[1].strip()
+    if not ref:
+        raise ValueError(data)
+    return ref
+
+
 async def approve_request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обрабатывает одобрение заявки."""
+    """Обрабатывает одобрение заявки (повторные нажатия не выполняют его еще раз)."""
     query = update.callback_query
-    await query.answer()
     
     try:
-        row_index = int(query.data.split(':')[1])
-        logger.info(f"Одобрение заявки №{row_index + 1} (row_index={row_index})")
+        ref = _callback_ref(query.data)
+        logger.info(f"Одобрение заявки {ref}")
     except (IndexError, ValueError):
         logger.error(f"Ошибка парсинга callback_data: {query.data}")
+        await query.answer()
         await query.edit_message_text("Ошибка: неверный формат ID заявки.", reply_markup=None)
         return
 
-    # Обновляем статус в Google Sheets
-    success = g_sheets.update_cell_by_row(row_index, SheetCols.STATUS_COL, "Одобрено")
+    decision = await existing_decision(_ref_key(ref))
+    if decision:
+        await query.answer(describe_decision(decision), show_alert=True)
+        return
+    await query.answer()
+
+    app = await asyncio.to_thread(find_application, ref)
+    if not app:
+        logger.error(f"Заявка {ref} не найдена")
+        await query.edit_message_text(
+            query.message.text_html + "\n\n<b>❌ ОШИБКА: Заявка не найдена в таблице</b>",
+            parse_mode=ParseMode.HTML,
+            reply_markup=None
+        )
+        return
+    if app.is_final:
+        # Решение уже есть в таблице (например, принято до появления журнала решений или вручную)
+        await query.edit_message_text(
+            query.message.text_html + f"\n\n<b>Статус: {app.status}</b> <i>(заявка уже рассмотрена)</i>",
+            parse_mode=ParseMode.HTML,
+            reply_markup=None
+        )
+        return
+
+    # Статус и поле одобрения - одним запросом в таблицу, затем локальная БД и индекс
+    admin_name = admin_display_name(query.from_user)
+    _, skipped, success = await decide_once([app], "Одобрено", admin_name,
+                                                  extra_columns={SheetCols.APPROVAL_STATUS: "Одобрено"})
+    if skipped:
+        decision = await existing_decision(decision_key(app))
+        logger.info(f"Повторное одобрение заявки {application_label(app)} пропущено")
+        await query.message.reply_text(describe_decision(decision or next(iter(skipped.values()))))
+        return
 
     if not success:
-        logger.error(f"Не удалось обновить статус заявки №{row_index}")
+        logger.error(f"Не удалось обновить статус заявки {application_label(app)}")
         await query.edit_message_text(
             query.message.text_html + "\n\n<b>❌ ОШИБКА: Не удалось обновить статус</b>",
             parse_mode=ParseMode.HTML,
@@ -103,70 +286,26 @@ async def approve_request(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return
 
-    logger.info(f"Статус заявки №{row_index} успешно обновлен на 'Одобрено'")
+    logger.info(f"Статус заявки {application_label(app)} успешно обновлен на 'Одобрено'")
 
-    # Также обновляем поле одобрения
-    approval_success = g_sheets.update_cell_by_row(row_index, SheetCols.APPROVAL_STATUS, "Одобрено")
-    if approval_success:
-        logger.info(f"Поле одобрения для заявки №{row_index} обновлено")
-    else:
-        logger.warning(f"Не удалось обновить поле одобрения для заявки №{row_index}")
-
-    # Получаем данные строки для уведомления пользователя
-    row_data = g_sheets.get_row_data(row_index)
-    tg_id = row_data.get(SheetCols.TG_ID) if row_data else None
-    if not row_data:
-        logger.error(f"Не найдены данные для строки {row_index} (row_data is None)")
-        return
+    tg_id = app.tg_user_id
     if not tg_id:
-        logger.error(f"TG_ID отсутствует для строки {row_index}")
+        logger.error(f"TG_ID отсутствует для заявки {application_label(app)}")
         return
 
     try:
-        owner_name = f"{row_data.get(SheetCols.OWNER_FIRST_NAME_COL, '')} {row_data.get(SheetCols.OWNER_LAST_NAME_COL, '')}".strip() or "Не указано"
-        card_number = row_data.get(SheetCols.CARD_NUMBER_COL, "Не указан")
-        amount = row_data.get(SheetCols.AMOUNT_COL, "Не указана")
-        
-        # Вычисляем ближайший четверг для активации
-        from datetime import datetime, timedelta
-        
-        # Получаем данные администратора, который одобрил
-        admin_user = query.from_user
-        admin_name = f"{admin_user.first_name} {admin_user.last_name or ''}".strip()
-        if not admin_name:
-            admin_name = admin_user.username or "Руководитель"
-        
-        # Вычисляем ближайший четверг
-        today = datetime.now()
-        days_until_thursday = (3 - today.weekday()) % 7  # 3 = четверг (понедельник = 0)
-        if days_until_thursday == 0 and today.hour >= 22:  # Если сегодня четверг после 22:00
-            days_until_thursday = 7  # Следующий четверг
-        elif days_until_thursday == 0:  # Если сегодня четверг до 22:00
-            days_until_thursday = 0  # Сегодня вечером
-        
-        next_thursday = today + timedelta(days=days_until_thursday)
-        thursday_date = next_thursday.strftime("%d.%m.%Y")
-        
         # Отправляем уведомление пользователю
-        await context.bot.send_message(
+        await outbound.send_message(
+            context.bot,
             chat_id=tg_id,
-            text=(
-                f"🎉 <b>Заявка одобрена руководителем!</b>\n\n"
-                f"📋 <b>Детали заявки:</b>\n"
-                f"👤 Владелец карты: <b>{owner_name}</b>\n"
-                f"💳 Номер карты: <code>{card_number}</code>\n"
-                f"💰 Сумма/Скидка: <b>{amount}</b>\n\n"
-                f"✅ <b>Согласовано:</b> {admin_name}\n"
-                f"📅 <b>Активация:</b> {thursday_date} (четверг) после 22:00\n\n"
-                f"ℹ️ <i>Карта будет активирована автоматически в указанную дату.\n"
-                f"До этого времени средства недоступны для использования.</i>"
-            ),
+            priority=outbound.PRIORITY_ADMIN,
+            text=format_approval_message(app, admin_name),
             parse_mode=ParseMode.HTML
         )
         logger.info(f"Уведомление об одобрении отправлено пользователю {tg_id}")
         
         # Подтверждение админу о доставке
-        user_tag = row_data.get(SheetCols.TG_TAG, "неизвестно")
+        user_tag = (app.initiator_username or "неизвестно")
         await query.edit_message_text(
             query.message.text_html + f"\n\n<b>Статус: ✅ ОДОБРЕНО</b>\n📬 <i>Уведомление доставлено пользователю {user_tag}</i>",
             parse_mode=ParseMode.HTML,
@@ -176,25 +315,33 @@ async def approve_request(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         logger.error(f"Ошибка отправки уведомления пользователю {tg_id}: {e}")
         boss_id = os.getenv("BOSS_ID")
         if boss_id:
-            await context.bot.send_message(
+            await outbound.send_message(
+                context.bot,
                 boss_id,
-                f"⚠️ Не удалось уведомить пользователя {row_data.get(SheetCols.TG_TAG, 'неизвестно')} об одобрении заявки №{row_index}.\n\nОшибка: {str(e)}"
+                f"⚠️ Не удалось уведомить пользователя {app.initiator_username or 'неизвестно'} об одобрении заявки №{application_label(app)}.\n\nОшибка: {str(e)}",
+                priority=outbound.PRIORITY_ADMIN
             )
 
 async def reject_request_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Начинает процесс отклонения, запрашивая причину."""
+    """Начинает процесс отклонения, запрашивая причину (если заявку еще не рассмотрели)."""
     query = update.callback_query
-    await query.answer()
 
     try:
-        row_index = int(query.data.split(':')[1])
-        logger.info(f"Начинаем отклонение заявки №{row_index + 1} (row_index={row_index})")
+        ref = _callback_ref(query.data)
+        logger.info(f"Начинаем отклонение заявки {ref}")
     except (IndexError, ValueError):
         logger.error(f"Ошибка парсинга callback_data: {query.data}")
+        await query.answer()
         await query.edit_message_text("Ошибка: неверный формат ID заявки.", reply_markup=None)
         return ConversationHandler.END
+
+    decision = await existing_decision(_ref_key(ref))
+    if decision:
+        await query.answer(describe_decision(decision), show_alert=True)
+        return ConversationHandler.END
+    await query.answer()
         
-    context.user_data['admin_action_row_index'] = row_index
+    context.user_data['admin_action_ref'] = ref
     
     # Обновляем исходное сообщение
     await query.edit_message_text(
@@ -205,7 +352,7 @@ async def reject_request_start(update: Update, context: ContextTypes.DEFAULT_TYP
     
     # Отправляем запрос причины
     await query.message.reply_text(
-        f"📝 Пожалуйста, введите причину отказа для заявки №{row_index + 1}:\n\n"
+        f"📝 Пожалуйста, введите причину отказа для заявки №{ref}:\n\n"
         "💡 <i>Укажите конкретную причину, которая поможет заявителю исправить ошибки в будущем.</i>",
         parse_mode=ParseMode.HTML
     )
@@ -215,9 +362,12 @@ async def reject_request_start(update: Update, context: ContextTypes.DEFAULT_TYP
 async def reject_request_reason(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Получает причину, обновляет статус и уведомляет пользователя."""
     reason = update.message.text.strip()
-    row_index = context.user_data.get('admin_action_row_index')
+    ref = context.user_data.get('admin_action_ref')
+    if ref is None and context.user_data.get('admin_action_row_index') is not None:
+        # Диалог, начатый до появления постоянных ID (сохранен в persistence)
+        ref = str(context.user_data['admin_action_row_index'])
     
-    if not row_index:
+    if not ref:
         await update.message.reply_text("❌ Произошла ошибка: не найден ID заявки. Попробуйте снова.")
         return ConversationHandler.END
     
@@ -225,56 +375,53 @@ async def reject_request_reason(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("❌ Причина не может быть пустой. Введите причину отклонения:")
         return AWAIT_REJECT_REASON
         
-    logger.info(f"Отклоняем заявку №{row_index} с причиной: {reason}")
+    logger.info(f"Отклоняем заявку {ref} с причиной: {reason}")
     
-    # Обновляем статус и причину в Google Sheets
-    status_updated = g_sheets.update_cell_by_row(row_index, SheetCols.STATUS_COL, "Отклонено")
-    reason_updated = g_sheets.update_cell_by_row(row_index, SheetCols.REASON_REJECT, reason)
-    
-    if status_updated and reason_updated:
-        logger.info(f"Статус и причина для заявки №{row_index} успешно обновлены")
+    # Статус и причина - одним запросом в таблицу, затем локальная БД и индекс
+    app = await asyncio.to_thread(find_application, ref)
+    notice = None
+    success = False
+    if app and app.is_final:
+        notice = f"ℹ️ Заявка №{ref} уже рассмотрена: {app.status}."
+    elif app:
+        _, skipped, success = await decide_once([app], "Отклонено", admin_display_name(update.effective_user),
+                                                reason, {SheetCols.REASON_REJECT: reason})
+        if skipped:
+            decision = await existing_decision(decision_key(app))
+            notice = describe_decision(decision or next(iter(skipped.values())))
+
+    if notice:
+        logger.info(f"Повторное отклонение заявки {ref} пропущено")
+        await update.message.reply_text(notice)
+    elif app and success:
+        logger.info(f"Статус и причина для заявки {ref} успешно обновлены")
         await update.message.reply_text(
-            f"✅ <b>Заявка №{row_index} отклонена</b>\n\n"
-            f"📝 <b>Причина:</b> {reason}\n\n"
+            f"✅ <b>Заявка №{ref} отклонена</b>\n\n"
+            f"📝 <b>Причина:</b> {html.escape(reason)}\n\n"
             f"🔔 <i>Уведомление будет отправлено заявителю...</i>",
             parse_mode=ParseMode.HTML
         )
         
-        # Получаем данные для уведомления пользователя
-        row_data = g_sheets.get_row_data(row_index)
-        if row_data and row_data.get(SheetCols.TG_ID):
+        if app.tg_user_id:
             try:
-                user_id = row_data[SheetCols.TG_ID]
-                owner_name = f"{row_data.get(SheetCols.OWNER_FIRST_NAME_COL, '')} {row_data.get(SheetCols.OWNER_LAST_NAME_COL, '')}".strip()
-                card_number = row_data.get(SheetCols.CARD_NUMBER_COL, "Не указан")
+                user_id = app.tg_user_id
                 
                 # Отправляем уведомление пользователю
-                await context.bot.send_message(
+                await outbound.send_message(
+                    context.bot,
                     chat_id=user_id,
-                    text=(
-                        f"😔 <b>Заявка отклонена</b>\n\n"
-                        f"📋 <b>Детали заявки:</b>\n"
-                        f"👤 Владелец карты: <b>{owner_name}</b>\n"
-                        f"💳 Номер карты: <code>{card_number}</code>\n\n"
-                        f"❌ <b>К сожалению, ваша заявка была отклонена.</b>\n\n"
-                        f"📝 <b>Причина отклонения:</b>\n"
-                        f"<i>{reason}</i>\n\n"
-                        f"� <b>Что делать дальше?</b>\n"
-                        f"• Изучите причину отклонения\n"
-                        f"• Исправьте указанные замечания\n"
-                        f"• Подайте новую заявку\n\n"
-                        f"💡 <i>Мы всегда готовы помочь! Обращайтесь, если есть вопросы.</i>"
-                    ),
+                    priority=outbound.PRIORITY_ADMIN,
+                    text=format_rejection_message(app, reason),
                     parse_mode=ParseMode.HTML
                 )
                 logger.info(f"Уведомление об отклонении отправлено пользователю {user_id}")
                 
                 # Подтверждение админу о доставке
-                user_tag = row_data.get(SheetCols.TG_TAG, "неизвестно")
+                user_tag = (app.initiator_username or "неизвестно")
                 await update.message.reply_text(
                     f"📬 <b>Уведомление доставлено!</b>\n\n"
                     f"👤 Пользователь: {user_tag}\n"
-                    f"✅ Уведомление об отклонении заявки №{row_index} успешно отправлено",
+                    f"✅ Уведомление об отклонении заявки №{ref} успешно отправлено",
                     parse_mode=ParseMode.HTML
                 )
                 
@@ -284,18 +431,266 @@ async def reject_request_reason(update: Update, context: ContextTypes.DEFAULT_TY
                 # Уведомляем босса об ошибке
                 boss_id = os.getenv("BOSS_ID")
                 if boss_id:
-                    await context.bot.send_message(
-                        boss_id, 
-                        f"⚠️ Не удалось уведомить пользователя {row_data.get(SheetCols.TG_TAG, 'неизвестно')} об отклонении заявки №{row_index}.\n\nОшибка: {str(e)}"
+                    await outbound.send_message(
+                        context.bot,
+                        boss_id,
+                        f"⚠️ Не удалось уведомить пользователя {app.initiator_username or 'неизвестно'} об отклонении заявки №{ref}.\n\nОшибка: {str(e)}",
+                        priority=outbound.PRIORITY_ADMIN
                     )
         else:
-            logger.error(f"Не найдены данные для строки {row_index} или отсутствует TG_ID")
+            logger.error(f"Отсутствует TG_ID для заявки {ref}")
     else:
-        logger.error(f"Ошибка обновления статуса/причины для заявки №{row_index}")
-        await update.message.reply_text(f"❌ Ошибка: не удалось обновить статус заявки №{row_index}")
+        logger.error(f"Ошибка обновления статуса/причины для заявки {ref}")
+        await update.message.reply_text(f"❌ Ошибка: не удалось обновить статус заявки №{ref}")
 
     # Очищаем данные
-    if 'admin_action_row_index' in context.user_data:
-        del context.user_data['admin_action_row_index']
+    context.user_data.pop('admin_action_ref', None)
+    context.user_data.pop('admin_action_row_index', None)
     
     return ConversationHandler.END
+
+
+# === ОЧЕРЕДЬ НА СОГЛАСОВАНИЕ (массовое одобрение/отклонение) ===
+
+def _is_boss(user) -> bool:
+    return str(user.id) == os.getenv("BOSS_ID")
+
+
+def _load_pending() -> List[Application]:
+    """Очередь на согласование: из индекса статусов, пока он не построен - из локальной БД."""
+    index = search_index.name_index
+    if index.ready:
+        return [app for app in index.with_status(ApplicationStatus.PENDING) if app.sheet_row is not None]
+    return [Application.from_db_row(row) for row in utils.get_pending_applications()]
+
+
+def _selected_pending(context: ContextTypes.DEFAULT_TYPE, pending: List[Application]) -> List[Application]:
+    """Выбранные заявки, которые все еще ждут решения (остальные убираются из выбора)."""
+    selection = context.user_data.get('pending_selection') or set()
+    selected = [app for app in pending if app.app_id in selection]
+    context.user_data['pending_selection'] = {app.app_id for app in selected}
+    return selected
+
+
+def _back_to_queue_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("⏳ К очереди", callback_data=f"{CALLBACK_PENDING_PREFIX}page:0")]])
+
+
+def _render_pending_queue(pending: List[Application], selection: set, page: int) -> Tuple[str, InlineKeyboardMarkup]:
+    """Текст и клавиатура одной страницы очереди с отметками выбранных заявок."""
+    back_row = [InlineKeyboardButton("⬅️ Назад в настройки", callback_data="back_to_settings")]
+    if not pending:
+        return "✅ Нет заявок на согласовании.", InlineKeyboardMarkup([back_row])
+
+    total_pages = (len(pending) + PENDING_PAGE_SIZE - 1) // PENDING_PAGE_SIZE
+    page = max(0, min(page, total_pages - 1))
+    start = page * PENDING_PAGE_SIZE
+    page_items = pending[start:start + PENDING_PAGE_SIZE]
+
+    text = f"<b>⏳ На согласовании: {len(pending)}</b> (выбрано: {len(selection)})\n\n"
+    keyboard = []
+    for number, app in enumerate(page_items, start + 1):
+        mark = "☑️" if app.app_id in selection else "⬜"
+        created = app.created_at.strftime('%d.%m') if app.created_at else '-'
+        text += (f"{number}. <b>{app.owner_name or '-'}</b> · <code>{app.card_number or '-'}</code> · "
+                 f"{app.amount_text} · {created}\n    🤵‍♂️ {app.initiator_fio or '-'}\n")
+        keyboard.append([InlineKeyboardButton(
+            f"{mark} {number}. {app.owner_name or '-'}"[:60],
+            callback_data=f"{CALLBACK_PENDING_PREFIX}toggle:{app.app_id}:{page}"
+        )])
+
+    keyboard.append([
+        InlineKeyboardButton("☑️ Выбрать страницу", callback_data=f"{CALLBACK_PENDING_PREFIX}all:{page}"),
+        InlineKeyboardButton("⬜ Снять выбор", callback_data=f"{CALLBACK_PENDING_PREFIX}none:{page}"),
+    ])
+    nav_row = []
+    if page > 0:
+        nav_row.append(InlineKeyboardButton("⬅️", callback_data=f"{CALLBACK_PENDING_PREFIX}page:{page - 1}"))
+    nav_row.append(InlineKeyboardButton(f" {page + 1}/{total_pages} ", callback_data="noop"))
+    if page + 1 < total_pages:
+        nav_row.append(InlineKeyboardButton("➡️", callback_data=f"{CALLBACK_PENDING_PREFIX}page:{page + 1}"))
+    keyboard.append(nav_row)
+    if selection:
+        keyboard.append([
+            InlineKeyboardButton(f"✅ Одобрить ({len(selection)})", callback_data=f"{CALLBACK_PENDING_PREFIX}approve"),
+            InlineKeyboardButton(f"❌ Отклонить ({len(selection)})", callback_data=f"{CALLBACK_PENDING_PREFIX}reject"),
+        ])
+    keyboard.append(back_row)
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+async def pending_queue_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает очередь на согласование и обрабатывает выбор заявок (pending:page|toggle|all|none)."""
+    query = update.callback_query
+    if not _is_boss(query.from_user):
+        await query.answer("Доступно только руководителю.", show_alert=True)
+        return
+    await query.answer()
+
+    parts = query.data[len(CALLBACK_PENDING_PREFIX):].split(':')
+    action = parts[0]
+    try:
+        page = int(parts[-1])
+    except ValueError:
+        page = 0
+
+    pending = await asyncio.to_thread(_load_pending)
+    selection = {app.app_id for app in _selected_pending(context, pending)}
+    page_ids = [app.app_id for app in pending[page * PENDING_PAGE_SIZE:(page + 1) * PENDING_PAGE_SIZE]]
+
+    if action == 'toggle' and len(parts) == 3 and parts[1].isdigit():
+        app_id = int(parts[1])
+        if app_id in selection:
+            selection.discard(app_id)
+        elif any(app.app_id == app_id for app in pending):
+            selection.add(app_id)
+    elif action == 'all':
+        selection.update(page_ids)
+    elif action == 'none':
+        selection.clear()
+    context.user_data['pending_selection'] = selection
+
+    text, keyboard = _render_pending_queue(pending, selection, page)
+    try:
+        await query.edit_message_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+    except Exception as e:
+        # "Message is not modified" при повторном нажатии - не ошибка
+        logger.debug(f"Очередь на согласование не обновлена: {e}")
+
+
+async def _apply_decision(apps: List[Application], status: str, extra_columns: Optional[dict] = None) -> bool:
+    """
+    Записывает решение по заявкам одним пакетным запросом в таблицу, затем в локальную БД и индекс.
+    Номера строк взяты из индекса и могли устареть, поэтому таблица сверяет их с ID заявок перед записью;
+    локальная БД и индекс обновляются по ID.
+    """
+    updates = {app.sheet_row: {SheetCols.STATUS_COL: status, **(extra_columns or {})} for app in apps}
+    public_ids = {app.sheet_row: app.public_id for app in apps if app.public_id}
+    if not await asyncio.to_thread(g_sheets.update_rows_batch, updates, public_ids):
+        return False
+    await asyncio.to_thread(
+        utils.update_application_statuses_local,
+        [app.public_id for app in apps if app.public_id], status,
+        [app.sheet_row for app in apps if not app.public_id]
+    )
+    for app in apps:
+        search_index.name_index.set_status(app.public_id, status, app.sheet_row)
+    logger.info(f"Решение '{status}': {len(apps)} заявок ({', '.join(application_label(app) for app in apps)})")
+    return True
+
+
+def _skipped_note(skipped: Dict[str, Dict]) -> str:
+    """Строка отчета о заявках, которые уже рассмотрены другим действием."""
+    if not skipped:
+        return ""
+    return f"\n⏭ Уже рассмотрены другим действием: {len(skipped)}"
+
+
+async def _notify_applicants(bot, messages: List[Tuple[Application, str]]) -> Tuple[int, int]:
+    """
+    Рассылает уведомления инициаторам через общую очередь исходящих сообщений (с ограничением скорости).
+    Возвращает (доставлено, всего).
+    """
+    targets = [(app, text) for app, text in messages if app.tg_user_id]
+    results = await asyncio.gather(*(
+        outbound.send_message(bot, chat_id=app.tg_user_id, text=text,
+                              priority=outbound.PRIORITY_NOTIFICATION, parse_mode=ParseMode.HTML)
+        for app, text in targets
+    ), return_exceptions=True)
+
+    delivered = 0
+    for (app, _), result in zip(targets, results):
+        if isinstance(result, Exception):
+            logger.error(f"Не удалось уведомить пользователя {app.tg_user_id} о решении по заявке (строка {app.sheet_row}): {result}")
+        else:
+            delivered += 1
+    return delivered, len(targets)
+
+
+async def pending_approve_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Одобряет все выбранные заявки из очереди."""
+    query = update.callback_query
+    if not _is_boss(query.from_user):
+        await query.answer("Доступно только руководителю.", show_alert=True)
+        return
+
+    apps = _selected_pending(context, await asyncio.to_thread(_load_pending))
+    if not apps:
+        await query.answer("Не выбрано ни одной заявки.", show_alert=True)
+        return
+    await query.answer()
+    await query.edit_message_text(f"⏳ Одобряю заявки: {len(apps)}...")
+
+    admin_name = admin_display_name(query.from_user)
+    approved = {SheetCols.APPROVAL_STATUS: "Одобрено"}
+    apps, skipped, success = await decide_once(apps, "Одобрено", admin_name, extra_columns=approved)
+    if not success:
+        await query.edit_message_text("❌ Не удалось обновить статусы в таблице. Попробуйте еще раз.",
+                                      reply_markup=_back_to_queue_keyboard())
+        return
+    context.user_data.pop('pending_selection', None)
+
+    delivered, total = await _notify_applicants(
+        context.bot, [(app, format_approval_message(app, admin_name)) for app in apps]
+    )
+    await query.edit_message_text(
+        f"<b>✅ Одобрено заявок: {len(apps)}</b>\n📬 Уведомлений доставлено: {delivered} из {total}"
+        + _skipped_note(skipped),
+        parse_mode=ParseMode.HTML,
+        reply_markup=_back_to_queue_keyboard()
+    )
+
+
+async def bulk_reject_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Начинает массовое отклонение выбранных заявок: запрашивает общую причину."""
+    query = update.callback_query
+    if not _is_boss(query.from_user):
+        await query.answer("Доступно только руководителю.", show_alert=True)
+        return ConversationHandler.END
+
+    apps = _selected_pending(context, await asyncio.to_thread(_load_pending))
+    if not apps:
+        await query.answer("Не выбрано ни одной заявки.", show_alert=True)
+        return ConversationHandler.END
+    await query.answer()
+
+    context.user_data['bulk_reject_ids'] = [app.app_id for app in apps]
+    await query.edit_message_text(
+        f"📝 Введите причину отказа для выбранных заявок ({len(apps)}).\n\n"
+        "💡 <i>Причина будет отправлена каждому заявителю.</i>",
+        parse_mode=ParseMode.HTML
+    )
+    return AWAIT_BULK_REJECT_REASON
+
+
+async def bulk_reject_reason(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Получает причину и отклоняет все выбранные заявки."""
+    reason = update.message.text.strip()
+    if not reason:
+        await update.message.reply_text("❌ Причина не может быть пустой. Введите причину отклонения:")
+        return AWAIT_BULK_REJECT_REASON
+
+    ids = set(context.user_data.pop('bulk_reject_ids', None) or [])
+    apps = [app for app in await asyncio.to_thread(_load_pending) if app.app_id in ids]
+    if not apps:
+        await update.message.reply_text("🤷 Выбранные заявки уже рассмотрены.", reply_markup=_back_to_queue_keyboard())
+        return ConversationHandler.END
+
+    apps, skipped, success = await decide_once(apps, "Отклонено", admin_display_name(update.effective_user),
+                                               reason, {SheetCols.REASON_REJECT: reason})
+    if not success:
+        await update.message.reply_text("❌ Не удалось обновить статусы в таблице. Попробуйте еще раз.",
+                                        reply_markup=_back_to_queue_keyboard())
+        return ConversationHandler.END
+    context.user_data.pop('pending_selection', None)
+
+    delivered, total = await _notify_applicants(
+        context.bot, [(app, format_rejection_message(app, reason)) for app in apps]
+    )
+    await update.message.reply_text(
+        f"<b>❌ Отклонено заявок: {len(apps)}</b>\n📝 <b>Причина:</b> {html.escape(reason)}\n"
+        f"📬 Уведомлений доставлено: {delivered} из {total}" + _skipped_note(skipped),
+        parse_mode=ParseMode.HTML,
+        reply_markup=_back_to_queue_keyboard()
+    )
+    return ConversationHandler.END
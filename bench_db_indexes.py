@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Бенчмарк индексов локальной БД.
+Создает временную БД со схемой из utils.init_local_db, заполняет ее синтетическими
+заявками и пользователями, печатает планы запросов (EXPLAIN QUERY PLAN) и время выполнения.
+Скрипт завершается с ошибкой, если какой-то из горячих запросов не использует свой индекс
+или досортировывает результат во временном B-дереве (индекс не покрывает ORDER BY).
+
+Запуск: python bench_db_indexes.py [количество_заявок]
+"""
+
+import os
+import sys
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+APPLICATIONS_COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+USERS_COUNT = 2_000
+REPEATS = 50
+
+# БД создается во временной папке, рабочая bot_data.db не затрагивается
+BENCH_DIR = tempfile.mkdtemp(prefix='bench_db_')
+os.environ['RAILWAY_VOLUME_MOUNT_PATH'] = BENCH_DIR
+
+import utils  # noqa: E402  (путь к БД должен быть задан до импорта)
+
+
+def fill_db(conn: sqlite3.Connection) -> None:
+    """Заполняет БД синтетическими данными."""
+    random.seed(42)
+    now = datetime.now()
+    statuses = ['На согласовании', 'Одобрено', 'Отклонено']
+    users = [str(100_000 + i) for i in range(USERS_COUNT)]
+
+    conn.executemany(
+        'INSERT INTO users (tg_id, fio, email, last_activity) VALUES (?, ?, ?, ?)',
+        [(tg_id, f'Пользователь {tg_id}', f'{tg_id}@example.com', now - timedelta(days=random.randint(0, 60)))
+         for tg_id in users]
+    )
+
+    rows = []
+    for _ in range(APPLICATIONS_COUNT):
+        created = now - timedelta(minutes=random.randint(0, 60 * 24 * 365 * 2))
+        rows.append((
+            random.choice(users), 'Иванов', 'Иван', f'8{random.randint(10**9, 10**10 - 1)}',
+            random.choice(['Бартер', 'Скидка']), random.choice(statuses),
+            created.strftime(utils.TIMESTAMP_FORMAT), utils.to_epoch(created)
+        ))
+    conn.executemany('''
+        INSERT INTO applications
+        (tg_user_id, owner_last_name, owner_first_name, card_number, card_type, status, created_at, created_ts)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    conn.commit()
+    conn.execute('ANALYZE')
+
+
+def bench(conn: sqlite3.Connection, title: str, sql: str, params: tuple, expected_index: str) -> bool:
+    """
+    Печатает план и среднее время запроса.
+    Возвращает True, если используется ожидаемый индекс и сортировка не требует временного B-дерева.
+    """
+    plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+
+    started = time.perf_counter()
+    for _ in range(REPEATS):
+        conn.execute(sql, params).fetchall()
+    elapsed_ms = (time.perf_counter() - started) / REPEATS * 1000
+
+    uses_index = (any(expected_index in step for step in plan)
+                  and not any('TEMP B-TREE' in step for step in plan))
+    print(f"\n{'✅' if uses_index else '❌'} {title}: {elapsed_ms:.3f} мс")
+    for step in plan:
+        print(f"    {step}")
+    return uses_index
+
+
+def main() -> int:
+    utils.init_local_db()
+    conn = sqlite3.connect(utils.get_db_path())
+    print(f"Заполняем БД: {APPLICATIONS_COUNT} заявок, {USERS_COUNT} пользователей...")
+    fill_db(conn)
+
+    now = datetime.now()
+    user_id = '100042'
+    anchor_ts = utils.to_epoch(now - timedelta(days=30))
+
+    checks = [
+        ("Мои заявки, первая страница",
+         'SELECT * FROM applications WHERE tg_user_id = ? ORDER BY created_ts DESC, id DESC LIMIT 7',
+         (user_id,), 'idx_applications_user_created_ts'),
+        ("Мои заявки, страница по курсору",
+         'SELECT * FROM applications WHERE tg_user_id = ? AND (created_ts, id) < (?, ?) '
+         'ORDER BY created_ts DESC, id DESC LIMIT 7',
+         (user_id, anchor_ts, 10**9), 'idx_applications_user_created_ts'),
+        ("Все заявки (босс), страница по курсору",
+         'SELECT * FROM applications WHERE (created_ts, id) < (?, ?) ORDER BY created_ts DESC, id DESC LIMIT 7',
+         (anchor_ts, 10**9), 'idx_applications_created_id'),
+        ("Отчет: заявки за 24 часа",
+         "SELECT COUNT(*), SUM(status = 'Одобрено'), SUM(status = 'Отклонено') FROM applications WHERE created_ts > ?",
+         (utils.to_epoch(now - timedelta(days=1)),), 'COVERING INDEX idx_applications_created_ts'),
+        ("Ожидающие решения за неделю",
+         'SELECT * FROM applications WHERE status = ? AND created_ts > ? ORDER BY created_ts DESC',
+         ('На согласовании', utils.to_epoch(now - timedelta(days=7))), 'idx_applications_status_created_ts'),
+        ("Пользователи для напоминания",
+         'SELECT * FROM users WHERE last_activity < ? ORDER BY last_activity ASC',
+         (now - timedelta(days=7),), 'idx_users_last_activity'),
+    ]
+
+    results = [bench(conn, *check) for check in checks]
+    conn.close()
+
+    print(f"\nИтого: {sum(results)}/{len(results)} запросов используют ожидаемые индексы")
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    try:
+        exit_code = main()
+    finally:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+    sys.exit(exit_code)
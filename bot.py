@@ -9,9 +9,10 @@
 import logging
 import os
 import datetime
+from telegram import Update
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ConversationHandler, filters
+    ConversationHandler, InlineQueryHandler, TypeHandler, filters
 )
 
 import constants
@@ -23,10 +24,15 @@ import search_handlers
 import settings_handlers
 import admin_handlers
 import reports  # Новый импорт для отчетов
+import outbound
+import persistence
+import scratch
+import submissions
 import utils
 
 # --- НАСТРОЙКА СРЕДЫ И ЛОГГИРОВАНИЯ ---
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+SHEETS_SYNC_INTERVAL = int(os.getenv("SHEETS_SYNC_INTERVAL", 300))  # секунды
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     level=logging.INFO
@@ -34,6 +40,21 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+async def post_init(application: Application) -> None:
+    """Запускает фоновые службы: очередь исходящих сообщений и отправку заявок в таблицу."""
+    await outbound.start(application)
+    await submissions.start(application)
+
+
+async def post_shutdown(application: Application) -> None:
+    """Останавливает фоновые службы и сохраняет накопленные данные при остановке бота."""
+    # Сначала отправка заявок: ее уведомления идут через очередь исходящих сообщений
+    await submissions.stop(application)
+    await outbound.stop(application)
+    flushed = utils.flush_activity_buffer()
+    logger.info(f"Буфер активности сброшен при остановке: {flushed} пользователей")
+
+
 def main() -> None:
     """Инициализирует и запускает бота."""
     if not TELEGRAM_BOT_TOKEN:
@@ -46,7 +67,14 @@ def main() -> None:
     else:
         logger.warning("Не удалось инициализировать локальную базу данных, работаем только с Google Sheets")
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .persistence(persistence.SQLitePersistence())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # --- Фильтры для кнопок меню ---
     filters_map = {
@@ -77,6 +105,8 @@ def main() -> None:
             constants.REGISTER_JOB_TITLE: [MessageHandler(text_filter, registration_handlers.get_job_title_and_finish)],
         },
         fallbacks=[fallback_handler, cancel_handler],
+        name="registration",
+        persistent=True,
     )
 
     # --- ДИАЛОГ ПОДАЧИ ЗАЯВКИ ---
@@ -98,6 +128,8 @@ def main() -> None:
             ],
         },
         fallbacks=[fallback_handler, cancel_handler],
+        name="application_form",
+        persistent=True,
     )
 
     # --- ДИАЛОГ ПОИСКА ---
@@ -108,18 +140,28 @@ def main() -> None:
             constants.AWAIT_SEARCH_QUERY: [MessageHandler(text_filter, search_handlers.perform_search)]
         },
         fallbacks=[fallback_handler, cancel_handler],
+        name="search",
+        persistent=True,
     )
 
     # --- ДИАЛОГ АДМИНСКИХ ДЕЙСТВИЙ ---
     admin_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(admin_handlers.reject_request_start, f"^{constants.CALLBACK_REJECT_PREFIX}")],
+        entry_points=[
+            CallbackQueryHandler(admin_handlers.reject_request_start, f"^{constants.CALLBACK_REJECT_PREFIX}"),
+            CallbackQueryHandler(admin_handlers.bulk_reject_start, f"^{constants.CALLBACK_PENDING_PREFIX}reject$"),
+        ],
         states={
-            constants.AWAIT_REJECT_REASON: [MessageHandler(text_filter, admin_handlers.reject_request_reason)]
+            constants.AWAIT_REJECT_REASON: [MessageHandler(text_filter, admin_handlers.reject_request_reason)],
+            constants.AWAIT_BULK_REJECT_REASON: [MessageHandler(text_filter, admin_handlers.bulk_reject_reason)],
         },
         fallbacks=[cancel_handler],
+        name="admin_reject",
+        persistent=True,
     )
 
     # --- Добавляем все обработчики в приложение ---
+    # Учет активности идет в отдельной группе и не мешает остальным обработчикам
+    application.add_handler(TypeHandler(Update, navigation_handlers.track_user_activity), group=-1)
     application.add_handler(CommandHandler("start", navigation_handlers.start_command))
     application.add_handler(MessageHandler(filters_map['main'], navigation_handlers.main_menu_command))
     application.add_handler(MessageHandler(filters_map['settings'], settings_handlers.show_settings))
@@ -129,18 +171,25 @@ def main() -> None:
     application.add_handler(search_conv)
     application.add_handler(admin_conv) # Админский диалог
 
+    # Инлайн-поиск карт (@бот номер или фамилия)
+    application.add_handler(InlineQueryHandler(search_handlers.inline_search))
+
     # Обработчики колбэков для меню настроек
     # ... (здесь ваш код для обработчиков кнопок из settings_handlers остается без изменений)
     application.add_handler(CallbackQueryHandler(settings_handlers.my_cards_command, "^settings_my_cards$"))
     application.add_handler(CallbackQueryHandler(settings_handlers.help_callback, "^help_show$"))
     application.add_handler(CallbackQueryHandler(settings_handlers.stats_callback, "^stats_show$"))
-    application.add_handler(CallbackQueryHandler(settings_handlers.export_csv_callback, "^export_csv$"))
+    application.add_handler(CallbackQueryHandler(settings_handlers.export_csv_callback, r"^export_csv(:|$)"))
     application.add_handler(CallbackQueryHandler(settings_handlers.back_to_settings_callback, "^back_to_settings$"))
     application.add_handler(CallbackQueryHandler(settings_handlers.handle_pagination, r"^paginate_"))
+    application.add_handler(CallbackQueryHandler(settings_handlers.handle_my_cards_pagination, r"^mycards:"))
     application.add_handler(CallbackQueryHandler(settings_handlers.noop_callback, r"^noop$"))
 
     # Обработчики админских колбэков (отдельно от ConversationHandler для корректной работы)
     application.add_handler(CallbackQueryHandler(admin_handlers.approve_request, f"^{constants.CALLBACK_APPROVE_PREFIX}"))
+    # Очередь на согласование: выбор заявок и массовое одобрение (массовое отклонение - в admin_conv)
+    application.add_handler(CallbackQueryHandler(admin_handlers.pending_queue_callback, f"^{constants.CALLBACK_PENDING_PREFIX}(page|toggle|all|none):"))
+    application.add_handler(CallbackQueryHandler(admin_handlers.pending_approve_selected, f"^{constants.CALLBACK_PENDING_PREFIX}approve$"))
     
     # ВАЖНО: CallbackQueryHandler для reject должен быть в ConversationHandler выше!
 
@@ -156,6 +205,24 @@ def main() -> None:
         # Напоминания пользователям по средам в 14:00
         job_queue.run_daily(reports.send_user_reminders, time=datetime.time(hour=14, minute=0), days=(2,))  # 2 = среда
         
+        # Синхронизация локального зеркала таблицы (из него строятся отчеты)
+        job_queue.run_repeating(reports.sync_local_mirror, interval=SHEETS_SYNC_INTERVAL, first=5)
+        
+        # Архивация старых завершенных заявок каждый день в 03:00
+        job_queue.run_daily(reports.archive_old_applications, time=datetime.time(hour=3, minute=0), days=(0, 1, 2, 3, 4, 5, 6))
+        
+        # Сводка по доставке исходящих сообщений раз в час
+        job_queue.run_repeating(outbound.log_metrics, interval=3600, first=3600)
+        
+        # Доля попаданий в кеш результатов поиска раз в час
+        job_queue.run_repeating(search_handlers.log_cache_stats, interval=3600, first=3600)
+        
+        # Очистка временных списков пользователей и отчет о занимаемой ими памяти
+        job_queue.run_repeating(scratch.purge_and_log_usage, interval=600, first=600)
+        
+        # Сброс буфера активности пользователей в БД каждые 5 секунд
+        job_queue.run_repeating(reports.flush_user_activity, interval=5, first=5)
+        
         # Очистка кэша каждые 6 часов
         job_queue.run_repeating(utils.cleanup_old_cache, interval=21600, first=10)  # 21600 сек = 6 часов
         
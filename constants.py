@@ -38,12 +38,14 @@ CARDS_PER_PAGE = 7
 
     # Admin states
     AWAIT_REJECT_REASON,
-) = range(17)
+    AWAIT_BULK_REJECT_REASON,
+) = range(18)
 
 
 # --- Callback Data Prefixes ---
 CALLBACK_APPROVE_PREFIX = "approve:"
 CALLBACK_REJECT_PREFIX = "reject:"
+CALLBACK_PENDING_PREFIX = "pending:"
 
 
 # --- Google Sheet Column Names ---
@@ -69,3 +71,4 @@ class SheetCols:
     START_DATE = 'STARTDATE (пополнение по четвергам после 22:00)'
     ACTIVATED = 'Активировано'
     REASON_REJECT = 'Причина отказа'  # Оставляем для обратной совместимости
+    APP_ID = 'ID заявки'  # Постоянный ID заявки (не меняется при сортировке и удалении строк)
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+
+"""
+Потоковый экспорт заявок в CSV.
+Строки берутся из генератора и сразу пишутся в SpooledTemporaryFile: небольшой экспорт
+остается в памяти, большой автоматически уходит на диск. Поддерживается сжатие gzip/zip
+и выбор набора колонок. Экспорт, который не помещается в лимит Telegram на отправку файла,
+делится по строкам на части (каждая - самостоятельный CSV с заголовком) и отправляется
+несколькими документами, так что при отправке в памяти одновременно находится не больше
+одной части.
+
+Экспорт из бота выполняется фоновой задачей JobQueue: одинаковые запросы объединяются
+в одну задачу, сообщение о прогрессе обновляется по мере записи строк, а готовый файл
+(его file_id в Telegram) переиспользуется в течение EXPORT_CACHE_TTL секунд.
+"""
+
+import asyncio
+import csv
+import gzip
+import io
+import itertools
+import logging
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from telegram import InputFile, Message
+from telegram.ext import ContextTypes
+
+import keyboards
+import utils
+from constants import SheetCols
+from models import Application
+
+logger = logging.getLogger(__name__)
+
+# Сколько байт держим в памяти, прежде чем файл будет сброшен на диск
+SPOOL_MAX_SIZE = 1024 * 1024
+# Лимит Telegram Bot API на размер отправляемого ботом файла
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+# После какого размера начинается новая часть экспорта (запас на буферы сжатия и multipart-запрос)
+EXPORT_PART_SIZE = TELEGRAM_UPLOAD_LIMIT - 5 * 1024 * 1024
+
+COMPRESSION_NONE = None
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZIP = 'zip'
+COMPRESSIONS = (COMPRESSION_NONE, COMPRESSION_GZIP, COMPRESSION_ZIP)
+
+# Сколько строк пишется между вызовами callback прогресса
+PROGRESS_EVERY_ROWS = 1000
+# Как часто (в секундах) обновляется сообщение о прогрессе
+PROGRESS_EDIT_INTERVAL = 3
+# Сколько секунд готовый файл переиспользуется для повторных запросов
+EXPORT_CACHE_TTL = 300
+
+# Наборы колонок для экспорта (заголовки совпадают с заголовками таблицы)
+EXPORT_COLUMNS: Dict[str, List[str]] = {
+    'full': [
+        SheetCols.APP_ID, SheetCols.TIMESTAMP, SheetCols.TG_ID, SheetCols.TG_TAG, SheetCols.FIO_INITIATOR,
+        SheetCols.OWNER_FIRST_NAME_COL, SheetCols.OWNER_LAST_NAME_COL, SheetCols.REASON_COL,
+        SheetCols.CARD_TYPE_COL, SheetCols.CARD_NUMBER_COL, SheetCols.CATEGORY_COL,
+        SheetCols.AMOUNT_COL, SheetCols.FREQUENCY_COL, SheetCols.ISSUE_LOCATION_COL,
+        SheetCols.STATUS_COL,
+    ],
+    'short': [
+        SheetCols.TIMESTAMP, SheetCols.OWNER_LAST_NAME_COL, SheetCols.OWNER_FIRST_NAME_COL,
+        SheetCols.CARD_NUMBER_COL, SheetCols.CARD_TYPE_COL, SheetCols.AMOUNT_COL,
+        SheetCols.STATUS_COL,
+    ],
+}
+
+
+def _write_rows(binary_stream, records: Iterable[Dict], columns: List[str],
+                progress: Optional[Callable[[int], None]] = None, written_before: int = 0,
+                full: Optional[Callable[[], bool]] = None) -> int:
+    """
+    Пишет CSV (UTF-8 с BOM для Excel) в бинарный поток. Возвращает количество строк.
+    Если full() вернул True, запись останавливается, а оставшиеся записи остаются в итераторе records.
+    written_before - сколько строк уже записано в предыдущие части (для progress).
+    """
+    text = io.TextIOWrapper(binary_stream, encoding='utf-8-sig', newline='')
+    writer = csv.DictWriter(text, fieldnames=columns, extrasaction='ignore')
+    writer.writeheader()
+    count = 0
+    for record in records:
+        writer.writerow(record)
+        count += 1
+        if progress and (written_before + count) % PROGRESS_EVERY_ROWS == 0:
+            progress(written_before + count)
+        if full and full():
+            break
+    text.flush()
+    # Отсоединяем обертку, чтобы она не закрыла поток под собой
+    text.detach()
+    return count
+
+
+def _write_file(records: Iterator[Dict], columns: List[str], compression: Optional[str], inner_name: str,
+                progress: Optional[Callable[[int], None]] = None, written_before: int = 0,
+                max_size: Optional[int] = None) -> Tuple[tempfile.SpooledTemporaryFile, int]:
+    """Один временный файл CSV; запись останавливается, когда файл дорастает до max_size байт."""
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode='w+b')
+    full = (lambda: spool.tell() >= max_size) if max_size else None
+    try:
+        if compression == COMPRESSION_GZIP:
+            with gzip.GzipFile(filename=inner_name, fileobj=spool, mode='wb') as gz:
+                count = _write_rows(gz, records, columns, progress, written_before, full)
+        elif compression == COMPRESSION_ZIP:
+            with zipfile.ZipFile(spool, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+                with archive.open(inner_name, 'w', force_zip64=True) as entry:
+                    count = _write_rows(entry, records, columns, progress, written_before, full)
+        else:
+            count = _write_rows(spool, records, columns, progress, written_before, full)
+    except Exception:
+        spool.close()
+        raise
+
+    spool.seek(0)
+    return spool, count
+
+
+def write_csv(records: Iterable[Dict], columns: List[str], compression: Optional[str] = None,
+              inner_name: str = 'export.csv',
+              progress: Optional[Callable[[int], None]] = None) -> Tuple[tempfile.SpooledTemporaryFile, int]:
+    """
+    Записывает записи в CSV во временный файл (с опциональным сжатием).
+    progress(count) вызывается каждые PROGRESS_EVERY_ROWS строк.
+    Возвращает файл, перемотанный в начало, и количество записанных строк.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Неизвестный тип сжатия: {compression}")
+    return _write_file(iter(records), columns, compression, inner_name, progress)
+
+
+def _part_name(name: str, part: int) -> str:
+    """export.csv -> export_part2.csv (суффикс ставится перед расширением)."""
+    stem, dot, ext = name.partition('.')
+    return f"{stem}_part{part}{dot}{ext}"
+
+
+def write_csv_parts(records: Iterable[Dict], columns: List[str], compression: Optional[str] = None,
+                    inner_name: str = 'export.csv', progress: Optional[Callable[[int], None]] = None,
+                    max_part_size: int = EXPORT_PART_SIZE) -> Tuple[List[tempfile.SpooledTemporaryFile], int]:
+    """
+    Как write_csv, но начинает новый файл, когда текущий дорастает до max_part_size байт
+    (после сжатия). Каждая часть - полноценный CSV с заголовком.
+    Возвращает файлы частей (перемотанные в начало) и общее количество строк.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Неизвестный тип сжатия: {compression}")
+
+    remaining = iter(records)
+    parts: List[tempfile.SpooledTemporaryFile] = []
+    total = 0
+    try:
+        while True:
+            name = inner_name if not parts else _part_name(inner_name, len(parts) + 1)
+            spool, count = _write_file(remaining, columns, compression, name, progress, total, max_part_size)
+            parts.append(spool)
+            total += count
+            following = next(remaining, None)
+            if following is None:
+                break
+            remaining = itertools.chain([following], remaining)
+    except Exception:
+        for spool in parts:
+            spool.close()
+        raise
+    return parts, total
+
+
+def export_applications(user_id: Optional[str] = None, columns: str = 'full',
+                        compression: Optional[str] = None,
+                        progress: Optional[Callable[[int], None]] = None,
+                        max_part_size: int = EXPORT_PART_SIZE) -> Tuple[List[Tuple[tempfile.SpooledTemporaryFile, str]], int]:
+    """
+    Экспорт заявок пользователя (или всех заявок, если user_id не указан) из локальной БД.
+    Экспорт больше max_part_size делится на части, каждую из которых можно отправить в Telegram.
+    Возвращает ([(файл, имя файла для отправки), ...], количество строк).
+    """
+    csv_name = f"export_{datetime.now().strftime('%Y-%m-%d')}.csv"
+    records = (Application.from_db_row(row).to_sheet_record() for row in utils.iter_applications(user_id))
+    spools, count = write_csv_parts(records, EXPORT_COLUMNS[columns], compression, inner_name=csv_name,
+                                    progress=progress, max_part_size=max_part_size)
+
+    filename = csv_name
+    if compression == COMPRESSION_GZIP:
+        filename += '.gz'
+    elif compression == COMPRESSION_ZIP:
+        filename = csv_name[:-len('.csv')] + '.zip'
+
+    files = []
+    sizes = []
+    for number, spool in enumerate(spools, 1):
+        sizes.append(spool.seek(0, io.SEEK_END))
+        spool.seek(0)
+        files.append((spool, filename if len(spools) == 1 else _part_name(filename, number)))
+    logger.info(f"Экспорт: {count} строк, {sum(sizes)} байт, файл {filename}, частей: {len(files)}")
+    return files, count
+
+
+# === ФОНОВЫЕ ЗАДАЧИ ЭКСПОРТА ===
+
+class ExportJob:
+    """Один выполняющийся экспорт и все сообщения, которые ждут его результата."""
+
+    def __init__(self, key: Tuple, user_id: Optional[str], columns: str, compression: Optional[str]):
+        self.key = key
+        self.user_id = user_id
+        self.columns = columns
+        self.compression = compression
+        self.rows_written = 0
+        self.waiters: List[Message] = []
+
+
+# Экспорты, которые сейчас выполняются (ключ -> задача)
+_active_jobs: Dict[Tuple, ExportJob] = {}
+# Готовые файлы: ключ -> (file_id частей в Telegram, имя файла, момент истечения)
+_file_cache: Dict[Tuple, Tuple[List[str], str, float]] = {}
+
+
+def export_key(user_id: Optional[str], columns: str, compression: Optional[str]) -> Tuple:
+    """Ключ, по которому одинаковые запросы экспорта объединяются и кешируются."""
+    return (user_id or 'all', columns, compression or 'none')
+
+
+def get_cached_file(key: Tuple) -> Optional[List[str]]:
+    """file_id готового файла (всех его частей), если он еще не устарел."""
+    entry = _file_cache.get(key)
+    if entry and entry[2] > time.monotonic():
+        return entry[0]
+    _file_cache.pop(key, None)
+    return None
+
+
+def _cache_file(key: Tuple, file_ids: List[str], filename: str) -> None:
+    now = time.monotonic()
+    for stale in [k for k, entry in _file_cache.items() if entry[2] <= now]:
+        del _file_cache[stale]
+    _file_cache[key] = (file_ids, filename, now + EXPORT_CACHE_TTL)
+
+
+def _part_caption(number: int, total: int) -> Optional[str]:
+    return f"Часть {number} из {total}" if total > 1 else None
+
+
+async def send_cached_file(bot, chat_id: int, file_ids: List[str]) -> None:
+    """Отправляет уже загруженный экспорт (все части) по file_id, без повторной загрузки."""
+    for number, file_id in enumerate(file_ids, 1):
+        await bot.send_document(chat_id=chat_id, document=file_id, caption=_part_caption(number, len(file_ids)))
+
+
+def enqueue_export(context: ContextTypes.DEFAULT_TYPE, progress_message: Message, user_id: Optional[str],
+                   columns: str, compression: Optional[str]) -> bool:
+    """
+    Ставит экспорт в очередь фоновых задач. Если такой же экспорт уже выполняется,
+    сообщение просто присоединяется к нему. Возвращает True, если создана новая задача.
+    """
+    key = export_key(user_id, columns, compression)
+    job = _active_jobs.get(key)
+    if job:
+        # Повторный клик по тому же сообщению не должен приводить к повторной отправке
+        if not any(m.chat_id == progress_message.chat_id and m.message_id == progress_message.message_id
+                   for m in job.waiters):
+            job.waiters.append(progress_message)
+        return False
+
+    job = ExportJob(key, user_id, columns, compression)
+    job.waiters.append(progress_message)
+    _active_jobs[key] = job
+    context.job_queue.run_once(run_export_job, 0, data=job, name=f"export_{'_'.join(key)}")
+    return True
+
+
+async def _edit_waiters(job: ExportJob, text: str, reply_markup=None) -> None:
+    """Обновляет текст у всех ожидающих сообщений (ошибки редактирования не критичны)."""
+    for message in job.waiters:
+        try:
+            await message.edit_text(text, reply_markup=reply_markup)
+        except Exception as e:
+            logger.debug(f"Не удалось обновить сообщение о прогрессе экспорта: {e}")
+
+
+async def run_export_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Фоновая задача: формирует файл, показывает прогресс и рассылает результат всем ожидающим."""
+    job: ExportJob = context.job.data
+
+    def on_progress(count: int) -> None:
+        job.rows_written = count
+
+    try:
+        task = asyncio.create_task(asyncio.to_thread(
+            export_applications, job.user_id, job.columns, job.compression, on_progress
+        ))
+        reported = 0
+        while not task.done():
+            await asyncio.wait({task}, timeout=PROGRESS_EDIT_INTERVAL)
+            if not task.done() and job.rows_written != reported:
+                reported = job.rows_written
+                await _edit_waiters(job, f"📄 Формирую CSV файл... записано строк: {reported}")
+
+        try:
+            files, count = task.result()
+        except Exception as e:
+            logger.error(f"Ошибка при формировании экспорта {job.key}: {e}")
+            await _edit_waiters(job, "❌ Не удалось сформировать файл.",
+                                reply_markup=keyboards.get_back_to_settings_keyboard())
+            return
+
+        try:
+            if not count:
+                await _edit_waiters(job, "Нет данных для экспорта.",
+                                    reply_markup=keyboards.get_back_to_settings_keyboard())
+                return
+
+            # file_id частей, уже загруженных в Telegram (остальным чатам они отправляются без загрузки)
+            file_ids: List[Optional[str]] = [None] * len(files)
+            # Новые ожидающие могут присоединиться, пока идет отправка
+            delivered = 0
+            while delivered < len(job.waiters):
+                message = job.waiters[delivered]
+                delivered += 1
+                try:
+                    for number, (export_file, filename) in enumerate(files, 1):
+                        if file_ids[number - 1]:
+                            document = file_ids[number - 1]
+                        else:
+                            # PTB читает файл целиком при отправке, поэтому память на отправку
+                            # ограничена размером части (EXPORT_PART_SIZE), а не всего экспорта.
+                            # Пока SpooledTemporaryFile не сброшен на диск, его name равен None и
+                            # PTB не может его прочитать - но тогда он и так не больше SPOOL_MAX_SIZE
+                            export_file.seek(0)
+                            source = export_file if export_file.name is not None else export_file.read()
+                            document = InputFile(source, filename=filename)
+                        sent = await context.bot.send_document(chat_id=message.chat_id, document=document,
+                                                               caption=_part_caption(number, len(files)))
+                        file_ids[number - 1] = file_ids[number - 1] or sent.document.file_id
+                    await message.delete()
+                except Exception as e:
+                    logger.error(f"Ошибка при отправке экспорта в чат {message.chat_id}: {e}")
+
+            if all(file_ids):
+                _cache_file(job.key, file_ids, files[0][1])
+            logger.info(f"Экспорт {job.key}: {count} строк ({len(files)} частей) отправлено в {delivered} чат(ов)")
+        finally:
+            for export_file, _ in files:
+                export_file.close()
+
+    finally:
+        _active_jobs.pop(job.key, None)
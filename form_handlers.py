@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
 import logging
 from datetime import datetime, timezone, timedelta
 import re
-import os
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
 from telegram.constants import ParseMode
@@ -11,8 +11,10 @@ from telegram.ext import ContextTypes, ConversationHandler
 
 import g_sheets
 import navigation_handlers
-import admin_handlers
+import search_index
+import submissions
 import utils
+from models import new_public_id
 from constants import (
     OWNER_LAST_NAME, OWNER_FIRST_NAME, REASON, CARD_TYPE, CARD_NUMBER, CATEGORY,
     AMOUNT, FREQUENCY, ISSUE_LOCATION, CONFIRMATION
@@ -166,14 +168,17 @@ async def get_issue_location(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return CONFIRMATION
 
 async def submit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Финализирует и отправляет заявку, используя новую функцию write_row."""
+    """
+    Финализирует заявку: сохраняет ее локально и сразу подтверждает пользователю с номером заявки.
+    Запись в Google Sheets и уведомление руководителя выполняет фоновая очередь submissions,
+    она же обновит это сообщение, когда заявка попадет в таблицу.
+    """
     query = update.callback_query
     await query.answer(text="Отправляю заявку...", show_alert=False)
     
     user_id = str(query.from_user.id)
     
-    # --- ИЗМЕНЕНИЕ ЗДЕСЬ ---
-    # Собираем данные в единый словарь для новой функции write_row
+    # Собираем данные в единый словарь для записи в БД и в таблицу (write_row)
     data_to_write = context.user_data.copy() # Копируем все, что уже есть
     
     # Московское время (+3 часа от UTC)
@@ -182,67 +187,36 @@ async def submit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     data_to_write['submission_time'] = moscow_time
     
     data_to_write['tg_user_id'] = user_id
+    # Постоянный ID заявки: по нему руководитель одобряет/отклоняет заявку, где бы ни оказалась ее строка
+    data_to_write['public_id'] = new_public_id()
     data_to_write['status'] = 'На согласовании'  # Изменено с 'Заявка' на более понятный статус
     
     # Убеждаемся, что username указан корректно
     if not data_to_write.get('initiator_username'):
         data_to_write['initiator_username'] = f"@{query.from_user.username}" if query.from_user.username else '–'
 
-    # Детальное логирование данных перед записью
-    logger.info(f"=== ДАННЫЕ ДЛЯ ЗАПИСИ В GOOGLE SHEETS ===")
-    logger.info(f"Пользователь: {user_id}")
-    for key, value in data_to_write.items():
-        logger.info(f"  {key}: '{value}'")
-    logger.info(f"==========================================")
+    payload = submissions.build_payload(data_to_write)
+    public_id = payload['public_id']
+    logger.info(f"Заявка {public_id} от пользователя {user_id}: {payload}")
 
-    # Инициализируем локальную БД если еще не создана
-    utils.init_local_db()
-    
-    # Сохраняем в локальную БД
-    local_app_id = utils.save_application_to_local_db(data_to_write)
-    
-    # Вызываем новую, "умную" функцию записи в Google Sheets
-    google_success = g_sheets.write_row(data_to_write)
+    # Сохраняем заявку и задание на отправку в таблицу одной транзакцией
+    local_app_id = await asyncio.to_thread(
+        utils.save_submission, payload, query.message.chat_id, query.message.message_id, query.message.text_html
+    )
 
-    if google_success or local_app_id:
-        if google_success:
-            status_text = "\n\n<b>Статус:</b> ✅ Заявка успешно отправлена на согласование.\n\n" \
-                         "📋 <i>Мы уведомим вас, как только заявка будет рассмотрена!</i>"
-        else:
-            status_text = "\n\n<b>Статус:</b> ✅ Заявка сохранена локально и будет отправлена на согласование после синхронизации.\n\n" \
-                         "📋 <i>Мы уведомим вас, как только заявка будет рассмотрена!</i>"
-        
-        # Уведомляем админа о новой заявке только если удалось сохранить в Google Sheets
-        if google_success:
-            boss_id = os.getenv("BOSS_ID")
-            if boss_id:
-                try:
-                    # ИСПРАВЛЕНИЕ: Получаем данные ПОСЛЕ добавления новой записи
-                    all_records = g_sheets.get_sheet_data()
-                    if all_records:
-                        # Новая запись - это последняя запись в массиве
-                        row_index = len(all_records) - 1  # Индекс последней записи (для get_row_data)
-                        logger.info(f"📊 Всего записей после добавления: {len(all_records)}, row_index для админа: {row_index}")
-                        
-                        notification = admin_handlers.format_admin_notification(data_to_write, row_index)
-                        
-                        await context.bot.send_message(
-                            chat_id=boss_id,
-                            text=notification["text"],
-                            reply_markup=notification["reply_markup"],
-                            parse_mode=ParseMode.HTML
-                        )
-                        logger.info(f"Админ уведомлен о новой заявке от пользователя {user_id}")
-                    else:
-                        logger.error("❌ Не удалось получить обновленные данные таблицы")
-                except Exception as e:
-                    logger.error(f"Не удалось уведомить админа о новой заявке: {e}")
-                    # Логируем детали для отладки
-                    logger.error(f"data_to_write содержит: {data_to_write}")
-                    import traceback
-                    logger.error(f"Трейсбек ошибки: {traceback.format_exc()}")
+    if local_app_id:
+        # Новая заявка сразу доступна в поиске по ФИО, не дожидаясь записи в таблицу
+        search_index.name_index.index_application(local_app_id)
+        submissions.pipeline.enqueue(local_app_id)
+        status_text = submissions.status_accepted(public_id)
     else:
-        status_text = "\n\n<b>Статус:</b> ❌ Ошибка! Не удалось сохранить заявку. Попробуйте позже."
+        # Локальная БД недоступна - пишем в таблицу сразу, как раньше
+        write_result = await asyncio.to_thread(g_sheets.write_row, payload)
+        if write_result is not None:
+            status_text = submissions.status_sent(public_id)
+            await submissions.notify_admin(context.bot, write_result)
+        else:
+            status_text = "\n\n<b>Статус:</b> ❌ Ошибка! Не удалось сохранить заявку. Попробуйте позже."
     
     await query.edit_message_text(text=query.message.text_html + status_text, parse_mode=ParseMode.HTML, reply_markup=None)
     
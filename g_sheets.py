@@ -4,9 +4,12 @@ import os
 import json
 import logging
 import datetime
+import re
+from typing import Dict, Optional, Tuple
 import gspread
 from google.oauth2.service_account import Credentials
 from constants import SheetCols # Убедимся, что импортируем константы
+from models import Application
 
 logger = logging.getLogger(__name__)
 
@@ -58,29 +61,57 @@ def get_sheet_by_gid(client, gid=None):
         logger.error(f"Непредвиденная ошибка при открытии листа: {e}", exc_info=True)
         return None
 
+class WriteResult:
+    """Итог write_row: где оказалась строка и что в нее записано."""
+    __slots__ = ('sheet_row', 'public_id', 'values')
+
+    def __init__(self, sheet_row: Optional[int], public_id: str, values: Dict[str, object]):
+        self.sheet_row = sheet_row  # номер строки в таблице (с заголовком, с единицы)
+        self.public_id = public_id
+        self.values = values        # заголовок столбца -> записанное значение
+
+    def __repr__(self) -> str:
+        return f"WriteResult(sheet_row={self.sheet_row}, public_id={self.public_id!r})"
+
+
+_RANGE_ROW_RE = re.compile(r'^[A-Za-z]*(\d+)')
+
+
+def _row_from_range(updated_range: str) -> Optional[int]:
+    """Номер первой строки из диапазона ответа API ("'Лист1'!A57:V57" -> 57)."""
+    match = _RANGE_ROW_RE.match(str(updated_range or '').rsplit('!', 1)[-1])
+    return int(match.group(1)) if match else None
+
+
 # === НОВАЯ УНИВЕРСАЛЬНАЯ ФУНКЦИЯ ЗАПИСИ ===
-def write_row(data: dict) -> bool:
+def write_row(data: dict) -> Optional[WriteResult]:
     """
     Универсальная функция, которая записывает данные в строку,
     ориентируясь на заголовки столбцов.
+    Возвращает WriteResult (номер строки берется из ответа append_row, без повторного чтения таблицы)
+    или None при ошибке.
     """
     logger.info(f"write_row вызвана с данными: {data}")
     
     client = get_gspread_client()
-    if not client: return False
+    if not client: return None
     sheet = get_sheet_by_gid(client)
-    if not sheet: return False
+    if not sheet: return None
     
     try:
         headers = sheet.row_values(1)
         if not headers:
             logger.error("Не удалось прочитать заголовки из таблицы.")
-            return False
+            return None
 
         logger.info(f"Заголовки таблицы: {headers}")
 
+        if data.get('public_id') and _find_column_index(headers, SheetCols.APP_ID) is None:
+            headers = _add_header(sheet, headers, SheetCols.APP_ID)
+
         # Собираем данные в словарь в соответствии с константами
         row_to_write = {
+            SheetCols.APP_ID: data.get('public_id', ''),
             SheetCols.TIMESTAMP: data.get('submission_time', ''),
             SheetCols.TG_ID: data.get('tg_user_id', ''),
             SheetCols.TG_TAG: data.get('initiator_username', ''),
@@ -124,20 +155,24 @@ def write_row(data: dict) -> bool:
         # Проверяем соответствие длин
         if len(final_row) != len(headers):
             logger.error(f"ОШИБКА: Длина строки ({len(final_row)}) не соответствует количеству заголовков ({len(headers)})")
-            return False
+            return None
         
         api_response = sheet.append_row(final_row, value_input_option='USER_ENTERED')
+        updates = api_response.get('updates', {})
         
-        if api_response.get('updates', {}).get('updatedRows', 0) > 0:
-            logger.info(f"Успешно записана строка для пользователя {data.get('tg_user_id')}")
-            return True
+        if updates.get('updatedRows', 0) > 0:
+            sheet_row = _row_from_range(updates.get('updatedRange'))
+            if sheet_row is None:
+                logger.warning(f"Не удалось определить номер строки из ответа API: {updates.get('updatedRange')!r}")
+            logger.info(f"Успешно записана строка {sheet_row} для пользователя {data.get('tg_user_id')}")
+            return WriteResult(sheet_row, data.get('public_id') or '', dict(zip(headers, final_row)))
         else:
             logger.error("API Google не подтвердил запись строки.")
-            return False
+            return None
 
     except Exception as e:
         logger.error(f"Ошибка при записи в таблицу: {e}", exc_info=True)
-        return False
+        return None
 
 
 # Остальные функции get_sheet_data, is_user_registered и т.д. остаются без изменений.
@@ -218,11 +253,13 @@ def get_initiator_data(user_id: str):
 
 def get_cards_from_sheet(user_id: str = None) -> list:
     all_records = get_sheet_data()
-    valid_records = [r for r in all_records if r.get(SheetCols.OWNER_LAST_NAME_COL)]
+    # i + 2: +1 заголовок, +1 нумерация строк с единицы
+    valid_cards = [Application.from_sheet_record(r, sheet_row=i + 2)
+                   for i, r in enumerate(all_records) if r.get(SheetCols.OWNER_LAST_NAME_COL)]
     if user_id:
-        user_cards = [r for r in valid_records if str(r.get(SheetCols.TG_ID)) == user_id]
+        user_cards = [card for card in valid_cards if card.tg_user_id == user_id]
     else:
-        user_cards = valid_records
+        user_cards = valid_cards
     return list(reversed(user_cards))
 
 def debug_sheet_headers():
@@ -254,6 +291,85 @@ def debug_sheet_headers():
         return []
 
 
+def _find_column_index(headers: list, column_name: str) -> Optional[int]:
+    """
+    Номер столбца (с единицы) по названию из SheetCols: сначала точное совпадение,
+    затем без учета лишних пробелов/переносов, затем частичное.
+    """
+    # Сначала пробуем точное совпадение
+    column_index = None
+    if column_name in headers:
+        column_index = headers.index(column_name) + 1
+        logger.info(f"✅ Найдено точное совпадение: '{column_name}' в позиции {column_index}")
+    else:
+        # Пробуем найти похожий заголовок (убираем лишние пробелы и переносы)
+        normalized_column_name = column_name.strip().replace('\n', ' ')
+        for i, header in enumerate(headers):
+            normalized_header = header.strip().replace('\n', ' ')
+            if normalized_header == normalized_column_name:
+                column_index = i + 1
+                logger.info(f"🔄 Найдено точное совпадение по нормализованному имени: '{header}' -> '{column_name}' в позиции {column_index}")
+                break
+        
+        # Если не найдено, пробуем частичное совпадение
+        if column_index is None:
+            for i, header in enumerate(headers):
+                if column_name.replace('\n', '').replace(' ', '') in header.replace('\n', '').replace(' ', ''):
+                    column_index = i + 1
+                    logger.info(f"⚠️ Найдено частичное совпадение: '{header}' -> '{column_name}' в позиции {column_index}")
+                    break
+    return column_index
+
+def _add_header(sheet, headers: list, column_name: str) -> list:
+    """Добавляет столбец с заголовком column_name справа от последнего. Возвращает новые заголовки."""
+    column_index = len(headers) + 1
+    if sheet.col_count < column_index:
+        sheet.add_cols(column_index - sheet.col_count)
+    sheet.update_cell(1, column_index, column_name)
+    logger.info(f"➕ В таблицу добавлен столбец '{column_name}' (позиция {column_index})")
+    return headers + [column_name]
+
+def ensure_column(column_name: str) -> bool:
+    """Проверяет, что в таблице есть столбец column_name, и добавляет его, если нет."""
+    client = get_gspread_client()
+    if not client: return False
+    sheet = get_sheet_by_gid(client)
+    if not sheet: return False
+    try:
+        headers = sheet.row_values(1)
+        if _find_column_index(headers, column_name) is None:
+            _add_header(sheet, headers, column_name)
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при добавлении столбца '{column_name}': {e}", exc_info=True)
+        return False
+
+def find_sheet_row_by_public_id(public_id: str) -> Tuple[bool, Optional[int]]:
+    """
+    Ищет строку таблицы с заявкой public_id.
+    Читает только столбец ID - для заявок, которых еще нет в индексе ID -> строка.
+    Возвращает (успех, номер строки с заголовком, с единицы): (True, None) - заявки в таблице нет,
+    (False, None) - таблицу прочитать не удалось.
+    """
+    client = get_gspread_client()
+    if not client: return False, None
+    sheet = get_sheet_by_gid(client)
+    if not sheet: return False, None
+    try:
+        column_index = _find_column_index(sheet.row_values(1), SheetCols.APP_ID)
+        if column_index is None:
+            logger.error(f"❌ Столбец '{SheetCols.APP_ID}' не найден в заголовках")
+            return False, None
+        ids = sheet.col_values(column_index)
+        for i, value in enumerate(ids[1:], start=2):
+            if str(value).strip() == public_id:
+                return True, i
+        logger.warning(f"Заявка {public_id} не найдена в таблице")
+        return True, None
+    except Exception as e:
+        logger.error(f"Ошибка при поиске строки заявки {public_id}: {e}", exc_info=True)
+        return False, None
+
 def update_cell_by_row(row_index: int, column_name: str, new_value: str) -> bool:
     """
     Обновляет конкретную ячейку в строке по индексу строки и названию столбца.
@@ -292,28 +408,7 @@ def update_cell_by_row(row_index: int, column_name: str, new_value: str) -> bool
         headers = sheet.row_values(1)
         logger.info(f"📋 Заголовки таблицы: {headers}")
         
-        # Сначала пробуем точное совпадение
-        column_index = None
-        if column_name in headers:
-            column_index = headers.index(column_name) + 1
-            logger.info(f"✅ Найдено точное совпадение: '{column_name}' в позиции {column_index}")
-        else:
-            # Пробуем найти похожий заголовок (убираем лишние пробелы и переносы)
-            normalized_column_name = column_name.strip().replace('\n', ' ')
-            for i, header in enumerate(headers):
-                normalized_header = header.strip().replace('\n', ' ')
-                if normalized_header == normalized_column_name:
-                    column_index = i + 1
-                    logger.info(f"🔄 Найдено точное совпадение по нормализованному имени: '{header}' -> '{column_name}' в позиции {column_index}")
-                    break
-            
-            # Если не найдено, пробуем частичное совпадение
-            if column_index is None:
-                for i, header in enumerate(headers):
-                    if column_name.replace('\n', '').replace(' ', '') in header.replace('\n', '').replace(' ', ''):
-                        column_index = i + 1
-                        logger.info(f"⚠️ Найдено частичное совпадение: '{header}' -> '{column_name}' в позиции {column_index}")
-                        break
+        column_index = _find_column_index(headers, column_name)
         
         if column_index is None:
             logger.error(f"❌ Столбец '{column_name}' не найден в заголовках")
@@ -344,28 +439,106 @@ def update_cell_by_row(row_index: int, column_name: str, new_value: str) -> bool
         logger.error(f"📊 Параметры: row_index={row_index}, column_name='{column_name}', new_value='{new_value}'")
         return False
 
-def get_row_data(row_index: int) -> dict:
+def _relocate_rows(sheet, headers: list, updates: dict, public_ids: Dict[int, str]) -> Optional[dict]:
+    """
+    Проверяет, что в строках, куда пишет update_rows_batch, лежат те же заявки, что и в индексе:
+    читается только ячейка ID каждой строки (один запрос). Если таблицу пересортировали или
+    строки вставили/удалили, заявки ищутся по столбцу ID и updates переносится на их текущие строки.
+    Возвращает исправленный updates или None, если заявку не удалось найти.
+    """
+    column_index = _find_column_index(headers, SheetCols.APP_ID)
+    if column_index is None:
+        logger.error(f"❌ Столбец '{SheetCols.APP_ID}' не найден в заголовках - строки не проверить")
+        return None
+
+    rows = [sheet_row for sheet_row in updates if public_ids.get(sheet_row)]
+    if not rows:
+        return updates
+    cells = sheet.batch_get([gspread.utils.rowcol_to_a1(sheet_row, column_index) for sheet_row in rows])
+    moved = {
+        sheet_row: public_ids[sheet_row]
+        for sheet_row, cell in zip(rows, cells)
+        if str(cell[0][0] if cell and cell[0] else '').strip() != public_ids[sheet_row]
+    }
+    if not moved:
+        return updates
+
+    positions = {}
+    for i, value in enumerate(sheet.col_values(column_index)[1:], start=2):
+        positions.setdefault(str(value).strip(), i)
+    relocated = {}
+    for sheet_row, values in updates.items():
+        if sheet_row in moved:
+            target = positions.get(moved[sheet_row])
+            if target is None:
+                logger.error(f"❌ Заявка {moved[sheet_row]} не найдена в таблице (ожидалась в строке {sheet_row})")
+                return None
+            logger.warning(f"⚠️ Заявка {moved[sheet_row]} сместилась: строка {sheet_row} -> {target}")
+            sheet_row = target
+        relocated[sheet_row] = values
+    return relocated
+
+def update_rows_batch(updates: dict, public_ids: Optional[Dict[int, str]] = None) -> bool:
+    """
+    Обновляет ячейки сразу в нескольких строках одним запросом batch_update.
+    updates: {номер строки в таблице (с заголовком, с единицы): {название столбца из SheetCols: значение}}
+    public_ids: {номер строки: ID заявки, которая должна в ней лежать} - номера строк из индекса
+    могли устареть с последней синхронизации, поэтому перед записью они сверяются со столбцом ID.
     """
-    Получает данные строки по индексу.
+    if not updates:
+        return True
+
+    client = get_gspread_client()
+    if not client:
+        logger.error("❌ Не удалось получить клиент Google Sheets")
+        return False
+
+    sheet = get_sheet_by_gid(client)
+    if not sheet:
+        logger.error("❌ Не удалось получить лист Google Sheets")
+        return False
+
+    try:
+        headers = sheet.row_values(1)
+        if public_ids:
+            updates = _relocate_rows(sheet, headers, updates, public_ids)
+            if updates is None:
+                return False
+        column_indexes = {}
+        cells = []
+        for sheet_row, values in updates.items():
+            for column_name, value in values.items():
+                if column_name not in column_indexes:
+                    column_indexes[column_name] = _find_column_index(headers, column_name)
+                column_index = column_indexes[column_name]
+                if column_index is None:
+                    logger.error(f"❌ Столбец '{column_name}' не найден в заголовках")
+                    return False
+                cells.append({'range': gspread.utils.rowcol_to_a1(sheet_row, column_index), 'values': [[value]]})
+
+        sheet.batch_update(cells, raw=False)
+        logger.info(f"✅ Пакетное обновление: {len(cells)} ячеек в {len(updates)} строках")
+        return True
+
+    except Exception as e:
+        logger.error(f"💥 Ошибка при пакетном обновлении строк {sorted(updates)}: {e}", exc_info=True)
+        return False
+
+def get_row_data(row_index: int) -> Optional[Application]:
+    """
+    Получает заявку из строки по индексу.
     row_index: номер строки (начиная с 0 для данных, не считая заголовки)
     """
     try:
         all_records = get_sheet_data()
         if 0 <= row_index < len(all_records):
-            return all_records[row_index]
+            return Application.from_sheet_record(all_records[row_index], sheet_row=row_index + 2)
         else:
             logger.error(f"Индекс строки {row_index} выходит за границы данных")
-            return {}
+            return None
     except Exception as e:
         logger.error(f"Ошибка при получении данных строки {row_index}: {e}", exc_info=True)
-        return {}
-
-def search_applications_with_status(status: str) -> list:
-    """
-    Ищет заявки по статусу. Полезно для мониторинга.
-    """
-    all_records = get_sheet_data()
-    return [record for record in all_records if record.get(SheetCols.STATUS_COL) == status]
+        return None
 
 def get_statistics() -> dict:
     """
@@ -4,10 +4,12 @@
 This file contains functions for generating keyboards for the bot.
 """
 
+from typing import Optional
+
 from telegram import ReplyKeyboardMarkup, InlineKeyboardMarkup, KeyboardButton, InlineKeyboardButton
 from constants import (
     MENU_TEXT_REGISTER, MENU_TEXT_SUBMIT, MENU_TEXT_SEARCH,
-    MENU_TEXT_SETTINGS, MENU_TEXT_MAIN_MENU
+    MENU_TEXT_SETTINGS, MENU_TEXT_MAIN_MENU, CALLBACK_PENDING_PREFIX
 )
 
 def get_main_menu_keyboard(is_registered: bool) -> ReplyKeyboardMarkup:
@@ -26,8 +28,8 @@ def get_main_menu_keyboard(is_registered: bool) -> ReplyKeyboardMarkup:
         return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
 
 # Остальные функции get_settings_keyboard и get_back_to_settings_keyboard остаются без изменений
-def get_settings_keyboard(is_boss: bool) -> InlineKeyboardMarkup:
-    """Returns the settings inline keyboard."""
+def get_settings_keyboard(is_boss: bool, pending_count: Optional[int] = None) -> InlineKeyboardMarkup:
+    """Returns the settings inline keyboard (with the pending count on the queue button, if known)."""
     cards_button_text = "🗂️ Все заявки" if is_boss else "🗂️ Мои Заявки"
     keyboard = [
         [InlineKeyboardButton(cards_button_text, callback_data="settings_my_cards")],
@@ -35,6 +37,21 @@ def get_settings_keyboard(is_boss: bool) -> InlineKeyboardMarkup:
         [InlineKeyboardButton("📄 Экспорт в CSV", callback_data="export_csv")],
         [InlineKeyboardButton("❓ Помощь", callback_data="help_show")],
     ]
+    if is_boss:
+        queue_text = "⏳ Очередь на согласование"
+        if pending_count is not None:
+            queue_text += f" ({pending_count})"
+        keyboard.insert(1, [InlineKeyboardButton(queue_text, callback_data=f"{CALLBACK_PENDING_PREFIX}page:0")])
+    return InlineKeyboardMarkup(keyboard)
+
+def get_export_keyboard() -> InlineKeyboardMarkup:
+    """Returns the export options keyboard (column set and compression)."""
+    keyboard = [
+        [InlineKeyboardButton("📄 CSV (все колонки)", callback_data="export_csv:full:none")],
+        [InlineKeyboardButton("🗜 CSV в ZIP (все колонки)", callback_data="export_csv:full:zip")],
+        [InlineKeyboardButton("📄 CSV (кратко)", callback_data="export_csv:short:none")],
+        [InlineKeyboardButton("⬅️ Назад в настройки", callback_data="back_to_settings")],
+    ]
     return InlineKeyboardMarkup(keyboard)
 
 def get_back_to_settings_keyboard() -> InlineKeyboardMarkup:
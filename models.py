@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+
+"""
+Модель заявки.
+Заявки приходят из трех источников: get_all_records() (ключи - заголовки таблицы SheetCols),
+строки локальной БД applications и данные формы (context.user_data). Все они приводятся
+к одному компактному объекту Application с разобранными полями: время подачи - datetime,
+сумма - число, статус - ApplicationStatus. Соответствие полей и колонок таблицы задано
+в одном месте - SHEET_FIELDS.
+
+Для долгоживущего снимка всех заявок (поисковый индекс) есть колоночное хранилище
+ApplicationTable: повторяющиеся значения хранятся словарем один раз, числа и время -
+в компактных массивах, а объекты Application собираются только для найденных заявок.
+"""
+
+import math
+import secrets
+from array import array
+from datetime import datetime
+from enum import Enum
+from typing import Dict, Iterable, List, Mapping, Optional, Union
+
+import utils
+from constants import SheetCols
+
+
+class ApplicationStatus(str, Enum):
+    """Статусы заявки. Прочие значения из таблицы сохраняются как есть (строкой)."""
+    PENDING = 'На согласовании'
+    APPROVED = 'Одобрено'
+    REJECTED = 'Отклонено'
+
+    def __str__(self) -> str:
+        return self.value
+
+    @classmethod
+    def parse(cls, value) -> Union['ApplicationStatus', str]:
+        text = str(value or '').strip()
+        try:
+            return cls(text)
+        except ValueError:
+            return text
+
+
+# Поле Application -> колонка таблицы
+SHEET_FIELDS: Dict[str, str] = {
+    'public_id': SheetCols.APP_ID,
+    'tg_user_id': SheetCols.TG_ID,
+    'initiator_username': SheetCols.TG_TAG,
+    'initiator_fio': SheetCols.FIO_INITIATOR,
+    'owner_first_name': SheetCols.OWNER_FIRST_NAME_COL,
+    'owner_last_name': SheetCols.OWNER_LAST_NAME_COL,
+    'reason': SheetCols.REASON_COL,
+    'card_type': SheetCols.CARD_TYPE_COL,
+    'card_number': SheetCols.CARD_NUMBER_COL,
+    'category': SheetCols.CATEGORY_COL,
+    'frequency': SheetCols.FREQUENCY_COL,
+    'issue_location': SheetCols.ISSUE_LOCATION_COL,
+}
+
+# Текстовые поля - одинаково называются в Application, в БД и в данных формы
+TEXT_FIELDS = tuple(SHEET_FIELDS)
+
+
+def new_public_id(now: Optional[datetime] = None) -> str:
+    """Новый постоянный ID заявки: дата подачи и случайный хвост ("261019-3F9A2C")."""
+    return f"{(now or datetime.now()):%y%m%d}-{secrets.token_hex(3).upper()}"
+
+
+def parse_amount(value) -> Optional[Union[int, float]]:
+    """Сумма бартера или процент скидки числом ("5 000", "10%", "2,5" -> 5000, 10, 2.5)."""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        number = value
+    else:
+        text = str(value).strip().lower().replace('\xa0', '').replace(' ', '').replace(',', '.')
+        text = text.rstrip('%₽.руб')
+        try:
+            number = float(text)
+        except ValueError:
+            return None
+    if isinstance(number, float) and number.is_integer():
+        return int(number)
+    return number
+
+
+class Application:
+    """Одна заявка. __slots__ вместо словаря: в памяти держатся десятки тысяч таких объектов."""
+    __slots__ = (
+        'app_id', 'sheet_row', 'archived', 'created_at', 'amount', 'status',
+    ) + TEXT_FIELDS
+
+    def __init__(self, app_id: Optional[int] = None, sheet_row: Optional[int] = None, archived: bool = False,
+                 created_at: Optional[datetime] = None, amount: Optional[Union[int, float]] = None,
+                 status: Union[ApplicationStatus, str] = ApplicationStatus.PENDING, **fields):
+        self.app_id = app_id
+        self.sheet_row = sheet_row
+        self.archived = archived
+        self.created_at = created_at
+        self.amount = amount
+        self.status = status
+        for name in TEXT_FIELDS:
+            value = fields.pop(name, None)
+            setattr(self, name, '' if value is None else str(value).strip())
+        if fields:
+            raise TypeError(f"Неизвестные поля заявки: {', '.join(fields)}")
+
+    # --- Создание из разных источников ---
+
+    @classmethod
+    def from_sheet_record(cls, record: Mapping, sheet_row: Optional[int] = None) -> 'Application':
+        """Из записи get_all_records() (ключи - заголовки таблицы)."""
+        return cls(
+            sheet_row=sheet_row,
+            created_at=utils.parse_sheet_timestamp(record.get(SheetCols.TIMESTAMP)),
+            amount=parse_amount(record.get(SheetCols.AMOUNT_COL)),
+            status=ApplicationStatus.parse(record.get(SheetCols.STATUS_COL)),
+            **{name: record.get(column) for name, column in SHEET_FIELDS.items()}
+        )
+
+    @classmethod
+    def from_db_row(cls, row: Mapping, archived: bool = False) -> 'Application':
+        """Из строки таблицы applications (или архива)."""
+        return cls(
+            app_id=row['id'],
+            sheet_row=row['sheet_row'],
+            archived=archived,
+            # created_ts уже посчитан при записи - это быстрее, чем разбирать created_at
+            created_at=utils.from_epoch(row['created_ts']) or utils.parse_sheet_timestamp(row['created_at']),
+            amount=parse_amount(row['amount']),
+            status=ApplicationStatus.parse(row['status']),
+            **{name: row[name] for name in TEXT_FIELDS}
+        )
+
+    @classmethod
+    def from_form_data(cls, data: Mapping) -> 'Application':
+        """Из данных формы подачи заявки (context.user_data)."""
+        return cls(
+            created_at=utils.parse_sheet_timestamp(data.get('submission_time')),
+            amount=parse_amount(data.get('amount')),
+            status=ApplicationStatus.parse(data.get('status') or ApplicationStatus.PENDING),
+            **{name: data.get(name) for name in TEXT_FIELDS}
+        )
+
+    # --- Представление ---
+
+    def to_sheet_record(self) -> Dict[str, object]:
+        """Запись с ключами SheetCols - для CSV-экспорта."""
+        record = {column: getattr(self, name) for name, column in SHEET_FIELDS.items()}
+        record[SheetCols.TIMESTAMP] = self.created_at_text
+        record[SheetCols.AMOUNT_COL] = '' if self.amount is None else self.amount
+        record[SheetCols.STATUS_COL] = str(self.status)
+        return record
+
+    @property
+    def owner_name(self) -> str:
+        return f"{self.owner_first_name} {self.owner_last_name}".strip()
+
+    @property
+    def is_discount(self) -> bool:
+        return self.card_type == 'Скидка'
+
+    @property
+    def amount_text(self) -> str:
+        """Сумма с единицей измерения: "10%" для скидки, "5000 ₽" для бартера."""
+        if self.amount is None:
+            return '-'
+        return f"{self.amount}{'%' if self.is_discount else ' ₽'}"
+
+    @property
+    def created_at_text(self) -> str:
+        return self.created_at.strftime(utils.TIMESTAMP_FORMAT) if self.created_at else ''
+
+    @property
+    def created_ts(self) -> int:
+        return utils.to_epoch(self.created_at)
+
+    @property
+    def is_final(self) -> bool:
+        return self.status in (ApplicationStatus.APPROVED, ApplicationStatus.REJECTED)
+
+    def _values(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Application):
+            return NotImplemented
+        return self._values() == other._values()
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"Application(id={self.app_id}, public_id={self.public_id!r}, row={self.sheet_row}, owner={self.owner_name!r}, status={str(self.status)!r})"
+
+
+# === КОЛОНОЧНОЕ ХРАНЕНИЕ ===
+
+# Колонки со словарным кодированием: значений немного, и они повторяются из строки в строку
+ENCODED_FIELDS = (
+    'status', 'card_type', 'category', 'frequency', 'issue_location',
+    'tg_user_id', 'initiator_username', 'initiator_fio', 'owner_first_name',
+)
+# Колонки, значения которых почти всегда уникальны
+PLAIN_FIELDS = tuple(name for name in TEXT_FIELDS if name not in ENCODED_FIELDS)
+
+NO_SHEET_ROW = -1
+
+
+class _Dictionary:
+    """Словарь колонки: каждое различное значение хранится один раз, в строках - его код."""
+    __slots__ = ('values', 'codes')
+
+    def __init__(self):
+        self.values: List = []
+        self.codes: Dict = {}
+
+    def encode(self, value) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+
+class ApplicationTable:
+    """
+    Заявки, разложенные по колонкам. Строки адресуются id заявки; место удаленной
+    строки переиспользуется следующей вставкой. Не потокобезопасно - блокировки на стороне вызывающего.
+    """
+
+    def __init__(self):
+        self._slots: Dict[int, int] = {}  # id заявки -> номер строки
+        self._free: List[int] = []
+        self._live = bytearray()
+        self._sheet_row = array('q')
+        self._created_ts = array('q')
+        self._amount = array('d')
+        self._archived = bytearray()
+        self._dictionaries = {name: _Dictionary() for name in ENCODED_FIELDS}
+        self._codes = {name: array('I') for name in ENCODED_FIELDS}
+        self._plain: Dict[str, List[str]] = {name: [] for name in PLAIN_FIELDS}
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, app_id) -> bool:
+        return app_id in self._slots
+
+    def ids(self) -> List[int]:
+        return list(self._slots)
+
+    def _new_slot(self) -> int:
+        if self._free:
+            return self._free.pop()
+        self._live.append(0)
+        self._sheet_row.append(NO_SHEET_ROW)
+        self._created_ts.append(0)
+        self._amount.append(math.nan)
+        self._archived.append(0)
+        for codes in self._codes.values():
+            codes.append(0)
+        for column in self._plain.values():
+            column.append('')
+        return len(self._live) - 1
+
+    def put(self, app: Application) -> None:
+        """Добавляет заявку или перезаписывает ее строку."""
+        slot = self._slots.get(app.app_id)
+        if slot is None:
+            slot = self._new_slot()
+            self._slots[app.app_id] = slot
+        self._live[slot] = 1
+        self._sheet_row[slot] = NO_SHEET_ROW if app.sheet_row is None else app.sheet_row
+        self._created_ts[slot] = app.created_ts
+        self._amount[slot] = math.nan if app.amount is None else app.amount
+        self._archived[slot] = bool(app.archived)
+        for name, dictionary in self._dictionaries.items():
+            self._codes[name][slot] = dictionary.encode(getattr(app, name))
+        for name, column in self._plain.items():
+            column[slot] = getattr(app, name)
+
+    def remove(self, app_id: int) -> None:
+        slot = self._slots.pop(app_id, None)
+        if slot is None:
+            return
+        self._live[slot] = 0
+        for column in self._plain.values():
+            column[slot] = ''
+        self._free.append(slot)
+
+    def matches(self, app: Application) -> bool:
+        """Совпадает ли сохраненная строка с заявкой (без сборки объекта Application)."""
+        slot = self._slots.get(app.app_id)
+        if slot is None:
+            return False
+        stored_amount = self._amount[slot]
+        if app.amount is None:
+            if not math.isnan(stored_amount):
+                return False
+        elif stored_amount != app.amount:
+            return False
+        return (
+            self._sheet_row[slot] == (NO_SHEET_ROW if app.sheet_row is None else app.sheet_row)
+            and self._created_ts[slot] == app.created_ts
+            and self._archived[slot] == bool(app.archived)
+            and all(self._codes[name][slot] == dictionary.codes.get(getattr(app, name))
+                    for name, dictionary in self._dictionaries.items())
+            and all(column[slot] == getattr(app, name) for name, column in self._plain.items())
+        )
+
+    def get(self, app_id: int) -> Optional[Application]:
+        """Собирает объект Application из колонок."""
+        slot = self._slots.get(app_id)
+        if slot is None:
+            return None
+        amount = self._amount[slot]
+        if math.isnan(amount):
+            amount = None
+        elif amount.is_integer():
+            amount = int(amount)
+        sheet_row = self._sheet_row[slot]
+        return Application(
+            app_id=app_id,
+            sheet_row=None if sheet_row == NO_SHEET_ROW else sheet_row,
+            archived=bool(self._archived[slot]),
+            created_at=utils.from_epoch(self._created_ts[slot]),
+            amount=amount,
+            **{name: dictionary.values[self._codes[name][slot]] for name, dictionary in self._dictionaries.items()},
+            **{name: column[slot] for name, column in self._plain.items()}
+        )
+
+    def field(self, app_id: int, name: str):
+        """Значение одного текстового поля заявки (без сборки всего объекта)."""
+        slot = self._slots.get(app_id)
+        if slot is None:
+            return None
+        if name in self._plain:
+            return self._plain[name][slot]
+        return self._dictionaries[name].values[self._codes[name][slot]]
+
+    def set_status(self, app_id: int, status: Union[ApplicationStatus, str]) -> None:
+        slot = self._slots.get(app_id)
+        if slot is not None:
+            self._codes['status'][slot] = self._dictionaries['status'].encode(ApplicationStatus.parse(status))
+
+    def sheet_row(self, app_id: int) -> Optional[int]:
+        slot = self._slots.get(app_id)
+        if slot is None or self._sheet_row[slot] == NO_SHEET_ROW:
+            return None
+        return self._sheet_row[slot]
+
+    def sort_key(self, app_id: int) -> tuple:
+        """Ключ сортировки "новые сверху": (время подачи, id)."""
+        return (self._created_ts[self._slots[app_id]], app_id)
+
+    def select(self, ids: Iterable[int], user_id: Optional[str] = None, include_archive: bool = False) -> List[int]:
+        """Оставляет из ids заявки пользователя (если указан) и, при необходимости, без архива."""
+        user_code = None
+        if user_id:
+            user_code = self._dictionaries['tg_user_id'].codes.get(user_id)
+            if user_code is None:
+                return []
+        users = self._codes['tg_user_id']
+        selected = []
+        for app_id in ids:
+            slot = self._slots.get(app_id)
+            if slot is None:
+                continue
+            if not include_archive and self._archived[slot]:
+                continue
+            if user_code is not None and users[slot] != user_code:
+                continue
+            selected.append(app_id)
+        return selected
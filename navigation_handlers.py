@@ -6,10 +6,17 @@ from telegram.ext import ContextTypes, ConversationHandler
 
 import g_sheets
 import keyboards
+import utils
 
 logger = logging.getLogger(__name__)
 
 
+async def track_user_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отмечает активность пользователя при любом обновлении (запись в БД идет пачками)."""
+    if update.effective_user:
+        utils.record_user_activity(str(update.effective_user.id))
+
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Точка входа. Проверяет регистрацию и показывает правильное главное меню.
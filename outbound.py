@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+"""
+Центральный планировщик исходящих сообщений.
+Все уведомления и рассылки проходят через одну очередь с приоритетами,
+которая соблюдает лимиты Telegram (~30 сообщений/с на бота и ~1 сообщение/с в один чат)
+и сама повторяет отправку после RetryAfter.
+"""
+
+import asyncio
+import itertools
+import logging
+import time
+from collections import defaultdict
+from datetime import timedelta
+from typing import Optional
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+logger = logging.getLogger(__name__)
+
+# --- Классы приоритета (меньше - важнее) ---
+PRIORITY_ADMIN = 0         # сообщения руководителю и уведомления о его решениях
+PRIORITY_NOTIFICATION = 1  # уведомления пользователям, отчеты
+PRIORITY_BROADCAST = 2     # массовые рассылки (напоминания)
+
+PRIORITY_NAMES = {
+    PRIORITY_ADMIN: 'admin',
+    PRIORITY_NOTIFICATION: 'notification',
+    PRIORITY_BROADCAST: 'broadcast',
+}
+
+GLOBAL_RATE = 25           # сообщений в секунду на весь бот (с запасом от лимита в 30)
+PER_CHAT_INTERVAL = 1.0    # секунд между сообщениями в один чат
+MAX_ATTEMPTS = 3           # попыток на одно сообщение (RetryAfter и сетевые ошибки)
+
+
+class SchedulerStopped(RuntimeError):
+    """Планировщик остановлен раньше, чем сообщение было отправлено."""
+
+
+class _Job:
+    """Одно исходящее сообщение в очереди."""
+    __slots__ = ('chat_id', 'send', 'future', 'priority', 'enqueued_at', 'attempts')
+
+    def __init__(self, chat_id, send, future, priority):
+        self.chat_id = chat_id
+        self.send = send
+        self.future = future
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+class OutboundScheduler:
+    """Очередь исходящих сообщений с приоритетами, темпом по чатам и обработкой RetryAfter."""
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, per_chat_interval: float = PER_CHAT_INTERVAL):
+        self._global_interval = 1.0 / global_rate
+        self._per_chat_interval = per_chat_interval
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._seq = itertools.count()
+        self._chat_ready_at = {}
+        self._paused_until = 0.0
+        self._next_slot = 0.0
+        self._worker: Optional[asyncio.Task] = None
+        self._in_flight = set()
+        self._deferred = {}  # порядковый номер задачи -> (таймер call_later, задача)
+        self.metrics = defaultdict(int)
+        self._latency_total = defaultdict(float)
+
+    @property
+    def running(self) -> bool:
+        return self._worker is not None and not self._worker.done()
+
+    async def start(self) -> None:
+        """Запускает фоновый обработчик очереди (вызывается из post_init приложения)."""
+        if self.running:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._worker = asyncio.create_task(self._run())
+        logger.info("Планировщик исходящих сообщений запущен")
+
+    async def stop(self) -> None:
+        """
+        Останавливает обработчик и дожидается сообщений, которые уже отправляются.
+        Неотправленные сообщения (в очереди и отложенные) завершаются ошибкой SchedulerStopped,
+        чтобы ожидающие их обработчики не зависли.
+        """
+        if self._worker:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+        dropped = 0
+        error = SchedulerStopped("планировщик исходящих сообщений остановлен")
+        for handle, entry in self._deferred.values():
+            handle.cancel()
+            self._fail(entry[2], error)
+            dropped += 1
+        self._deferred.clear()
+        while self._queue is not None and not self._queue.empty():
+            self._fail(self._queue.get_nowait()[2], error)
+            dropped += 1
+        if dropped:
+            logger.warning(f"Планировщик остановлен, не отправлено сообщений: {dropped}")
+        logger.info(f"Планировщик исходящих сообщений остановлен. {self.metrics_summary()}")
+
+    def submit(self, chat_id, send, priority: int = PRIORITY_NOTIFICATION) -> asyncio.Future:
+        """
+        Ставит отправку в очередь. send - функция без аргументов, возвращающая корутину
+        (вызывается заново при каждой попытке). Возвращает future с результатом отправки.
+        """
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(chat_id, send, future, priority)
+        self.metrics[f'queued_{PRIORITY_NAMES[priority]}'] += 1
+        self._queue.put_nowait((priority, next(self._seq), job))
+        return future
+
+    def _defer(self, entry, delay: float) -> None:
+        """Возвращает задачу в очередь через delay секунд, сохраняя ее место (приоритет и порядок)."""
+        handle = asyncio.get_running_loop().call_later(delay, self._requeue, entry)
+        self._deferred[entry[1]] = (handle, entry)
+
+    def _requeue(self, entry) -> None:
+        self._deferred.pop(entry[1], None)
+        self._queue.put_nowait(entry)
+
+    async def _run(self) -> None:
+        while True:
+            entry = await self._queue.get()
+            try:
+                await self._dispatch(entry)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Сбой на одном сообщении не должен останавливать всю очередь
+                logger.error(f"Ошибка планировщика при обработке сообщения в чат {entry[2].chat_id}: {e}", exc_info=True)
+                self._fail(entry[2], e)
+
+    async def _dispatch(self, entry) -> None:
+        job = entry[2]
+        now = time.monotonic()
+
+        ready_at = max(self._chat_ready_at.get(job.chat_id, 0.0), self._paused_until)
+        if ready_at > now:
+            # Чат еще "остывает" - откладываем только его, остальные чаты идут дальше
+            self._defer(entry, ready_at - now)
+            return
+
+        wait = self._next_slot - now
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                # Остановка во время ожидания слота: сообщение остается в очереди и будет завершено в stop()
+                self._queue.put_nowait(entry)
+                raise
+        self._next_slot = max(now, self._next_slot) + self._global_interval
+        self._chat_ready_at[job.chat_id] = time.monotonic() + self._per_chat_interval
+
+        task = asyncio.create_task(self._deliver(entry))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+        if len(self._chat_ready_at) > 10_000:
+            self._prune_chats()
+
+    def _prune_chats(self) -> None:
+        """Забывает чаты, для которых пауза уже истекла."""
+        now = time.monotonic()
+        self._chat_ready_at = {chat: ready for chat, ready in self._chat_ready_at.items() if ready > now}
+
+    async def _deliver(self, entry) -> None:
+        job = entry[2]
+        name = PRIORITY_NAMES[job.priority]
+        job.attempts += 1
+        try:
+            result = await job.send()
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+            self.metrics['retry_after'] += 1
+            # Флуд-контроль Telegram действует на весь бот - притормаживаем всю очередь
+            self._paused_until = time.monotonic() + retry_after
+            logger.warning(f"Telegram RetryAfter {retry_after}с (чат {job.chat_id}, попытка {job.attempts})")
+            self._retry_or_fail(entry, e, retry_after)
+            return
+        except BadRequest as e:
+            # BadRequest наследует NetworkError, но повтор тут не поможет
+            self._fail(job, e)
+            return
+        except (TimedOut, NetworkError) as e:
+            self.metrics['network_errors'] += 1
+            self._retry_or_fail(entry, e, 2 ** job.attempts)
+            return
+        except Exception as e:
+            self._fail(job, e)
+            return
+
+        self.metrics[f'sent_{name}'] += 1
+        self._latency_total[name] += time.monotonic() - job.enqueued_at
+        if not job.future.done():
+            job.future.set_result(result)
+
+    def _retry_or_fail(self, entry, error: Exception, delay: float) -> None:
+        job = entry[2]
+        if job.attempts < MAX_ATTEMPTS:
+            self._defer(entry, delay)
+            return
+        self._fail(job, error)
+
+    def _fail(self, job: _Job, error: Exception) -> None:
+        self.metrics[f'failed_{PRIORITY_NAMES[job.priority]}'] += 1
+        if not job.future.done():
+            job.future.set_exception(error)
+
+    def metrics_summary(self) -> str:
+        """Краткая сводка доставки для логов."""
+        parts = []
+        for name in PRIORITY_NAMES.values():
+            sent = self.metrics[f'sent_{name}']
+            avg = self._latency_total[name] / sent if sent else 0.0
+            parts.append(f"{name}: отправлено {sent}, ошибок {self.metrics[f'failed_{name}']}, "
+                         f"средняя задержка {avg:.2f}с")
+        queued = self._queue.qsize() if self._queue else 0
+        return (f"Исходящие сообщения - {'; '.join(parts)}; "
+                f"RetryAfter: {self.metrics['retry_after']}, в очереди: {queued}")
+
+
+scheduler = OutboundScheduler()
+
+
+async def start(application) -> None:
+    """post_init-хук приложения: запускает планировщик."""
+    await scheduler.start()
+
+
+async def stop(application) -> None:
+    """post_shutdown-хук приложения: останавливает планировщик."""
+    await scheduler.stop()
+
+
+async def log_metrics(context) -> None:
+    """Периодическая задача: пишет сводку доставки в лог."""
+    logger.info(scheduler.metrics_summary())
+
+
+async def send_message(bot, chat_id, text: str, priority: int = PRIORITY_NOTIFICATION, **kwargs):
+    """
+    Отправляет сообщение через общую очередь и возвращает отправленное сообщение.
+    Если планировщик не запущен (например, в отладочных скриптах), отправляет напрямую.
+    """
+    if not scheduler.running:
+        return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+    return await scheduler.submit(
+        chat_id,
+        lambda: bot.send_message(chat_id=chat_id, text=text, **kwargs),
+        priority=priority
+    )
+
+
+async def edit_message_text(bot, chat_id, message_id: int, text: str, priority: int = PRIORITY_NOTIFICATION, **kwargs):
+    """Редактирует ранее отправленное сообщение через ту же очередь (правки тоже входят в лимиты Telegram)."""
+    if not scheduler.running:
+        return await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, **kwargs)
+    return await scheduler.submit(
+        chat_id,
+        lambda: bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, **kwargs),
+        priority=priority
+    )
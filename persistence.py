@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+"""
+Хранение состояния бота (user_data, chat_data, bot_data и шагов диалогов) в локальной SQLite.
+Каждый пользователь, чат и диалог - отдельная строка таблицы persistence, поэтому при сохранении
+перезаписываются только изменившиеся записи, а не весь файл, как у PicklePersistence.
+user_data и chat_data подгружаются лениво - при первом обращении к конкретному пользователю/чату,
+так что запуск бота не зависит от количества пользователей.
+"""
+
+import asyncio
+import json
+import logging
+import pickle
+import sqlite3
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+# Как часто (в секундах) PTB передает изменившиеся данные в persistence
+UPDATE_INTERVAL = 30
+# Задержка перед записью пачки изменений в БД (изменения за это время объединяются)
+FLUSH_DELAY = 1.0
+# Сколько последних записанных строк помнить для отсечения неизменившихся данных.
+# Для вытесненной строки следующее сохранение просто запишет ее заново
+STORED_CACHE_SIZE = 1000
+
+KIND_USER = 'user'
+KIND_CHAT = 'chat'
+KIND_BOT = 'bot'
+CONVERSATION_PREFIX = 'conv:'
+
+
+class SQLitePersistence(BasePersistence):
+    """BasePersistence на таблице persistence(kind, key, data) с отложенной пакетной записью."""
+
+    def __init__(self, update_interval: float = UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        # Ожидающие записи: (kind, key) -> сериализованные данные (None - удалить строку)
+        self._dirty: Dict[Tuple[str, str], Optional[bytes]] = {}
+        # Последнее записанное состояние недавних строк (LRU) - чтобы не писать неизменившиеся данные
+        self._stored: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+        self._loaded_users = set()
+        self._loaded_chats = set()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    # --- Работа с БД (вызывается в отдельном потоке или до запуска бота) ---
+
+    def _load_row(self, kind: str, key: str) -> Optional[bytes]:
+        try:
+            conn = sqlite3.connect(utils.get_db_path())
+            cursor = conn.cursor()
+            cursor.execute('SELECT data FROM persistence WHERE kind = ? AND key = ?', (kind, key))
+            row = cursor.fetchone()
+            conn.close()
+            return row[0] if row else None
+
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке состояния {kind}:{key}: {e}")
+            return None
+
+    def _load_kind(self, kind: str) -> Dict[str, bytes]:
+        try:
+            conn = sqlite3.connect(utils.get_db_path())
+            cursor = conn.cursor()
+            cursor.execute('SELECT key, data FROM persistence WHERE kind = ?', (kind,))
+            rows = dict(cursor.fetchall())
+            conn.close()
+            return rows
+
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке состояний {kind}: {e}")
+            return {}
+
+    def _write_batch(self, batch: Dict[Tuple[str, str], Optional[bytes]]) -> bool:
+        try:
+            conn = sqlite3.connect(utils.get_db_path())
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT INTO persistence (kind, key, data, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(kind, key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+            ''', [(kind, key, data) for (kind, key), data in batch.items() if data is not None])
+            cursor.executemany(
+                'DELETE FROM persistence WHERE kind = ? AND key = ?',
+                [entry for entry, data in batch.items() if data is None]
+            )
+            conn.commit()
+            conn.close()
+            return True
+
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении состояния бота ({len(batch)} записей): {e}")
+            return False
+
+    # --- Отложенная запись ---
+
+    def _mark_dirty(self, kind: str, key, data) -> None:
+        """Ставит запись в очередь на сохранение, если она отличается от сохраненной."""
+        entry = (kind, str(key))
+        if data is None:
+            self._dirty[entry] = None
+        else:
+            try:
+                payload = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                logger.error(f"Не удалось сериализовать состояние {kind}:{key}: {e}")
+                return
+            if self._stored.get(entry) == payload:
+                self._stored.move_to_end(entry)
+                self._dirty.pop(entry, None)
+                return
+            self._dirty[entry] = payload
+
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(FLUSH_DELAY)
+        await self._flush_dirty()
+
+    async def _flush_dirty(self) -> None:
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        if await asyncio.to_thread(self._write_batch, batch):
+            for entry, data in batch.items():
+                if data is None:
+                    self._stored.pop(entry, None)
+                else:
+                    self._remember(entry, data)
+        else:
+            # Не удалось записать - вернем в очередь, более свежие изменения важнее
+            for entry, data in batch.items():
+                self._dirty.setdefault(entry, data)
+
+    def _remember(self, entry: Tuple[str, str], payload: bytes) -> None:
+        self._stored[entry] = payload
+        self._stored.move_to_end(entry)
+        if len(self._stored) > STORED_CACHE_SIZE:
+            self._stored.popitem(last=False)
+
+    def _restore(self, kind: str, key, payload: Optional[bytes]):
+        if payload is None:
+            return None
+        try:
+            data = pickle.loads(payload)
+        except Exception as e:
+            logger.error(f"Не удалось прочитать сохраненное состояние {kind}:{key}: {e}")
+            return None
+        self._remember((kind, str(key)), payload)
+        return data
+
+    # --- Загрузка (PTB вызывает при старте) ---
+
+    async def get_user_data(self) -> Dict[int, Dict]:
+        # Данные пользователей подгружаются лениво в refresh_user_data
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Dict]:
+        return {}
+
+    async def get_bot_data(self) -> Dict:
+        payload = await asyncio.to_thread(self._load_row, KIND_BOT, '')
+        return self._restore(KIND_BOT, '', payload) or {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[tuple, object]:
+        kind = f'{CONVERSATION_PREFIX}{name}'
+        rows = await asyncio.to_thread(self._load_kind, kind)
+        conversations = {}
+        for key, payload in rows.items():
+            state = self._restore(kind, key, payload)
+            if state is not None:
+                conversations[tuple(json.loads(key))] = state
+        logger.info(f"Восстановлено диалогов '{name}': {len(conversations)}")
+        return conversations
+
+    # --- Ленивая подгрузка перед обработкой апдейта ---
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+        if user_id in self._loaded_users:
+            return
+        self._loaded_users.add(user_id)
+        payload = await asyncio.to_thread(self._load_row, KIND_USER, str(user_id))
+        for key, value in (self._restore(KIND_USER, user_id, payload) or {}).items():
+            user_data.setdefault(key, value)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict) -> None:
+        if chat_id in self._loaded_chats:
+            return
+        self._loaded_chats.add(chat_id)
+        payload = await asyncio.to_thread(self._load_row, KIND_CHAT, str(chat_id))
+        for key, value in (self._restore(KIND_CHAT, chat_id, payload) or {}).items():
+            chat_data.setdefault(key, value)
+
+    async def refresh_bot_data(self, bot_data: Dict) -> None:
+        pass
+
+    # --- Сохранение изменений ---
+
+    async def update_user_data(self, user_id: int, data: Dict) -> None:
+        self._mark_dirty(KIND_USER, user_id, data or None)
+
+    async def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        self._mark_dirty(KIND_CHAT, chat_id, data or None)
+
+    async def update_bot_data(self, data: Dict) -> None:
+        self._mark_dirty(KIND_BOT, '', data or None)
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        self._mark_dirty(f'{CONVERSATION_PREFIX}{name}', json.dumps(list(key)), new_state)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._mark_dirty(KIND_USER, user_id, None)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._mark_dirty(KIND_CHAT, chat_id, None)
+
+    async def flush(self) -> None:
+        """Вызывается при остановке бота: дописывает все отложенные изменения."""
+        if self._flush_task and not self._flush_task.done():
+            await self._flush_task
+        await self._flush_dirty()
+        logger.info("Состояние бота сохранено в локальную БД")
@@ -1,16 +1,41 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import logging
 import os
-from datetime import datetime, timedelta
+from datetime import datetime
 from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
+from telegram.error import Forbidden
 
-import g_sheets
+import outbound
+import search_index
 import utils
-from constants import SheetCols
 
 logger = logging.getLogger(__name__)
 
+async def sync_local_mirror(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодически обновляет локальное зеркало таблицы, из которого строятся отчеты и поисковый индекс."""
+    await asyncio.to_thread(utils.sync_with_google_sheets)
+    await asyncio.to_thread(search_index.name_index.refresh)
+
+async def archive_old_applications(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Переносит старые завершенные заявки в архив, чтобы рабочая таблица оставалась небольшой."""
+    months = int(os.getenv("ARCHIVE_AFTER_MONTHS", 6))
+    moved = await asyncio.to_thread(utils.archive_old_applications, months)
+    if moved:
+        await asyncio.to_thread(search_index.name_index.refresh)
+
+async def flush_user_activity(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Сбрасывает буфер активности пользователей в БД."""
+    await asyncio.to_thread(utils.flush_activity_buffer)
+
+def _format_sync_note(snapshot: dict) -> str:
+    """Подпись о свежести данных в отчете."""
+    synced_at = snapshot.get('synced_at')
+    if not synced_at:
+        return "\n\n<i>Данные из локальной БД (синхронизация с таблицей еще не выполнялась)</i>"
+    return f"\n\n<i>Данные синхронизированы с таблицей в {synced_at:%H:%M}</i>"
+
 async def send_daily_summary(context: ContextTypes.DEFAULT_TYPE) -> None:
     """Формирует и отправляет ежедневный отчет админу."""
     boss_id = os.getenv("BOSS_ID")
@@ -19,77 +44,82 @@ async def send_daily_summary(context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     logger.info("Generating daily summary...")
-    all_cards = g_sheets.get_cards_from_sheet(user_id=None)
+    snapshot = utils.get_report_snapshot()
     
-    if not all_cards:
-        await context.bot.send_message(chat_id=boss_id, text="📄 Ежедневный отчет: За последние 24 часа не было активности.")
+    if not snapshot.get('total'):
+        await outbound.send_message(context.bot, chat_id=boss_id, text="📄 Ежедневный отчет: За последние 24 часа не было активности.")
         return
 
-    yesterday = datetime.now() - timedelta(days=1)
-    recent_cards = []
-    
-    for card in all_cards:
-        try:
-            timestamp_str = card.get(SheetCols.TIMESTAMP)
-            card_time = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-            if card_time > yesterday:
-                recent_cards.append(card)
-        except (TypeError, ValueError):
-            continue 
-            
-    pending_count = sum(1 for card in all_cards if card.get(SheetCols.STATUS_COL) == 'На согласовании')
-    new_in_24h = len(recent_cards)
-    approved_in_24h = sum(1 for card in recent_cards if card.get(SheetCols.STATUS_COL) == 'Одобрено')
-    rejected_in_24h = sum(1 for card in recent_cards if card.get(SheetCols.STATUS_COL) == 'Отклонено')
+    day = snapshot['last_24h']
+    pending = snapshot['pending']
 
     report_text = (
         f"<b>📄 Ежедневная сводка | {datetime.now():%d-%m-%Y}</b>\n\n"
         f"<b>За последние 24 часа:</b>\n"
-        f"  - Новых заявок: <b>{new_in_24h}</b>\n"
-        f"  - Одобрено: <b>{approved_in_24h}</b>\n"
-        f"  - Отклонено: <b>{rejected_in_24h}</b>\n\n"
+        f"  - Новых заявок: <b>{day['new']}</b>\n"
+        f"  - Одобрено: <b>{day['approved']}</b>\n"
+        f"  - Отклонено: <b>{day['rejected']}</b>\n\n"
         f"<b>Общий статус:</b>\n"
-        f"  - 🔥 Ожидают решения: <b>{pending_count}</b>"
+        f"  - 🔥 Ожидают решения: <b>{pending}</b>"
     )
+    report_text += _format_sync_note(snapshot)
+
+    await outbound.send_message(context.bot, chat_id=boss_id, text=report_text, parse_mode=ParseMode.HTML)
 
-    await context.bot.send_message(chat_id=boss_id, text=report_text, parse_mode=ParseMode.HTML)
+# Размер порции пользователей и число одновременных отправок при рассылке напоминаний
+REMINDER_BATCH_SIZE = 200
+REMINDER_CONCURRENCY = 20
+
+REMINDER_TEXT = (
+    "👋 Привет, {fio}!\n\n"
+    "Давно не виделись! 🤔\n\n"
+    "Напоминаем, что вы можете:\n"
+    "• 📝 Подать новую заявку на карту\n"
+    "• 🔍 Найти свои предыдущие заявки\n"
+    "• 📊 Посмотреть статистику\n\n"
+    "Есть вопросы? Я всегда готов помочь! 🤖"
+)
+
+async def _send_reminder(bot, user: dict, semaphore: asyncio.Semaphore) -> tuple:
+    """Отправляет одно напоминание. Возвращает (tg_id, status, error) для reminder_log."""
+    tg_id = user['tg_id']
+    text = REMINDER_TEXT.format(fio=user.get('fio') or 'пользователь')
+    async with semaphore:
+        try:
+            # Темп отправки и повторы после RetryAfter обеспечивает общая очередь
+            await outbound.send_message(bot, chat_id=tg_id, text=text, priority=outbound.PRIORITY_BROADCAST)
+            return tg_id, 'sent', None
+        except Forbidden as e:
+            # Пользователь заблокировал бота - повторять бессмысленно
+            return tg_id, 'blocked', str(e)
+        except Exception as e:
+            logger.error(f"Failed to send reminder to user {tg_id}: {e}")
+            return tg_id, 'failed', str(e)
 
 async def send_user_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Отправляет напоминания неактивным пользователям."""
+    """Отправляет напоминания неактивным пользователям порциями с ограниченным параллелизмом."""
     logger.info("Checking for users to send reminders...")
-    
-    users_for_reminder = utils.get_users_for_reminder()
-    
-    if not users_for_reminder:
+
+    wave = datetime.now().strftime('%Y-%m-%d')
+    semaphore = asyncio.Semaphore(REMINDER_CONCURRENCY)
+    totals = {'sent': 0, 'blocked': 0, 'failed': 0}
+
+    while True:
+        batch = await asyncio.to_thread(utils.claim_reminder_batch, wave, REMINDER_BATCH_SIZE)
+        if not batch:
+            break
+
+        results = await asyncio.gather(*(_send_reminder(context.bot, user, semaphore) for user in batch))
+        await asyncio.to_thread(utils.record_reminder_results, wave, results)
+
+        for _, status, _ in results:
+            totals[status] += 1
+
+    if not any(totals.values()):
         logger.info("No users need reminders at this time.")
         return
-    
-    for user in users_for_reminder:
-        try:
-            reminder_text = (
-                f"👋 Привет, {user.get('fio', 'пользователь')}!\n\n"
-                "Давно не виделись! 🤔\n\n"
-                "Напоминаем, что вы можете:\n"
-                "• 📝 Подать новую заявку на карту\n"
-                "• 🔍 Найти свои предыдущие заявки\n"
-                "• 📊 Посмотреть статистику\n\n"
-                "Есть вопросы? Я всегда готов помочь! 🤖"
-            )
-            
-            await context.bot.send_message(
-                chat_id=user['tg_id'],
-                text=reminder_text
-            )
-            
-            # Обновляем время последней активности, чтобы не спамить
-            utils.update_user_activity(user['tg_id'])
-            
-            logger.info(f"Sent reminder to user {user['tg_id']}")
-            
-        except Exception as e:
-            logger.error(f"Failed to send reminder to user {user['tg_id']}: {e}")
-    
-    logger.info(f"Sent {len(users_for_reminder)} reminder(s)")
+
+    logger.info(f"Reminder wave {wave}: sent {totals['sent']}, blocked {totals['blocked']}, failed {totals['failed']}")
 
 async def send_weekly_analytics(context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отправляет еженедельную аналитику админу."""
@@ -100,33 +130,21 @@ async def send_weekly_analytics(context: ContextTypes.DEFAULT_TYPE) -> None:
 
     logger.info("Generating weekly analytics...")
     
-    # Получаем статистику из локальной БД (быстрее)
-    stats = utils.get_statistics()
+    # Все цифры берем из одного снимка локальной БД, чтобы части отчета не расходились
+    stats = utils.get_report_snapshot()
     
-    if not stats:
-        await context.bot.send_message(
+    if not stats.get('total'):
+        await outbound.send_message(
+            context.bot,
             chat_id=boss_id,
             text="📊 Еженедельная аналитика: Недостаточно данных для анализа."
         )
         return
     
-    # Получаем данные за неделю
-    week_ago = datetime.now() - timedelta(days=7)
-    all_cards = g_sheets.get_cards_from_sheet(user_id=None)
-    weekly_cards = []
-    
-    for card in all_cards:
-        try:
-            timestamp_str = card.get(SheetCols.TIMESTAMP)
-            card_time = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-            if card_time > week_ago:
-                weekly_cards.append(card)
-        except (TypeError, ValueError):
-            continue
-    
-    weekly_new = len(weekly_cards)
-    weekly_approved = sum(1 for card in weekly_cards if card.get(SheetCols.STATUS_COL) == 'Одобрено')
-    weekly_rejected = sum(1 for card in weekly_cards if card.get(SheetCols.STATUS_COL) == 'Отклонено')
+    week = stats['last_7d']
+    weekly_new = week['new']
+    weekly_approved = week['approved']
+    weekly_rejected = week['rejected']
     
     approval_rate = (weekly_approved / weekly_new * 100) if weekly_new > 0 else 0
     
@@ -140,6 +158,9 @@ async def send_weekly_analytics(context: ContextTypes.DEFAULT_TYPE) -> None:
         f"<b>Общая статистика:</b>\n"
         f"  - Всего заявок: <b>{stats.get('total', 0)}</b>\n"
     )
+    archived = stats.get('archived', 0)
+    if archived:
+        analytics_text += f"  - В архиве: <b>{archived}</b>\n"
     
     # Добавляем статистику по статусам
     by_status = stats.get('by_status', {})
@@ -155,4 +176,6 @@ async def send_weekly_analytics(context: ContextTypes.DEFAULT_TYPE) -> None:
         for card_type, count in by_card_type.items():
             analytics_text += f"  - {card_type}: <b>{count}</b>\n"
 
-    await context.bot.send_message(chat_id=boss_id, text=analytics_text, parse_mode=ParseMode.HTML)
+    analytics_text += _format_sync_note(stats)
+
+    await outbound.send_message(context.bot, chat_id=boss_id, text=analytics_text, parse_mode=ParseMode.HTML)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""
+Временное хранилище тяжелых списков пользователей (результаты поиска и т.п.).
+В отличие от context.user_data, записи здесь живут ограниченное время (SCRATCH_TTL),
+ограничены по размеру и вытесняются по LRU среди всех пользователей, поэтому память
+долго работающего процесса не растет. Данные не попадают в persistence.
+"""
+
+import logging
+import sys
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+SCRATCH_TTL = 30 * 60               # секунд с последнего обращения
+MAX_ITEMS_PER_ENTRY = 500           # элементов в одном списке
+MAX_ENTRIES = 1000                  # списков на весь процесс
+MAX_TOTAL_BYTES = 50 * 1024 * 1024  # примерный объем всех списков
+
+
+class _Entry:
+    """Один сохраненный список."""
+    __slots__ = ('items', 'total', 'version', 'size', 'touched_at')
+
+    def __init__(self, items: list, total: int, size: int):
+        self.items = items
+        self.total = total  # сколько элементов было до обрезки до MAX_ITEMS_PER_ENTRY
+        self.version = uuid4().hex
+        self.size = size
+        self.touched_at = time.monotonic()
+
+
+_entries: "OrderedDict[Tuple[int, str], _Entry]" = OrderedDict()
+_total_bytes = 0
+_evicted = 0
+
+
+def _approx_size(obj) -> int:
+    """Примерный размер списка словарей/строк/объектов со __slots__ в байтах (без учета общих объектов)."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(sys.getsizeof(k) + _approx_size(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_approx_size(item) for item in obj)
+    elif hasattr(type(obj), '__slots__'):
+        size += sum(_approx_size(getattr(obj, name, None)) for name in type(obj).__slots__)
+    return size
+
+
+def _remove(key: Tuple[int, str]) -> None:
+    global _total_bytes
+    entry = _entries.pop(key, None)
+    if entry:
+        _total_bytes -= entry.size
+
+
+def _evict() -> None:
+    """Удаляет самые давно использованные списки, пока не уложимся в лимиты."""
+    global _evicted
+    while _entries and (len(_entries) > MAX_ENTRIES or _total_bytes > MAX_TOTAL_BYTES):
+        key = next(iter(_entries))
+        _remove(key)
+        _evicted += 1
+
+
+def put(user_id: int, key: str, items: list, total: Optional[int] = None) -> str:
+    """
+    Сохраняет список пользователя (обрезая его до MAX_ITEMS_PER_ENTRY). Возвращает версию списка.
+    total - полный размер списка, если вызывающий уже обрезал его сам; get() возвращает его,
+    чтобы пользователю можно было показать, что список неполный.
+    """
+    global _total_bytes
+    total = max(total or 0, len(items))
+    items = list(items[:MAX_ITEMS_PER_ENTRY])
+    _remove((user_id, key))
+    entry = _Entry(items, total, _approx_size(items))
+    _entries[(user_id, key)] = entry
+    _total_bytes += entry.size
+    _evict()
+    return entry.version
+
+
+def get(user_id: int, key: str) -> Optional[Tuple[List, str, int]]:
+    """
+    Возвращает (список, версия, полный размер списка) или None, если списка нет или он устарел.
+    Полный размер больше длины списка, если при сохранении список был обрезан.
+    """
+    entry = _entries.get((user_id, key))
+    if not entry:
+        return None
+    now = time.monotonic()
+    if now - entry.touched_at > SCRATCH_TTL:
+        _remove((user_id, key))
+        return None
+    entry.touched_at = now
+    _entries.move_to_end((user_id, key))
+    return entry.items, entry.version, entry.total
+
+
+def drop(user_id: int, key: Optional[str] = None) -> None:
+    """Удаляет один список пользователя или все его списки."""
+    for entry_key in [k for k in _entries if k[0] == user_id and (key is None or k[1] == key)]:
+        _remove(entry_key)
+
+
+def purge_expired() -> int:
+    """Удаляет все устаревшие списки. Возвращает количество удаленных."""
+    now = time.monotonic()
+    expired = [key for key, entry in _entries.items() if now - entry.touched_at > SCRATCH_TTL]
+    for key in expired:
+        _remove(key)
+    return len(expired)
+
+
+def usage() -> Dict:
+    """Текущая загрузка хранилища."""
+    return {
+        'entries': len(_entries),
+        'users': len({key[0] for key in _entries}),
+        'items': sum(len(entry.items) for entry in _entries.values()),
+        'bytes': _total_bytes,
+        'evicted': _evicted,
+    }
+
+
+async def purge_and_log_usage(context) -> None:
+    """Периодическая задача: чистит устаревшие списки и пишет загрузку хранилища в лог."""
+    expired = purge_expired()
+    stats = usage()
+    logger.info(
+        f"Временные списки: {stats['entries']} (пользователей: {stats['users']}, элементов: {stats['items']}, "
+        f"~{stats['bytes'] / 1024 / 1024:.1f} МБ); удалено устаревших: {expired}, вытеснено всего: {stats['evicted']}"
+    )
@@ -1,13 +1,22 @@
 # -*- coding: utf-8 -*-
 
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+)
+from telegram.constants import ParseMode
 from telegram.ext import ContextTypes, ConversationHandler
 
 import g_sheets
+import scratch
+import search_index
 import utils
+from models import Application
 # Импортируем утилиту для пагинации из модуля настроек
-from settings_handlers import display_paginated_list
+from settings_handlers import display_paginated_list, set_paginated_list, format_card_details, truncation_note, FUZZY_LIST_TITLE
 from constants import SEARCH_CHOOSE_FIELD, AWAIT_SEARCH_QUERY
 
 logger = logging.getLogger(__name__)
@@ -17,7 +26,9 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     """Начинает диалог поиска."""
     keyboard = [
         [InlineKeyboardButton("По ФИО владельца", callback_data="search_by_name")],
-        [InlineKeyboardButton("По номеру карты", callback_data="search_by_phone")]
+        [InlineKeyboardButton("По номеру карты", callback_data="search_by_phone")],
+        [InlineKeyboardButton("🗄 По ФИО (включая архив)", callback_data="search_by_name_archive")],
+        [InlineKeyboardButton("🗄 По номеру (включая архив)", callback_data="search_by_phone_archive")]
     ]
     await update.message.reply_text("Выберите критерий поиска:", reply_markup=InlineKeyboardMarkup(keyboard))
     return SEARCH_CHOOSE_FIELD
@@ -32,6 +43,94 @@ async def search_field_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE
     return AWAIT_SEARCH_QUERY
 
 
+# Кеш результатов поиска: (поколение данных, поле, архив, запрос, область) -> (результаты, всего, ключ списка).
+# Поколение меняется при каждом изменении заявок, поэтому устаревшие результаты не выдаются,
+# а старые записи просто вытесняются как самые давние.
+_RESULT_CACHE: "OrderedDict[tuple, tuple]" = OrderedDict()
+RESULT_CACHE_SIZE = 500
+_cache_stats = {'hits': 0, 'misses': 0}
+
+# Инлайн-режим: сколько результатов в одном ответе (лимит Telegram - 50)
+# и сколько секунд Telegram может отдавать ответ на тот же запрос из своего кеша
+INLINE_RESULTS_PER_PAGE = 20
+INLINE_CACHE_TIME = 30
+
+
+def _find_applications(search_query: str, search_type: str, scope: Optional[str], include_archive: bool) -> Tuple[List[Application], str]:
+    """Ищет заявки по индексу, в локальной БД или в таблице. Возвращает (результаты, ключ списка)."""
+    if search_type == 'name' and search_index.name_index.ready:
+        # Поиск по ФИО - по индексу в памяти (регистр и "ё" не важны, слова ищутся по началу)
+        results = search_index.name_index.search(search_query, user_id=scope, include_archive=include_archive)
+        data_key = 'search_results'
+        if not results:
+            # Точных совпадений нет - пробуем найти фамилии с опечатками
+            results = search_index.name_index.fuzzy_search(search_query, user_id=scope, include_archive=include_archive)
+            if results:
+                data_key = 'fuzzy_results'
+        logger.info(f"Найдено {len(results)} результатов в поисковом индексе ({data_key})")
+        return results, data_key
+
+    # Сначала пытаемся искать в локальной БД (быстрее)
+    local_results = utils.search_applications_local(
+        query=search_query,
+        search_type=search_type,
+        user_id=scope,
+        include_archive=include_archive
+    )
+
+    if local_results:
+        results = [Application.from_db_row(row) for row in local_results]
+        logger.info(f"Найдено {len(results)} результатов в локальной БД")
+        return results, 'search_results'
+
+    # Если в локальной БД ничего не найдено, ищем в Google Sheets
+    all_cards = g_sheets.get_cards_from_sheet(user_id=scope)
+
+    if search_type == 'name':
+        results = [c for c in all_cards
+                   if search_query in c.owner_first_name.lower()
+                   or search_query in c.owner_last_name.lower()]
+    else:  # search_by_phone
+        results = [c for c in all_cards if search_query in c.card_number]
+
+    logger.info(f"Найдено {len(results)} результатов в Google Sheets")
+    return results, 'search_results'
+
+
+def find_applications_cached(search_query: str, search_type: str, scope: Optional[str],
+                             include_archive: bool) -> Tuple[List[Application], int, str]:
+    """
+    _find_applications с кешем результатов. Возвращает (результаты, сколько найдено всего, ключ списка);
+    в кеше хранится не больше scratch.MAX_ITEMS_PER_ENTRY результатов - больше списки не показывают,
+    а о том, что найдено больше, пользователю сообщает settings_handlers.truncation_note.
+    """
+    key = (utils.get_data_generation(), search_type, include_archive, ' '.join(search_query.split()), scope or 'all')
+    cached = _RESULT_CACHE.get(key)
+    if cached is not None:
+        _RESULT_CACHE.move_to_end(key)
+        _cache_stats['hits'] += 1
+        return cached
+
+    _cache_stats['misses'] += 1
+    results, data_key = _find_applications(search_query, search_type, scope, include_archive)
+    entry = (results[:scratch.MAX_ITEMS_PER_ENTRY], len(results), data_key)
+    # Пустой результат не кешируем: он может означать и сбой чтения таблицы.
+    # Поколение могло смениться во время поиска - такой результат под старым ключом не сохраняем
+    if results and key[0] == utils.get_data_generation():
+        _RESULT_CACHE[key] = entry
+        while len(_RESULT_CACHE) > RESULT_CACHE_SIZE:
+            _RESULT_CACHE.popitem(last=False)
+    return entry
+
+
+async def log_cache_stats(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодическая задача: пишет в лог долю попаданий в кеш результатов поиска."""
+    hits, misses = _cache_stats['hits'], _cache_stats['misses']
+    total = hits + misses
+    ratio = hits / total * 100 if total else 0
+    logger.info(f"Кеш поиска: {len(_RESULT_CACHE)} записей, попаданий {hits} из {total} ({ratio:.1f}%)")
+
+
 async def perform_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Выполняет поиск и отображает результаты."""
     user_id = str(update.effective_user.id)
@@ -44,56 +143,25 @@ async def perform_search(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     loading_msg = await update.message.reply_text("🔍 Выполняю поиск...")
 
-    search_field = context.user_data.get('search_field')
-    search_type = 'name' if search_field == 'search_by_name' else 'phone'
-    
-    # Сначала пытаемся искать в локальной БД (быстрее)
-    local_results = utils.search_applications_local(
-        query=search_query,
-        search_type=search_type,
-        user_id=None if is_boss else user_id
-    )
+    search_field = context.user_data.get('search_field', 'search_by_name')
+    search_type = 'name' if search_field.startswith('search_by_name') else 'phone'
+    # Архив просматриваем, только если пользователь явно выбрал поиск по истории
+    include_archive = search_field.endswith('_archive')
     
-    if local_results:
-        # Преобразуем результаты из локальной БД в формат Google Sheets
-        results = []
-        for local_result in local_results:
-            formatted_result = {
-                'Имя владельца карты': local_result.get('owner_first_name', ''),
-                'Фамилия Владельца': local_result.get('owner_last_name', ''),
-                'Номер карты': local_result.get('card_number', ''),
-                'Какую карту регистрируем?': local_result.get('card_type', ''),
-                'Сумма бартера или % скидки': local_result.get('amount', ''),
-                'Статья пополнения карт': local_result.get('category', ''),
-                'Статус Согласования': local_result.get('status', ''),
-                'Отметка времени': local_result.get('created_at', ''),
-                'ТГ Заполняющего': local_result.get('tg_user_id', ''),
-                'ФИО Инициатора': 'Данные из локальной БД',  # Можно доработать
-                'Тег Telegram': '–'
-            }
-            results.append(formatted_result)
-        
-        logger.info(f"Найдено {len(results)} результатов в локальной БД")
-    else:
-        # Если в локальной БД ничего не найдено, ищем в Google Sheets
-        all_cards = g_sheets.get_cards_from_sheet(user_id=None if is_boss else user_id)
-
-        if search_field == 'search_by_name':
-            results = [c for c in all_cards if search_query in c.get('Имя владельца карты', '').lower() or search_query in c.get('Фамилия Владельца', '').lower()]
-        else:  # search_by_phone
-            results = [c for c in all_cards if search_query in str(c.get('Номер карты', ''))]
-        
-        logger.info(f"Найдено {len(results)} результатов в Google Sheets")
+    scope = None if is_boss else user_id
+    results, total, data_key = find_applications_cached(search_query, search_type, scope, include_archive)
+    list_title = FUZZY_LIST_TITLE if data_key == 'fuzzy_results' else "Результаты поиска"
 
-    context.user_data['search_results'] = results
+    set_paginated_list(update, context, data_key, results, total)
     await loading_msg.delete()
 
     # Используем утилиту для отображения с пагинацией
     # Поскольку мы не в callback_query, нам нужно отправить новое сообщение
     if results:
-        search_summary = f"🔍 <b>Найдено результатов:</b> {len(results)}\n"
+        search_summary = f"🔍 <b>{'Похожих результатов' if data_key == 'fuzzy_results' else 'Найдено результатов'}:</b> {total}\n"
         search_summary += f"<b>Критерий поиска:</b> {'ФИО владельца' if search_type == 'name' else 'Номер карты'}\n"
         search_summary += f"<b>Запрос:</b> {search_query}\n\n"
+        search_summary += truncation_note(len(results), total)
     else:
         search_summary = f"🤷 По запросу '<b>{search_query}</b>' ничего не найдено.\n\n"
 
@@ -104,7 +172,46 @@ async def perform_search(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         context=context,
         message_to_edit=paginated_message,
         page=0,
-        data_key='search_results',
-        list_title="Результаты поиска"
+        data_key=data_key,
+        list_title=list_title
     )
     return ConversationHandler.END
+
+
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Инлайн-поиск (@бот запрос): цифры ищутся по началу номера карты, остальное - по ФИО.
+    Отвечает только из индекса в памяти, чтобы успевать за вводом; руководитель видит все заявки,
+    остальные - только свои.
+    """
+    inline_query = update.inline_query
+    user_id = str(inline_query.from_user.id)
+    is_boss = (user_id == g_sheets.os.getenv("BOSS_ID"))
+    search_query = utils.sanitize_input(inline_query.query.lower().strip(), 100)
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+
+    results = []
+    if len(search_query) >= 2 and search_index.name_index.ready:
+        scope = None if is_boss else user_id
+        limit = offset + INLINE_RESULTS_PER_PAGE + 1  # +1 - чтобы понять, есть ли следующая страница
+        if not any(char.isalpha() for char in search_query):
+            results = search_index.name_index.search_card(search_query, user_id=scope, limit=limit)
+        else:
+            results = search_index.name_index.search(search_query, user_id=scope, limit=limit)
+            if not results and not offset:
+                results = search_index.name_index.fuzzy_search(
+                    search_query, user_id=scope, limit=INLINE_RESULTS_PER_PAGE
+                )
+
+    page = results[offset:offset + INLINE_RESULTS_PER_PAGE]
+    articles = [
+        InlineQueryResultArticle(
+            id=str(app.app_id),
+            title=app.owner_name or "Без имени",
+            description=f"📞 {app.card_number or '-'} · {app.status or '–'} · {app.amount_text}",
+            input_message_content=InputTextMessageContent(format_card_details(app, is_boss), parse_mode=ParseMode.HTML),
+        )
+        for app in page
+    ]
+    next_offset = str(offset + INLINE_RESULTS_PER_PAGE) if len(results) > offset + INLINE_RESULTS_PER_PAGE else ''
+    await inline_query.answer(articles, cache_time=INLINE_CACHE_TIME, is_personal=True, next_offset=next_offset)
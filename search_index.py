@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+
+"""
+Поисковый индекс по ФИО владельцев карт в памяти процесса.
+Строится из локального зеркала таблицы (рабочая таблица + архив) после каждой синхронизации
+и дополняется точечно при подаче заявки и смене статуса. Состоит из:
+- обратного индекса: слово -> id заявок;
+- префиксного дерева слов, в каждом узле которого хранятся id заявок со словами на этот префикс;
+- триграммного индекса словаря для нечеткого поиска (опечатки в фамилиях): кандидаты отбираются
+  по общим триграммам и только затем сравниваются по расстоянию Левенштейна;
+- отсортированного списка номеров карт (только цифры) для поиска по началу номера;
+- индекса статусов рабочей таблицы: статус -> id заявок (очередь на согласование, счетчики);
+- хеш-индекса постоянных ID заявок: ID -> id заявки (а через нее - текущая строка таблицы);
+  по нему же применяются решения руководителя (номер строки нужен только заявкам без ID).
+Сами заявки лежат в колоночном хранилище models.ApplicationTable; объекты Application
+собираются из него только для найденных заявок.
+"""
+
+import bisect
+import heapq
+import logging
+import re
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple
+
+import utils
+from models import Application, ApplicationStatus, ApplicationTable
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r'[0-9a-zа-я]+')
+
+
+# Сколько результатов возвращает нечеткий поиск
+FUZZY_LIMIT = 50
+
+
+def tokenize(text) -> List[str]:
+    """Разбивает строку на слова в нижнем регистре (ё приравнивается к е)."""
+    return _TOKEN_RE.findall(str(text or '').lower().replace('ё', 'е'))
+
+
+def card_digits(text) -> str:
+    """Только цифры номера карты ("+7 (999) 123" -> "7999123")."""
+    return ''.join(char for char in str(text or '') if char.isdigit())
+
+
+def card_prefixes(query) -> Set[str]:
+    """Варианты начала номера для поиска: 8 и 7 в начале российского номера взаимозаменяемы."""
+    digits = card_digits(query)
+    if not digits:
+        return set()
+    prefixes = {digits}
+    if digits[0] in '78':
+        prefixes.add(('7' if digits[0] == '8' else '8') + digits[1:])
+    return prefixes
+
+
+def trigrams(word: str) -> Set[str]:
+    """Триграммы слова с границами (#иванов# -> #ив, ива, ван, ...)."""
+    padded = f'#{word}#'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def max_typos(word: str) -> int:
+    """Сколько опечаток допускается в слове такой длины."""
+    if len(word) <= 6:
+        return 1
+    if len(word) <= 10:
+        return 2
+    return 3
+
+
+def bounded_levenshtein(a: str, b: str, limit: int) -> Optional[int]:
+    """Расстояние Левенштейна или None, если оно больше limit (расчет прерывается досрочно)."""
+    if abs(len(a) - len(b)) > limit:
+        return None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= limit else None
+
+
+class _TrieNode:
+    """Узел префиксного дерева. rows - id заявок (с кратностью) со словами, проходящими через узел."""
+    __slots__ = ('children', 'rows')
+
+    def __init__(self):
+        self.children: Dict[str, '_TrieNode'] = {}
+        self.rows: Dict[int, int] = {}
+
+
+class NameIndex:
+    """Обратный индекс и префиксное дерево по имени и фамилии владельца карты."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._table = ApplicationTable()
+        self._app_tokens: Dict[int, Tuple[str, ...]] = {}
+        self._by_sheet_row: Dict[int, int] = {}
+        self._by_public_id: Dict[str, int] = {}
+        # Только рабочая таблица: в архив уходят лишь завершенные заявки
+        self._by_status: Dict[str, Set[int]] = {}
+        self._tokens: Dict[str, Set[int]] = {}
+        self._trigrams: Dict[str, Set[str]] = {}
+        self._trie = _TrieNode()
+        # (цифры номера карты, id заявки) по возрастанию; строится при первом поиске после изменений
+        self._cards: Optional[List[Tuple[str, int]]] = None
+        self.ready = False
+
+    # --- Изменение индекса (вызывать под self._lock) ---
+
+    def _trie_add(self, token: str, app_id: int) -> None:
+        node = self._trie
+        for char in token:
+            node = node.children.setdefault(char, _TrieNode())
+            node.rows[app_id] = node.rows.get(app_id, 0) + 1
+
+    def _trie_remove(self, token: str, app_id: int) -> None:
+        node = self._trie
+        path = []
+        for char in token:
+            child = node.children.get(char)
+            if child is None:
+                return
+            path.append((node, char, child))
+            node = child
+        for parent, char, child in path:
+            count = child.rows.get(app_id, 0) - 1
+            if count > 0:
+                child.rows[app_id] = count
+            else:
+                child.rows.pop(app_id, None)
+        # Убираем опустевшие ветки снизу вверх
+        for parent, char, child in reversed(path):
+            if child.rows or child.children:
+                break
+            del parent.children[char]
+
+    def _trigrams_add(self, token: str) -> None:
+        for gram in trigrams(token):
+            self._trigrams.setdefault(gram, set()).add(token)
+
+    def _trigrams_remove(self, token: str) -> None:
+        for gram in trigrams(token):
+            words = self._trigrams.get(gram)
+            if words is not None:
+                words.discard(token)
+                if not words:
+                    del self._trigrams[gram]
+
+    def _status_add(self, app_id: int, status: str) -> None:
+        self._by_status.setdefault(status, set()).add(app_id)
+
+    def _status_remove(self, app_id: int) -> None:
+        status = self._table.field(app_id, 'status')
+        ids = self._by_status.get(status)
+        if ids is not None:
+            ids.discard(app_id)
+            if not ids:
+                del self._by_status[status]
+
+    def _remove(self, app_id: int) -> None:
+        if app_id not in self._table:
+            return
+        sheet_row = self._table.sheet_row(app_id)
+        if sheet_row is not None and self._by_sheet_row.get(sheet_row) == app_id:
+            del self._by_sheet_row[sheet_row]
+        public_id = self._table.field(app_id, 'public_id')
+        if public_id and self._by_public_id.get(public_id) == app_id:
+            del self._by_public_id[public_id]
+        self._status_remove(app_id)
+        self._table.remove(app_id)
+        self._cards = None
+        for token in self._app_tokens.pop(app_id):
+            ids = self._tokens.get(token)
+            if ids is not None:
+                ids.discard(app_id)
+                if not ids:
+                    del self._tokens[token]
+                    self._trigrams_remove(token)
+            self._trie_remove(token, app_id)
+
+    def _is_current(self, app: Application) -> bool:
+        return self._table.matches(app)
+
+    def _upsert(self, app: Application) -> None:
+        if self._is_current(app):
+            return
+        self._remove(app.app_id)
+
+        app_id = app.app_id
+        tokens = tuple(sorted(set(tokenize(app.owner_first_name) + tokenize(app.owner_last_name))))
+        self._table.put(app)
+        self._app_tokens[app_id] = tokens
+        self._cards = None
+        if app.sheet_row is not None and not app.archived:
+            # Архивная заявка хранит строку, которую в таблице уже занимает другая заявка
+            self._by_sheet_row[app.sheet_row] = app_id
+        if app.public_id:
+            # Локальная копия не перекрывает строку таблицы с тем же ID
+            current = self._by_public_id.get(app.public_id)
+            if current is None or app.sheet_row is not None or self._table.sheet_row(current) is None:
+                self._by_public_id[app.public_id] = app_id
+        if not app.archived:
+            self._status_add(app_id, app.status)
+        for token in tokens:
+            if token not in self._tokens:
+                self._tokens[token] = set()
+                self._trigrams_add(token)
+            self._tokens[token].add(app_id)
+            self._trie_add(token, app_id)
+
+    # --- Публичный интерфейс ---
+
+    def refresh(self) -> bool:
+        """Приводит индекс в соответствие с локальной БД (меняются только изменившиеся заявки)."""
+        snapshot = utils.load_application_snapshot()
+        if snapshot is None:
+            return False
+
+        # Сравнение со снимком - без блокировки, чтобы поиск не ждал; под блокировкой только правки
+        seen = set()
+        changed = []
+        for row, archived in snapshot:
+            app = Application.from_db_row(row, archived)
+            seen.add(app.app_id)
+            if not self._is_current(app):
+                changed.append(app)
+
+        with self._lock:
+            for app in changed:
+                self._upsert(app)
+            removed = [app_id for app_id in self._table.ids() if app_id not in seen]
+            for app_id in removed:
+                self._remove(app_id)
+            self.ready = True
+            total = len(self._table)
+
+        if changed or removed:
+            utils.bump_data_generation()
+
+        logger.info(f"Поисковый индекс обновлен: {total} заявок, {len(self._tokens)} слов")
+        return True
+
+    def index_application(self, app_id: int) -> None:
+        """Добавляет (или обновляет) одну заявку из рабочей таблицы, например сразу после подачи и записи в таблицу."""
+        row = utils.get_application(app_id)
+        with self._lock:
+            if row:
+                self._upsert(Application.from_db_row(row))
+            else:
+                # Локальную копию успела заменить синхронизация
+                self._remove(app_id)
+        utils.bump_data_generation()
+
+    def set_status(self, public_id: Optional[str], status: str, sheet_row: Optional[int] = None) -> None:
+        """
+        Обновляет статус заявки в индексе после решения руководителя.
+        Заявка ищется по постоянному ID; по номеру строки - только если ID у нее еще нет.
+        """
+        with self._lock:
+            if public_id:
+                app_id = self._by_public_id.get(public_id)
+            else:
+                app_id = self._by_sheet_row.get(sheet_row)
+            if app_id is not None:
+                archived = not self._table.select([app_id])
+                if not archived:
+                    self._status_remove(app_id)
+                self._table.set_status(app_id, status)
+                if not archived:
+                    self._status_add(app_id, ApplicationStatus.parse(status))
+        utils.bump_data_generation()
+
+    def get_by_public_id(self, public_id: str) -> Optional[Application]:
+        """Заявка по постоянному ID (с текущей строкой таблицы по данным последней синхронизации)."""
+        with self._lock:
+            app_id = self._by_public_id.get(public_id)
+            return self._table.get(app_id) if app_id is not None else None
+
+    def count_status(self, status: str) -> int:
+        """Количество заявок рабочей таблицы с таким статусом (без обхода заявок)."""
+        with self._lock:
+            return len(self._by_status.get(status, ()))
+
+    def with_status(self, status: str, limit: Optional[int] = None) -> List[Application]:
+        """Заявки рабочей таблицы с таким статусом, старые сверху (порядок очереди на согласование)."""
+        with self._lock:
+            ids = sorted(self._by_status.get(status, ()), key=self._table.sort_key)
+            return [self._table.get(app_id) for app_id in ids[:limit]]
+
+    def _prefix_rows(self, prefix: str) -> Set[int]:
+        """id заявок, у которых есть слово, начинающееся с prefix."""
+        node = self._trie
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return set()
+        return set(node.rows)
+
+    def _select_newest(self, ids: Set[int], user_id: Optional[str], include_archive: bool,
+                       limit: Optional[int]) -> List[Application]:
+        """Отбирает заявки пользователя/без архива, сортирует (новые сверху) и собирает не больше limit объектов."""
+        selected = self._table.select(ids, user_id=user_id, include_archive=include_archive)
+        selected.sort(key=self._table.sort_key, reverse=True)
+        return [self._table.get(app_id) for app_id in selected[:limit]]
+
+    def search(self, query: str, user_id: Optional[str] = None, include_archive: bool = False,
+               limit: Optional[int] = None) -> List[Application]:
+        """
+        Заявки, у которых каждое слово запроса является началом имени или фамилии владельца.
+        Новые сверху.
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        with self._lock:
+            ids = None
+            for token in tokens:
+                matched = self._prefix_rows(token)
+                ids = matched if ids is None else ids & matched
+                if not ids:
+                    return []
+
+            return self._select_newest(ids, user_id, include_archive, limit)
+
+    def search_card(self, query: str, user_id: Optional[str] = None, include_archive: bool = False,
+                    limit: Optional[int] = None) -> List[Application]:
+        """Заявки, номер карты которых начинается с цифр запроса. Новые сверху."""
+        prefixes = card_prefixes(query)
+        if not prefixes:
+            return []
+
+        with self._lock:
+            if self._cards is None:
+                self._cards = sorted(
+                    (card_digits(self._table.field(app_id, 'card_number')), app_id) for app_id in self._table.ids()
+                )
+            ids = set()
+            for prefix in prefixes:
+                position = bisect.bisect_left(self._cards, (prefix,))
+                while position < len(self._cards) and self._cards[position][0].startswith(prefix):
+                    ids.add(self._cards[position][1])
+                    position += 1
+            return self._select_newest(ids, user_id, include_archive, limit)
+
+    def _similar_words(self, token: str) -> Dict[str, int]:
+        """
+        Слова словаря, отличающиеся от token не более чем на max_typos(token) правок: слово -> расстояние.
+        Одна правка портит не больше трех триграмм, поэтому кандидатами считаются только слова
+        с достаточным числом общих триграмм - остальной словарь не сравнивается вовсе.
+        """
+        limit = max_typos(token)
+        grams = trigrams(token)
+        min_shared = max(1, len(grams) - 3 * limit)
+
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._trigrams.get(gram, ()))
+
+        similar = {}
+        for word, count in shared.items():
+            if count < min_shared:
+                continue
+            distance = bounded_levenshtein(token, word, limit)
+            if distance is not None:
+                similar[word] = distance
+        return similar
+
+    def fuzzy_search(self, query: str, user_id: Optional[str] = None, include_archive: bool = False,
+                     limit: int = FUZZY_LIMIT) -> List[Application]:
+        """
+        Нечеткий поиск с учетом опечаток: каждое слово запроса должно быть похоже на одно из слов
+        имени/фамилии владельца. Возвращает до limit записей, самые похожие (затем самые новые) сверху.
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        with self._lock:
+            # Для каждой заявки - суммарное число опечаток по всем словам запроса
+            scores: Optional[Dict[int, int]] = None
+            for token in tokens:
+                token_scores: Dict[int, int] = {}
+                for word, distance in self._similar_words(token).items():
+                    for app_id in self._tokens[word]:
+                        if distance < token_scores.get(app_id, distance + 1):
+                            token_scores[app_id] = distance
+                if scores is None:
+                    scores = token_scores
+                else:
+                    scores = {app_id: scores[app_id] + d for app_id, d in token_scores.items() if app_id in scores}
+                if not scores:
+                    return []
+
+            selected = self._table.select(scores, user_id=user_id, include_archive=include_archive)
+            best = heapq.nsmallest(
+                limit, selected,
+                key=lambda app_id: (scores[app_id], tuple(-k for k in self._table.sort_key(app_id)))
+            )
+            return [self._table.get(app_id) for app_id in best]
+
+
+name_index = NameIndex()
@@ -1,30 +1,43 @@
 # -*- coding: utf-8 -*-
 
 import logging
-import io
-import csv
-from datetime import datetime
-from collections import Counter
+from collections import OrderedDict
+from typing import Optional
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 
+import exports
 import g_sheets
 import keyboards
+import scratch
+import search_index
+import utils
+from models import Application, ApplicationStatus
 from constants import (
     MENU_TEXT_SUBMIT, MENU_TEXT_SEARCH, MENU_TEXT_SETTINGS, 
-    MENU_TEXT_MAIN_MENU, CARDS_PER_PAGE, SheetCols
+    MENU_TEXT_MAIN_MENU, CARDS_PER_PAGE
 )
 
 logger = logging.getLogger(__name__)
 
 
+def _settings_menu(is_boss: bool):
+    """Текст и клавиатура меню настроек; руководителю - сколько заявок ждут решения (из индекса статусов)."""
+    index = search_index.name_index
+    if not (is_boss and index.ready):
+        return "Меню настроек:", keyboards.get_settings_keyboard(is_boss)
+    pending = index.count_status(ApplicationStatus.PENDING)
+    text = f"Меню настроек:\n\n⏳ Ожидают решения: <b>{pending}</b>"
+    return text, keyboards.get_settings_keyboard(is_boss, pending_count=pending)
+
+
 async def show_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отображает меню настроек."""
     is_boss = (str(update.effective_user.id) == g_sheets.os.getenv("BOSS_ID"))
-    keyboard = keyboards.get_settings_keyboard(is_boss)
-    await update.message.reply_text("Меню настроек:", reply_markup=keyboard)
+    text, keyboard = _settings_menu(is_boss)
+    await update.message.reply_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
 
 
 async def back_to_settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -32,8 +45,8 @@ async def back_to_settings_callback(update: Update, context: ContextTypes.DEFAUL
     query = update.callback_query
     await query.answer()
     is_boss = (str(query.from_user.id) == g_sheets.os.getenv("BOSS_ID"))
-    keyboard = keyboards.get_settings_keyboard(is_boss)
-    await query.edit_message_text("Меню настроек:", reply_markup=keyboard)
+    text, keyboard = _settings_menu(is_boss)
+    await query.edit_message_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
 
 
 async def help_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -73,106 +86,197 @@ async def my_profile_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.edit_message_text(profile_text, parse_mode=ParseMode.HTML, reply_markup=keyboards.get_back_to_settings_keyboard())
 
 
+def format_duration(seconds: float) -> str:
+    """Длительность в виде "2 д 3 ч" / "3 ч 15 мин" / "15 мин"."""
+    minutes = int(seconds // 60)
+    days, minutes = divmod(minutes, 60 * 24)
+    hours, minutes = divmod(minutes, 60)
+    if days:
+        return f"{days} д {hours} ч"
+    if hours:
+        return f"{hours} ч {minutes} мин"
+    return f"{minutes} мин"
+
+
 async def stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Собирает и отображает статистику."""
+    """Отображает статистику из предрассчитанных агрегатов локальной БД."""
     query = update.callback_query
     user_id = str(query.from_user.id)
     is_boss = (user_id == g_sheets.os.getenv("BOSS_ID"))
-    await query.edit_message_text("📊 Собираю статистику...")
-    cards_data = g_sheets.get_cards_from_sheet(user_id=None if is_boss else user_id)
+    await query.answer()
+    stats = utils.get_user_stats(None if is_boss else user_id)
 
-    if not cards_data:
+    if not stats:
         await query.edit_message_text("Нет данных для статистики.", reply_markup=keyboards.get_back_to_settings_keyboard())
         return
 
-    total_cards = len(cards_data)
-    barter_count = sum(1 for c in cards_data if c.get(SheetCols.CARD_TYPE_COL) == 'Бартер')
-    category_counter = Counter(c.get(SheetCols.CATEGORY_COL) for c in cards_data if c.get(SheetCols.CATEGORY_COL))
-    most_common_category = category_counter.most_common(1)[0][0] if category_counter else "–"
+    approval_rate = f"{stats['approval_rate']:.0%}" if stats['approval_rate'] is not None else "–"
+    avg_decision = format_duration(stats['avg_decision_seconds']) if stats['avg_decision_seconds'] is not None else "–"
 
     text = (f"<b>📊 Статистика</b>\n\n"
-            f"🗂️ {'Всего заявок в системе' if is_boss else 'Подано вами заявок'}: <b>{total_cards}</b>\n"
-            f"    - Карт 'Бартер': <code>{barter_count}</code>\n"
-            f"    - Карт 'Скидка': <code>{total_cards - barter_count}</code>\n\n"
-            f"📈 Самая частая статья: <b>{most_common_category}</b>")
+            f"🗂️ {'Всего заявок в системе' if is_boss else 'Подано вами заявок'}: <b>{stats['total']}</b>\n"
+            f"    - Карт 'Бартер': <code>{stats['barter']}</code>\n"
+            f"    - Карт 'Скидка': <code>{stats['discount']}</code>\n\n"
+            f"✅ Одобрено: <code>{stats['approved']}</code>\n"
+            f"❌ Отклонено: <code>{stats['rejected']}</code>\n"
+            f"⏳ На согласовании: <code>{stats['pending']}</code>\n"
+            f"📈 Доля одобренных: <b>{approval_rate}</b>\n"
+            f"⏱️ Среднее время решения: <b>{avg_decision}</b>\n\n"
+            f"📈 Самая частая статья: <b>{stats['top_category'] or '–'}</b>")
     await query.edit_message_text(text, reply_markup=keyboards.get_back_to_settings_keyboard(), parse_mode=ParseMode.HTML)
 
 
 async def export_csv_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Формирует и отправляет CSV файл с заявками."""
+    """Показывает варианты экспорта или формирует и отправляет CSV файл с заявками."""
     query = update.callback_query
     user_id = str(query.from_user.id)
     is_boss = (user_id == g_sheets.os.getenv("BOSS_ID"))
-    await query.edit_message_text("📄 Формирую CSV файл...")
-    cards_to_export = g_sheets.get_cards_from_sheet(user_id=None if is_boss else user_id)
 
-    if not cards_to_export:
-        await query.edit_message_text("Нет данных для экспорта.", reply_markup=keyboards.get_back_to_settings_keyboard())
+    # export_csv - меню выбора, export_csv:<колонки>:<сжатие> - сам экспорт
+    parts = query.data.split(':')
+    if len(parts) != 3:
+        await query.answer()
+        await query.edit_message_text("📄 Выберите формат экспорта:", reply_markup=keyboards.get_export_keyboard())
         return
 
-    output = io.StringIO()
-    if cards_to_export:
-        writer = csv.DictWriter(output, fieldnames=cards_to_export[0].keys())
-        writer.writeheader()
-        writer.writerows(cards_to_export)
-        output.seek(0)
-        file_to_send = InputFile(output.getvalue().encode('utf-8-sig'), filename=f"export_{datetime.now().strftime('%Y-%m-%d')}.csv")
-        await context.bot.send_document(chat_id=query.message.chat_id, document=file_to_send)
+    _, columns, compression = parts
+    if columns not in exports.EXPORT_COLUMNS:
+        columns = 'full'
+    compression = None if compression == 'none' else compression
+    if compression not in exports.COMPRESSIONS:
+        compression = None
+    export_user_id = None if is_boss else user_id
+
+    await query.answer()
+    cached_file_ids = exports.get_cached_file(exports.export_key(export_user_id, columns, compression))
+    if cached_file_ids:
+        await exports.send_cached_file(context.bot, query.message.chat_id, cached_file_ids)
         await query.message.delete()
+        return
 
+    if exports.enqueue_export(context, query.message, export_user_id, columns, compression):
+        await query.edit_message_text("📄 Формирую CSV файл... Пришлю его, как только он будет готов.")
+    else:
+        await query.edit_message_text("📄 Такой экспорт уже формируется, пришлю файл, как только он будет готов.")
 
-async def display_paginated_list(update: Update, context: ContextTypes.DEFAULT_TYPE, message_to_edit, page: int, data_key: str, list_title: str):
-    """Отображает список элементов с кнопками пагинации."""
-    all_items = context.user_data.get(data_key, [])
 
-    if not all_items:
-        await message_to_edit.edit_text("🤷 Ничего не найдено.", reply_markup=keyboards.get_back_to_settings_keyboard())
-        return
+def format_card_details(app: Application, is_boss: bool) -> str:
+    """Карточка одной заявки (HTML)."""
+    amount_text = ""
+    if app.amount:
+        amount_text = f"💰 {'Скидка' if app.is_discount else 'Бартер'}: {app.amount_text}\n"
+
+    text = (f"👤 <b>Владелец:</b> {app.owner_name or '-'}\n📞 Номер: {app.card_number or '-'}\n{amount_text}"
+            f"<b>Статус:</b> <code>{app.status or '–'}</code>\n📅 {app.created_at_text or '-'}\n")
+
+    if is_boss:
+        text += f"🤵‍♂️ <b>Инициатор:</b> {app.initiator_fio or '-'} ({app.initiator_username or '-'})\n"
+    return text
+
+
+def format_card_entry(app: Application, is_boss: bool) -> str:
+    """Форматирует одну заявку для списков с пагинацией."""
+    return format_card_details(app, is_boss) + "--------------------\n"
+
+
+# Кеш отрисованных страниц: (версия списка в scratch, страница, роль) -> (текст, клавиатура).
+# Версия меняется при каждом сохранении нового списка, поэтому старые страницы
+# просто перестают запрашиваться и вытесняются как самые давние.
+_PAGE_CACHE: "OrderedDict[tuple, tuple]" = OrderedDict()
+PAGE_CACHE_SIZE = 2000
 
+FUZZY_LIST_TITLE = "Похожие результаты (возможны опечатки)"
+# Заголовки списков, которые листаются через handle_pagination
+LIST_TITLES = {
+    'search_results': "Результаты поиска",
+    'fuzzy_results': FUZZY_LIST_TITLE,
+}
+
+
+def set_paginated_list(update: Update, context: ContextTypes.DEFAULT_TYPE, data_key: str, items: list,
+                       total: Optional[int] = None) -> None:
+    """
+    Сохраняет список для пагинации во временное хранилище (scratch) с новой версией,
+    что сбрасывает кеш страниц. В user_data списки больше не хранятся.
+    total - сколько найдено всего, если items уже обрезан (scratch хранит не больше MAX_ITEMS_PER_ENTRY).
+    """
+    context.user_data.pop(data_key, None)
+    context.user_data.pop(f'{data_key}_version', None)
+    scratch.put(update.effective_user.id, data_key, items, total)
+
+
+def truncation_note(shown: int, total: int) -> str:
+    """Предупреждение о том, что в списке показаны не все найденные заявки."""
+    if total <= shown:
+        return ""
+    return f"⚠️ <i>Показаны первые {shown} из {total}. Уточните запрос, чтобы увидеть остальные.</i>\n\n"
+
+
+def _render_page(all_items: list, page: int, data_key: str, list_title: str, is_boss: bool, total: int = 0):
+    """Строит текст и клавиатуру одной страницы списка (total - сколько найдено, если список обрезан)."""
     start_index = page * CARDS_PER_PAGE
     end_index = start_index + CARDS_PER_PAGE
     items_on_page = all_items[start_index:end_index]
     total_pages = (len(all_items) + CARDS_PER_PAGE - 1) // CARDS_PER_PAGE
 
     text = f"<b>{list_title} (Стр. {page + 1}/{total_pages}):</b>\n\n"
-    for card in items_on_page:
-        owner_name = f"{card.get(SheetCols.OWNER_FIRST_NAME_COL,'')} {card.get(SheetCols.OWNER_LAST_NAME_COL,'-')}".strip()
-        amount_text = ""
-        if card.get(SheetCols.AMOUNT_COL):
-            card_type_str = card.get(SheetCols.CARD_TYPE_COL)
-            amount_val = card.get(SheetCols.AMOUNT_COL)
-            amount_text = f"💰 {'Скидка' if card_type_str == 'Скидка' else 'Бартер'}: {amount_val}{'%' if card_type_str == 'Скидка' else ' ₽'}\n"
-
-        text += (f"👤 <b>Владелец:</b> {owner_name}\n📞 Номер: {card.get(SheetCols.CARD_NUMBER_COL, '-')}\n{amount_text}"
-                 f"<b>Статус:</b> <code>{card.get(SheetCols.STATUS_COL, '–')}</code>\n📅 {card.get(SheetCols.TIMESTAMP, '-')}\n")
-
-        if str(update.effective_user.id) == g_sheets.os.getenv("BOSS_ID"):
-            text += f"🤵‍♂️ <b>Инициатор:</b> {card.get(SheetCols.FIO_INITIATOR, '-')} ({card.get(SheetCols.TG_TAG, '-')})\n"
-        text += "--------------------\n"
+    text += truncation_note(len(all_items), total)
+    text += "".join(format_card_entry(card, is_boss) for card in items_on_page)
 
     row = []
     if page > 0: row.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"paginate_{data_key}_{page - 1}"))
     row.append(InlineKeyboardButton(f" {page + 1}/{total_pages} ", callback_data="noop"))
     if end_index < len(all_items): row.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"paginate_{data_key}_{page + 1}"))
 
-    await message_to_edit.edit_text(
-        text,
-        reply_markup=InlineKeyboardMarkup([row, [InlineKeyboardButton("⬅️ Назад в настройки", callback_data="back_to_settings")]]),
-        parse_mode=ParseMode.HTML
-    )
+    return text, InlineKeyboardMarkup([row, [InlineKeyboardButton("⬅️ Назад в настройки", callback_data="back_to_settings")]])
+
+
+def _get_rendered_page(all_items: list, version: str, page: int, data_key: str, list_title: str, is_boss: bool,
+                       total: int = 0):
+    """Возвращает страницу из кеша или отрисовывает и кеширует ее."""
+    key = (version, page, is_boss)
+    rendered = _PAGE_CACHE.get(key)
+    if rendered:
+        _PAGE_CACHE.move_to_end(key)
+        return rendered
+
+    rendered = _render_page(all_items, page, data_key, list_title, is_boss, total)
+    _PAGE_CACHE[key] = rendered
+    if len(_PAGE_CACHE) > PAGE_CACHE_SIZE:
+        _PAGE_CACHE.popitem(last=False)
+    return rendered
+
+
+async def display_paginated_list(update: Update, context: ContextTypes.DEFAULT_TYPE, message_to_edit, page: int, data_key: str, list_title: str):
+    """Отображает список элементов с кнопками пагинации."""
+    stored = scratch.get(update.effective_user.id, data_key)
+    if stored is None:
+        await message_to_edit.edit_text("⌛ Список устарел, выполните поиск заново.", reply_markup=keyboards.get_back_to_settings_keyboard())
+        return
+
+    all_items, version, total = stored
+    if not all_items:
+        await message_to_edit.edit_text("🤷 Ничего не найдено.", reply_markup=keyboards.get_back_to_settings_keyboard())
+        return
+
+    is_boss = str(update.effective_user.id) == g_sheets.os.getenv("BOSS_ID")
+    text, reply_markup = _get_rendered_page(all_items, version, page, data_key, list_title, is_boss, total)
+
+    await message_to_edit.edit_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+
+    # Заранее готовим следующую страницу, чтобы "Вперед" был просто редактированием сообщения
+    if (page + 1) * CARDS_PER_PAGE < len(all_items):
+        _get_rendered_page(all_items, version, page + 1, data_key, list_title, is_boss, total)
 
 
 async def handle_pagination(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает нажатия на кнопки пагинации."""
     query = update.callback_query
     await query.answer()
-    _, data_key, page_str = query.data.split('_')
-    is_boss = (str(update.effective_user.id) == g_sheets.os.getenv("BOSS_ID"))
-    
-    if data_key == 'my_cards':
-        list_title = "Все заявки" if is_boss else "Ваши поданные заявки"
-    else: # search_results
-        list_title = "Результаты поиска"
+    # data_key сам может содержать "_" (search_results), поэтому номер страницы отрезаем справа
+    prefix_and_key, page_str = query.data.rsplit('_', 1)
+    data_key = prefix_and_key[len('paginate_'):]
+    list_title = LIST_TITLES.get(data_key, "Результаты поиска")
 
     await display_paginated_list(update, context, message_to_edit=query.message, page=int(page_str), data_key=data_key, list_title=list_title)
 
@@ -182,17 +286,68 @@ async def noop_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
 
 
-async def my_cards_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Загружает и отображает список заявок."""
+async def display_my_cards_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int,
+                                after_id: int = None, before_id: int = None):
+    """
+    Показывает страницу "Мои заявки" прямо из локальной БД.
+    В user_data ничего не хранится - кнопки несут только номер страницы и id заявки-курсора.
+    """
     query = update.callback_query
-    await query.answer()
     user_id = str(query.from_user.id)
     is_boss = (user_id == g_sheets.os.getenv("BOSS_ID"))
-    await query.edit_message_text("👑 Загружаю ВСЕ заявки..." if is_boss else "🔍 Загружаю ваши заявки...")
-
-    all_cards = g_sheets.get_cards_from_sheet(user_id=None if is_boss else user_id)
-    
-    data_key = 'my_cards'
-    context.user_data[data_key] = all_cards
+    scope = None if is_boss else user_id
     list_title = "Все заявки" if is_boss else "Ваши поданные заявки"
-    await display_paginated_list(update, context, message_to_edit=query.message, page=0, data_key=data_key, list_title=list_title)
+
+    rows = utils.get_applications_page(scope, after_id=after_id, before_id=before_id, limit=CARDS_PER_PAGE)
+    if not rows and (after_id is not None or before_id is not None):
+        # Заявка-курсор исчезла (таблицу синхронизировали) - начинаем с первой страницы
+        page = 0
+        rows = utils.get_applications_page(scope, limit=CARDS_PER_PAGE)
+
+    if not rows:
+        await query.edit_message_text("🤷 Ничего не найдено.", reply_markup=keyboards.get_back_to_settings_keyboard())
+        return
+
+    total = utils.count_applications(scope)
+    total_pages = max((total + CARDS_PER_PAGE - 1) // CARDS_PER_PAGE, page + 1)
+
+    text = f"<b>{list_title} (Стр. {page + 1}/{total_pages}):</b>\n\n"
+    for row in rows:
+        text += format_card_entry(Application.from_db_row(row), is_boss)
+
+    nav_row = []
+    if page > 0: nav_row.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"mycards:prev:{page - 1}:{rows[0]['id']}"))
+    nav_row.append(InlineKeyboardButton(f" {page + 1}/{total_pages} ", callback_data="noop"))
+    if page + 1 < total_pages: nav_row.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"mycards:next:{page + 1}:{rows[-1]['id']}"))
+
+    await query.edit_message_text(
+        text,
+        reply_markup=InlineKeyboardMarkup([nav_row, [InlineKeyboardButton("⬅️ Назад в настройки", callback_data="back_to_settings")]]),
+        parse_mode=ParseMode.HTML
+    )
+
+
+async def handle_my_cards_pagination(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Листает "Мои заявки" по курсору из callback_data (mycards:<next|prev>:<page>:<id>)."""
+    query = update.callback_query
+    await query.answer()
+    try:
+        _, direction, page_str, cursor_str = query.data.split(':')
+        page, cursor_id = int(page_str), int(cursor_str)
+    except ValueError:
+        logger.error(f"Ошибка парсинга callback_data пагинации: {query.data}")
+        return
+
+    if direction == 'next':
+        await display_my_cards_page(update, context, page=page, after_id=cursor_id)
+    else:
+        await display_my_cards_page(update, context, page=page, before_id=cursor_id)
+
+
+async def my_cards_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Загружает и отображает список заявок."""
+    query = update.callback_query
+    await query.answer()
+    # Списки из старых версий бота больше не нужны
+    context.user_data.pop('my_cards', None)
+    await display_my_cards_page(update, context, page=0)
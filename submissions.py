@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+"""
+Фоновая отправка поданных заявок в Google Sheets.
+Пользователь получает подтверждение с номером заявки сразу после сохранения в локальную БД,
+а запись в таблицу и уведомление руководителя выполняются здесь, с повторами при ошибках.
+Задания лежат в таблице submission_queue, поэтому переживают перезапуск бота: при старте
+все невыполненные задания снова ставятся в очередь. Когда строка попадает в таблицу,
+сообщение пользователя с заявкой обновляется на месте.
+"""
+
+import asyncio
+import logging
+import os
+from typing import Dict, Optional
+
+from telegram.constants import ParseMode
+
+import admin_handlers
+import g_sheets
+import outbound
+import search_index
+import utils
+from models import Application
+
+logger = logging.getLogger(__name__)
+
+RETRY_BASE_DELAY = 10     # секунд до первого повтора, дальше - вдвое больше
+RETRY_MAX_DELAY = 600     # но не реже, чем раз в 10 минут
+DELAY_NOTICE_AFTER = 3    # после стольких неудач пользователь узнает о задержке
+
+# Поля данных формы, которые нужны для записи заявки (локально и в g_sheets.write_row)
+PAYLOAD_FIELDS = (
+    'public_id', 'submission_time', 'tg_user_id', 'status',
+    'initiator_username', 'initiator_email', 'initiator_fio', 'initiator_job_title', 'initiator_phone',
+    'owner_first_name', 'owner_last_name', 'reason', 'card_type', 'card_number',
+    'category', 'amount', 'frequency', 'issue_location',
+)
+
+_FOOTER = "\n\n📋 <i>Мы уведомим вас, как только заявка будет рассмотрена!</i>"
+
+
+def status_accepted(public_id: str) -> str:
+    return f"\n\n<b>Статус:</b> ⏳ Заявка №<code>{public_id}</code> принята и передается на согласование.{_FOOTER}"
+
+
+def status_sent(public_id: str) -> str:
+    return f"\n\n<b>Статус:</b> ✅ Заявка №<code>{public_id}</code> успешно отправлена на согласование.{_FOOTER}"
+
+
+def status_delayed(public_id: str) -> str:
+    return (
+        f"\n\n<b>Статус:</b> ⏳ Заявка №<code>{public_id}</code> сохранена, но таблица согласования "
+        f"сейчас недоступна. Отправка повторяется автоматически.{_FOOTER}"
+    )
+
+
+def build_payload(data: Dict) -> Dict:
+    """Данные формы, которые сохраняются в задании (user_data содержит и посторонние ключи)."""
+    return {field: data.get(field) for field in PAYLOAD_FIELDS}
+
+
+def retry_delay(attempts: int) -> float:
+    return min(RETRY_BASE_DELAY * 2 ** max(attempts - 1, 0), RETRY_MAX_DELAY)
+
+
+async def notify_admin(bot, result: g_sheets.WriteResult) -> None:
+    """Отправляет руководителю уведомление о новой заявке, построенное из записанной строки."""
+    boss_id = os.getenv("BOSS_ID")
+    if not boss_id:
+        return
+    try:
+        notification = admin_handlers.format_admin_notification(
+            Application.from_sheet_record(result.values, sheet_row=result.sheet_row)
+        )
+        await outbound.send_message(
+            bot,
+            chat_id=boss_id,
+            text=notification["text"],
+            reply_markup=notification["reply_markup"],
+            parse_mode=ParseMode.HTML,
+            priority=outbound.PRIORITY_ADMIN
+        )
+        logger.info(f"Админ уведомлен о новой заявке {result.public_id} (строка {result.sheet_row})")
+    except Exception as e:
+        logger.error(f"Не удалось уведомить админа о новой заявке {result.public_id}: {e}", exc_info=True)
+
+
+class SubmissionPipeline:
+    """Очередь заданий на запись заявок в таблицу с одним фоновым обработчиком и повторами."""
+
+    def __init__(self):
+        self._bot = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._scheduled = set()   # id заявок в очереди или в ожидании повтора
+        self._in_flight = set()   # уведомления по уже записанным заявкам
+
+    @property
+    def running(self) -> bool:
+        return self._worker is not None and not self._worker.done()
+
+    async def start(self, bot) -> None:
+        """Запускает обработчик и ставит в очередь задания, оставшиеся с прошлого запуска."""
+        if self.running:
+            return
+        self._bot = bot
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+        jobs = await asyncio.to_thread(utils.get_queued_submissions)
+        for job in jobs:
+            self.enqueue(job['app_id'])
+        logger.info(f"Очередь отправки заявок запущена, невыполненных заданий: {len(jobs)}")
+
+    async def stop(self) -> None:
+        """Останавливает обработчик. Невыполненные задания остаются в БД до следующего запуска."""
+        if self._worker:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+        self._scheduled.clear()
+        logger.info("Очередь отправки заявок остановлена")
+
+    def enqueue(self, app_id: int, delay: float = 0.0) -> bool:
+        """Ставит задание в очередь (через delay секунд). False, если обработчик не запущен."""
+        if not self.running:
+            logger.warning(f"Очередь отправки не запущена - заявка {app_id} будет отправлена после перезапуска")
+            return False
+        if app_id in self._scheduled:
+            return True
+        self._scheduled.add(app_id)
+        if delay:
+            asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, app_id)
+        else:
+            self._queue.put_nowait(app_id)
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            app_id = await self._queue.get()
+            self._scheduled.discard(app_id)
+            try:
+                await self._process(app_id)
+            except Exception as e:
+                logger.error(f"Ошибка обработки задания на отправку заявки {app_id}: {e}", exc_info=True)
+                await asyncio.to_thread(utils.record_submission_failure, app_id, str(e))
+                self.enqueue(app_id, RETRY_MAX_DELAY)
+
+    async def _write(self, payload: Dict, attempt: Optional[int]) -> Optional[g_sheets.WriteResult]:
+        public_id = payload.get('public_id')
+        if public_id and (attempt is None or attempt > 1):
+            # Прошлая попытка могла записать строку, но не дойти до конца - не дублируем ее.
+            # Если номер попытки неизвестен (ошибка БД), проверяем таблицу на всякий случай
+            found, sheet_row = await asyncio.to_thread(g_sheets.find_sheet_row_by_public_id, public_id)
+            if not found:
+                # Не знаем, есть ли строка в таблице - повторим попытку позже, а не допишем дубль
+                return None
+            if sheet_row:
+                logger.info(f"Заявка {public_id} уже есть в таблице (строка {sheet_row})")
+                return g_sheets.WriteResult(sheet_row, public_id, Application.from_form_data(payload).to_sheet_record())
+        return await asyncio.to_thread(g_sheets.write_row, payload)
+
+    async def _process(self, app_id: int) -> None:
+        job = await asyncio.to_thread(utils.get_queued_submission, app_id)
+        if not job:
+            return  # уже выполнено
+        payload = job['payload']
+        public_id = payload.get('public_id')
+
+        attempt = await asyncio.to_thread(utils.start_submission_attempt, app_id)
+        result = await self._write(payload, attempt)
+        if attempt is None:
+            attempt = job['attempts'] + 1
+        if result is None:
+            await asyncio.to_thread(utils.record_submission_failure, app_id, "write_row не подтвердил запись")
+            delay = retry_delay(attempt)
+            logger.warning(f"Заявка {public_id} не записана в таблицу (попытка {attempt}), повтор через {delay:.0f}с")
+            self.enqueue(app_id, delay)
+            if attempt == DELAY_NOTICE_AFTER:
+                self._spawn(self._update_user_message(job, status_delayed(public_id)))
+            return
+
+        # Уведомление отмечается в задании до его завершения: если завершить задание не удастся,
+        # повторная попытка найдет строку в таблице и не уведомит руководителя второй раз
+        if not job['notified'] and await asyncio.to_thread(utils.mark_submission_notified, app_id):
+            self._spawn(notify_admin(self._bot, result))
+
+        if not await asyncio.to_thread(utils.complete_submission, app_id, result.sheet_row):
+            raise RuntimeError(f"заявка {public_id} записана в строку {result.sheet_row}, но не отмечена в БД")
+        await asyncio.to_thread(search_index.name_index.index_application, app_id)
+        logger.info(f"Заявка {public_id} записана в таблицу (строка {result.sheet_row}), попытка {attempt}")
+
+        self._spawn(self._update_user_message(job, status_sent(public_id)))
+
+    def _spawn(self, coroutine) -> None:
+        """Уведомления отправляются в фоне, чтобы обработчик не ждал очередь исходящих сообщений."""
+        task = asyncio.create_task(coroutine)
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def _update_user_message(self, job: Dict, status_text: str) -> None:
+        """Обновляет статус в сообщении пользователя с заявкой."""
+        if not job.get('chat_id') or not job.get('message_id'):
+            return
+        try:
+            await outbound.edit_message_text(
+                self._bot,
+                chat_id=job['chat_id'],
+                message_id=job['message_id'],
+                text=(job.get('message_text') or '') + status_text,
+                parse_mode=ParseMode.HTML,
+                priority=outbound.PRIORITY_NOTIFICATION
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось обновить сообщение с заявкой {job['payload'].get('public_id')}: {e}")
+
+
+pipeline = SubmissionPipeline()
+
+
+async def start(application) -> None:
+    """post_init-хук приложения: запускает отправку заявок."""
+    await pipeline.start(application.bot)
+
+
+async def stop(application) -> None:
+    """post_shutdown-хук приложения: останавливает отправку заявок."""
+    await pipeline.stop()
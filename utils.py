@@ -5,11 +5,16 @@
 """
 
 import re
+import json
 import logging
 import sqlite3
 import os
+import calendar
+import threading
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Iterator
+
+from constants import SheetCols
 
 logger = logging.getLogger(__name__)
 
@@ -64,6 +69,32 @@ def validate_amount(amount: str, card_type: str) -> tuple[bool, str]:
 
 # === ВНУТРЕННЯЯ БАЗА ДАННЫХ (SQLite) ===
 
+# Формат времени, в котором бот пишет "Отметку времени" в таблицу и в локальную БД
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Форматы, которые встречаются в таблице (часть строк заведена вручную или через Google Forms)
+SHEET_TIMESTAMP_FORMATS = (TIMESTAMP_FORMAT, '%d.%m.%Y %H:%M:%S', '%d.%m.%Y')
+
+# Время последней успешной синхронизации зеркала с Google Sheets
+LAST_SYNC_AT: Optional[datetime] = None
+
+# Поколение данных о заявках: увеличивается при любом изменении заявок (подача, смена статуса,
+# архивация, синхронизация с изменившейся таблицей). По нему кеши понимают, что устарели.
+_DATA_GENERATION = 0
+_GENERATION_LOCK = threading.Lock()
+# Отпечаток данных последней синхронизации - неизменившаяся таблица поколение не меняет
+_LAST_SYNC_DIGEST: Optional[int] = None
+
+def get_data_generation() -> int:
+    """Текущее поколение данных о заявках."""
+    return _DATA_GENERATION
+
+def bump_data_generation() -> int:
+    """Отмечает, что данные о заявках изменились. Возвращает новое поколение."""
+    global _DATA_GENERATION
+    with _GENERATION_LOCK:
+        _DATA_GENERATION += 1
+        return _DATA_GENERATION
+
 def get_db_path():
     """Возвращает путь к базе данных, используя volume если доступен."""
     volume_path = os.getenv('RAILWAY_VOLUME_MOUNT_PATH', os.getcwd())
@@ -119,12 +150,142 @@ def init_local_db():
             )
         ''')
         
+        # История напоминаний: одна запись на пользователя в рамках волны рассылки
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS reminder_log (
+                tg_id TEXT NOT NULL,
+                wave TEXT NOT NULL,
+                status TEXT NOT NULL,
+                error TEXT,
+                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (tg_id, wave)
+            )
+        ''')
+        
+        # Состояние бота (user_data, chat_data, bot_data, шаги диалогов) - см. persistence.py
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS persistence (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                data BLOB NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (kind, key)
+            )
+        ''')
+        
+        # Заявки, поданные в боте, но еще не записанные в Google Sheets (см. submissions.py)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS submission_queue (
+                app_id INTEGER PRIMARY KEY,
+                payload TEXT NOT NULL,
+                chat_id INTEGER,
+                message_id INTEGER,
+                message_text TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                notified INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Решения руководителя по заявкам: защищают от повторного одобрения/отклонения
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS admin_decisions (
+                app_key TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                decided_by TEXT,
+                reason TEXT,
+                state TEXT NOT NULL DEFAULT 'pending',
+                updated_ts INTEGER NOT NULL
+            )
+        ''')
+        
+        # Агрегаты для экрана статистики: одна строка на инициатора
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_stats (
+                tg_id TEXT PRIMARY KEY,
+                total INTEGER NOT NULL DEFAULT 0,
+                barter INTEGER NOT NULL DEFAULT 0,
+                approved INTEGER NOT NULL DEFAULT 0,
+                rejected INTEGER NOT NULL DEFAULT 0,
+                decided INTEGER NOT NULL DEFAULT 0,
+                decision_seconds INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_category_stats (
+                tg_id TEXT NOT NULL,
+                category TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (tg_id, category)
+            )
+        ''')
+        
+        # Колонки, добавленные после первого релиза (для уже существующих файлов БД)
+        _ensure_columns(cursor, 'applications', {
+            'sheet_row': 'INTEGER',
+            'initiator_fio': 'TEXT',
+            'initiator_username': 'TEXT',
+            'created_ts': 'INTEGER',  # created_at в секундах эпохи - по нему строятся все выборки
+            'decided_ts': 'INTEGER',  # момент решения руководителя (только для решений через бота)
+            'public_id': 'TEXT',  # постоянный ID заявки из колонки SheetCols.APP_ID
+            'synced_ts': 'INTEGER',  # когда бот сам записал заявку в таблицу (см. _mark_synced)
+        })
+        _ensure_columns(cursor, 'submission_queue', {
+            'notified': 'INTEGER NOT NULL DEFAULT 0',  # руководитель уже получил уведомление о заявке
+        })
+        # Заполняем created_ts для строк, сохраненных до появления колонки
+        cursor.execute('''
+            UPDATE applications
+            SET created_ts = COALESCE(CAST(strftime('%s', created_at) AS INTEGER), 0)
+            WHERE created_ts IS NULL
+        ''')
+
+        # Индексы, которые перекрываются составными индексами ниже
+        cursor.execute('DROP INDEX IF EXISTS idx_applications_tg_user_id')
+        cursor.execute('DROP INDEX IF EXISTS idx_applications_status')
+        cursor.execute('DROP INDEX IF EXISTS idx_applications_user_created')
+
         # Создаем индексы для быстрого поиска
+        # (id - это rowid, он неявно дописывается в конец каждого индекса: индекс по (tg_user_id, created_ts)
+        # отдает строки в порядке (created_ts, id) и служит ключом пагинации, а (created_ts, status) - нет)
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_tg_id ON users(tg_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_applications_tg_user_id ON applications(tg_user_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_applications_status ON applications(status)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users(last_activity)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_applications_card_number ON applications(card_number)')
-        
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_applications_sheet_row ON applications(sheet_row)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_reminder_log_tg_id_sent ON reminder_log(tg_id, sent_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_applications_user_created_ts ON applications(tg_user_id, created_ts)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_applications_status_created_ts ON applications(status, created_ts)')
+        # Постоянный ID - идентичность заявки: синхронизация сопоставляет строки таблицы по нему.
+        # Прежний индекс был не уникальным - перед заменой убираем дубли, оставляя копию таблицы
+        cursor.execute('PRAGMA index_list(applications)')
+        if any(row[1] == 'idx_applications_public_id' and not row[2] for row in cursor.fetchall()):
+            cursor.execute('''
+                DELETE FROM applications WHERE id IN (
+                    SELECT a.id FROM applications a JOIN applications b ON b.public_id = a.public_id
+                    WHERE (b.google_sheets_synced, b.id) > (a.google_sheets_synced, a.id)
+                )
+            ''')
+            cursor.execute('DROP INDEX idx_applications_public_id')
+        cursor.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS idx_applications_public_id ON applications(public_id) '
+            'WHERE public_id IS NOT NULL'
+        )
+        # status в конце делает индекс покрывающим для подсчетов в отчетах за период
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_applications_created_ts ON applications(created_ts, status)')
+        # Ключ пагинации по всем заявкам (created_ts, id) для экрана руководителя
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_applications_created_id ON applications(created_ts)')
+
+        # Архивные таблицы получают новые колонки и индексы вслед за applications
+        for table in _archive_tables(cursor):
+            _ensure_archive_table(cursor, table[len(ARCHIVE_TABLE_PREFIX):])
+
+        # Первое заполнение агрегатов статистики (дальше они обновляются при изменениях заявок)
+        cursor.execute('SELECT COUNT(*) FROM user_stats')
+        if not cursor.fetchone()[0]:
+            _refresh_user_stats(cursor)
+
         conn.commit()
         conn.close()
         
@@ -135,6 +296,30 @@ def init_local_db():
         logger.error(f"Ошибка при инициализации локальной БД: {e}")
         return False
 
+def _ensure_columns(cursor, table: str, columns: Dict[str, str]) -> None:
+    """Добавляет в таблицу недостающие колонки (простая миграция схемы)."""
+    cursor.execute(f'PRAGMA table_info({table})')
+    existing = {row[1] for row in cursor.fetchall()}
+    for name, col_type in columns.items():
+        if name not in existing:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {col_type}')
+            logger.info(f"Миграция БД: в таблицу {table} добавлена колонка {name}")
+
+def to_epoch(dt: Optional[datetime]) -> int:
+    """
+    Переводит "наивное" время в секунды эпохи, считая его UTC - так же, как strftime('%s') в SQLite.
+    Для неизвестного времени возвращает 0.
+    """
+    if not dt:
+        return 0
+    return calendar.timegm(dt.timetuple())
+
+def from_epoch(ts: int) -> Optional[datetime]:
+    """Обратное к to_epoch: секунды эпохи в "наивное" время UTC (0 - время неизвестно)."""
+    if not ts:
+        return None
+    return datetime(1970, 1, 1) + timedelta(seconds=ts)
+
 def save_user_to_local_db(user_data: Dict) -> bool:
     """Сохранение данных пользователя в локальную БД."""
     try:
@@ -164,41 +349,146 @@ def save_user_to_local_db(user_data: Dict) -> bool:
         logger.error(f"Ошибка при сохранении пользователя в локальную БД: {e}")
         return False
 
-def save_application_to_local_db(app_data: Dict) -> Optional[int]:
-    """Сохранение заявки в локальную БД. Возвращает ID записи."""
+def _insert_application(cursor, app_data: Dict) -> int:
+    """Вставляет заявку из данных формы в applications. Возвращает ее id."""
+    created_at = app_data.get('submission_time') or datetime.now().strftime(TIMESTAMP_FORMAT)
+    cursor.execute('''
+        INSERT INTO applications
+        (public_id, tg_user_id, owner_last_name, owner_first_name, card_number,
+         card_type, amount, category, frequency, issue_location, reason, status,
+         initiator_fio, initiator_username, created_at, created_ts)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        app_data.get('public_id'),
+        app_data.get('tg_user_id'),
+        app_data.get('owner_last_name'),
+        app_data.get('owner_first_name'),
+        app_data.get('card_number'),
+        app_data.get('card_type'),
+        app_data.get('amount'),
+        app_data.get('category'),
+        app_data.get('frequency'),
+        app_data.get('issue_location'),
+        app_data.get('reason'),
+        app_data.get('status', 'На согласовании'),
+        app_data.get('initiator_fio'),
+        app_data.get('initiator_username'),
+        # Время подачи пишем тем же форматом, что и в таблице, чтобы окна отчетов совпадали
+        created_at,
+        to_epoch(parse_sheet_timestamp(created_at))
+    ))
+    # lastrowid нужно взять до пересчета агрегатов - он пишет в user_stats
+    app_id = cursor.lastrowid
+    _refresh_user_stats(cursor, [app_data.get('tg_user_id')])
+    return app_id
+
+def save_submission(app_data: Dict, chat_id: int, message_id: int, message_text: str) -> Optional[int]:
+    """
+    Сохраняет поданную заявку и задание на ее отправку в таблицу одной транзакцией.
+    app_data - данные формы (они же уходят в g_sheets.write_row); chat_id/message_id/message_text -
+    сообщение пользователя, которое обновляется, когда заявка попадет в таблицу. Возвращает id заявки.
+    """
     try:
-        db_path = get_db_path()
-        conn = sqlite3.connect(db_path)
+        conn = sqlite3.connect(get_db_path())
         cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO applications 
-            (tg_user_id, owner_last_name, owner_first_name, card_number, 
-             card_type, amount, category, frequency, issue_location, reason, status)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            app_data.get('tg_user_id'),
-            app_data.get('owner_last_name'),
-            app_data.get('owner_first_name'),
-            app_data.get('card_number'),
-            app_data.get('card_type'),
-            app_data.get('amount'),
-            app_data.get('category'),
-            app_data.get('frequency'),
-            app_data.get('issue_location'),
-            app_data.get('reason'),
-            app_data.get('status', 'На согласовании')
-        ))
-        
-        app_id = cursor.lastrowid
+        app_id = _insert_application(cursor, app_data)
+        cursor.execute(
+            'INSERT INTO submission_queue (app_id, payload, chat_id, message_id, message_text) VALUES (?, ?, ?, ?, ?)',
+            (app_id, json.dumps(app_data, ensure_ascii=False), chat_id, message_id, message_text)
+        )
         conn.commit()
         conn.close()
+        bump_data_generation()
         return app_id
-        
+
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении заявки пользователя {app_data.get('tg_user_id')} в очередь отправки: {e}")
+        return None
+
+def _submission_job(row) -> Dict:
+    job = dict(row)
+    job['payload'] = json.loads(job['payload'])
+    return job
+
+def get_queued_submissions() -> List[Dict]:
+    """Задания на отправку заявок в таблицу, которые еще не выполнены (старые сверху)."""
+    try:
+        conn = sqlite3.connect(get_db_path())
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM submission_queue ORDER BY app_id')
+        jobs = [_submission_job(row) for row in cursor.fetchall()]
+        conn.close()
+        return jobs
+
+    except Exception as e:
+        logger.error(f"Ошибка при чтении очереди отправки заявок: {e}")
+        return []
+
+def get_queued_submission(app_id: int) -> Optional[Dict]:
+    """Одно задание на отправку заявки или None, если его уже нет."""
+    try:
+        conn = sqlite3.connect(get_db_path())
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM submission_queue WHERE app_id = ?', (app_id,))
+        row = cursor.fetchone()
+        conn.close()
+        return _submission_job(row) if row else None
+
+    except Exception as e:
+        logger.error(f"Ошибка при чтении задания на отправку заявки {app_id}: {e}")
+        return None
+
+def start_submission_attempt(app_id: int) -> Optional[int]:
+    """
+    Отмечает начало очередной попытки отправки заявки (до записи в таблицу, чтобы после сбоя
+    или перезапуска было видно, что строка могла уже попасть в таблицу). Возвращает номер попытки
+    или None, если отметить ее не удалось (тогда неизвестно, были ли попытки раньше).
+    """
+    try:
+        conn = sqlite3.connect(get_db_path())
+        cursor = conn.cursor()
+        cursor.execute('UPDATE submission_queue SET attempts = attempts + 1 WHERE app_id = ?', (app_id,))
+        cursor.execute('SELECT attempts FROM submission_queue WHERE app_id = ?', (app_id,))
+        row = cursor.fetchone()
+        conn.commit()
+        conn.close()
+        return row[0] if row else None
+
     except Exception as e:
-        logger.error(f"Ошибка при сохранении заявки в локальную БД: {e}")
+        logger.error(f"Ошибка при отметке попытки отправки заявки {app_id}: {e}")
         return None
 
+def mark_submission_notified(app_id: int) -> bool:
+    """Отмечает, что руководитель получил уведомление о заявке. False - задания нет или ошибка БД."""
+    try:
+        conn = sqlite3.connect(get_db_path())
+        cursor = conn.cursor()
+        cursor.execute('UPDATE submission_queue SET notified = 1 WHERE app_id = ? AND notified = 0', (app_id,))
+        marked = cursor.rowcount > 0
+        conn.commit()
+        conn.close()
+        return marked
+
+    except Exception as e:
+        logger.error(f"Ошибка при отметке уведомления о заявке {app_id}: {e}")
+        return False
+
+def record_submission_failure(app_id: int, error: str) -> bool:
+    """Сохраняет причину последней неудачной попытки отправки заявки."""
+    try:
+        conn = sqlite3.connect(get_db_path())
+        cursor = conn.cursor()
+        cursor.execute('UPDATE submission_queue SET last_error = ? WHERE app_id = ?', (error[:500], app_id))
+        conn.commit()
+        conn.close()
+        return True
+
+    except Exception as e:
+        logger.error(f"Ошибка при записи неудачной отправки заявки {app_id}: {e}")
+        return False
+
 def get_user_from_local_db(tg_id: str) -> Optional[Dict]:
     """Получение данных пользователя из локальной БД."""
     logger.info(f"🔍 Ищем пользователя в локальной БД: tg_id={tg_id}")
@@ -263,8 +553,12 @@ def get_initiator_from_local_db(tg_id: str) -> Optional[Dict]:
     logger.info(f"📋 Возвращаем преобразованные данные: {result}")
     return result
 
-def search_applications_local(query: str, search_type: str = 'name', user_id: str = None) -> List[Dict]:
-    """Быстрый поиск заявок в локальной БД."""
+def search_applications_local(query: str, search_type: str = 'name', user_id: str = None,
+                              include_archive: bool = False) -> List[Dict]:
+    """
+    Быстрый поиск заявок в локальной БД.
+    Архивные таблицы просматриваются только при include_archive=True (поиск "по истории").
+    """
     try:
         db_path = get_db_path()
         conn = sqlite3.connect(db_path)
@@ -272,22 +566,25 @@ def search_applications_local(query: str, search_type: str = 'name', user_id: st
         cursor = conn.cursor()
         
         if search_type == 'name':
-            sql = '''
-                SELECT * FROM applications 
-                WHERE (owner_first_name LIKE ? OR owner_last_name LIKE ?)
-            '''
+            where = '(owner_first_name LIKE ? OR owner_last_name LIKE ?)'
             params = [f'%{query}%', f'%{query}%']
         else:  # phone
-            sql = 'SELECT * FROM applications WHERE card_number LIKE ?'
+            where = 'card_number LIKE ?'
             params = [f'%{query}%']
         
         if user_id:
-            sql += ' AND tg_user_id = ?'
+            where += ' AND tg_user_id = ?'
             params.append(user_id)
-            
-        sql += ' ORDER BY created_at DESC'
+
+        tables = ['applications']
+        if include_archive:
+            tables += _archive_tables(cursor)
+
+        columns = ', '.join(_table_columns(cursor, 'applications'))
+        sql = ' UNION ALL '.join(f'SELECT {columns} FROM {table} WHERE {where}' for table in tables)
+        sql += ' ORDER BY created_ts DESC'
         
-        cursor.execute(sql, params)
+        cursor.execute(sql, params * len(tables))
         rows = cursor.fetchall()
         conn.close()
         
@@ -297,10 +594,738 @@ def search_applications_local(query: str, search_type: str = 'name', user_id: st
         logger.error(f"Ошибка при поиске в локальной БД: {e}")
         return []
 
-def sync_with_google_sheets():
-    """Синхронизация локальной БД с Google Sheets (фоновая задача)."""
-    # Эта функция может выполняться периодически для обеспечения консистентности данных
-    pass
+# === АРХИВ СТАРЫХ ЗАЯВОК ===
+
+ARCHIVE_TABLE_PREFIX = 'applications_archive_'
+# Статусы, после которых заявка больше не меняется и может уйти в архив
+FINAL_STATUSES = ('Одобрено', 'Отклонено')
+
+def _table_columns(cursor, table: str) -> List[str]:
+    """Список колонок таблицы в порядке объявления."""
+    cursor.execute(f'PRAGMA table_info({table})')
+    return [row[1] for row in cursor.fetchall()]
+
+def _archive_tables(cursor) -> List[str]:
+    """Имена архивных таблиц (по одной на год), от новых к старым."""
+    cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ? ORDER BY name DESC",
+        (f'{ARCHIVE_TABLE_PREFIX}%',)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+def _ensure_archive_table(cursor, year: str) -> str:
+    """Создает архивную таблицу за год со схемой как у applications."""
+    table = f'{ARCHIVE_TABLE_PREFIX}{int(year)}'
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS {table} AS SELECT * FROM applications WHERE 0')
+    # applications могла получить новые колонки после создания архива
+    cursor.execute('PRAGMA table_info(applications)')
+    _ensure_columns(cursor, table, {row[1]: row[2] for row in cursor.fetchall()})
+    cursor.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_id ON {table}(id)')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_tg_user_id ON {table}(tg_user_id)')
+    # Номер строки - не идентичность заявки: после пересортировки таблицы в архив может попасть
+    # другая заявка с той же строкой, поэтому индекс по строке не уникальный
+    cursor.execute(f'PRAGMA index_list({table})')
+    if any(row[1] == f'idx_{table}_sheet_row' and row[2] for row in cursor.fetchall()):
+        cursor.execute(f'DROP INDEX idx_{table}_sheet_row')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_sheet_row ON {table}(sheet_row)')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_card_number ON {table}(card_number)')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_user_created_ts ON {table}(tg_user_id, created_ts)')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_public_id ON {table}(public_id)')
+    return table
+
+def _legacy_app_key(created_at, tg_user_id, card_number) -> tuple:
+    """Ключ заявки без постоянного ID: время подачи, TG ID инициатора и номер карты."""
+    return (str(created_at or ''), str(tg_user_id or ''), str(card_number or ''))
+
+def _archived_app_keys(cursor) -> tuple:
+    """
+    Заявки, которые уже лежат в архиве: (постоянные ID, ключи _legacy_app_key заявок без ID).
+    Номер строки для этого не годится - после пересортировки таблицы он принадлежит другой заявке.
+    """
+    public_ids, legacy_keys = set(), set()
+    for table in _archive_tables(cursor):
+        cursor.execute(f'SELECT public_id, created_at, tg_user_id, card_number FROM {table}')
+        for public_id, created_at, tg_user_id, card_number in cursor.fetchall():
+            if public_id:
+                public_ids.add(public_id)
+            else:
+                legacy_keys.add(_legacy_app_key(created_at, tg_user_id, card_number))
+    return public_ids, legacy_keys
+
+def archive_old_applications(months: int = 6) -> int:
+    """
+    Переносит завершенные (одобренные/отклоненные) заявки старше months месяцев
+    в архивные таблицы по годам. Возвращает количество перенесенных заявок.
+    """
+    cutoff = to_epoch(datetime.now() - timedelta(days=30 * months))
+    status_placeholders = ', '.join('?' for _ in FINAL_STATUSES)
+    condition = f'status IN ({status_placeholders}) AND created_ts > 0 AND created_ts < ?'
+    params = (*FINAL_STATUSES, cutoff)
+
+    try:
+        conn = sqlite3.connect(get_db_path())
+        cursor = conn.cursor()
+
+        cursor.execute(
+            f"SELECT DISTINCT strftime('%Y', created_ts, 'unixepoch') FROM applications WHERE {condition}",
+            params
+        )
+        years = [row[0] for row in cursor.fetchall()]
+
+        moved = 0
+        columns = ', '.join(_table_columns(cursor, 'applications'))
+        for year in years:
+            table = _ensure_archive_table(cursor, year)
+            year_condition = f"{condition} AND strftime('%Y', created_ts, 'unixepoch') = ?"
+            cursor.execute(
+                f'INSERT OR REPLACE INTO {table} ({columns}) SELECT {columns} FROM applications WHERE {year_condition}',
+                (*params, year)
+            )
+            cursor.execute(f'DELETE FROM applications WHERE {year_condition}', (*params, year))
+            moved += cursor.rowcount
+
+        conn.commit()
+        conn.close()
+        if moved:
+            bump_data_generation()
+
+        logger.info(f"Архивация: перенесено {moved} заявок старше {months} мес. (годы: {years or '-'})")
+        return moved
+
+    except Exception as e:
+        logger.error(f"Ошибка при архивации заявок: {e}")
+        return 0
+
+def parse_sheet_timestamp(value) -> Optional[datetime]:
+    """Разбирает "Отметку времени" из таблицы. Возвращает None, если формат неизвестен."""
+    if not value:
+        return None
+    for fmt in SHEET_TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(str(value).strip(), fmt)
+        except ValueError:
+            continue
+    return None
+
+def _mark_synced(cursor, app_id: int, sheet_row: Optional[int]) -> None:
+    try:
+        # synced_ts защищает строку от удаления синхронизацией, которая прочитала таблицу до записи
+        cursor.execute(
+            'UPDATE applications SET google_sheets_synced = 1, sheet_row = ?, synced_ts = ? WHERE id = ?',
+            (sheet_row, to_epoch(datetime.now()), app_id)
+        )
+    except sqlite3.IntegrityError:
+        # Номер строки еще числится за другой заявкой с прошлой синхронизации (таблицу пересортировали) -
+        # он устарел, следующая синхронизация найдет ту заявку по ID или удалит
+        cursor.execute('UPDATE applications SET sheet_row = NULL WHERE sheet_row = ? AND id != ?', (sheet_row, app_id))
+        cursor.execute(
+            'UPDATE applications SET google_sheets_synced = 1, sheet_row = ?, synced_ts = ? WHERE id = ?',
+            (sheet_row, to_epoch(datetime.now()), app_id)
+        )
+
+def complete_submission(app_id: int, sheet_row: Optional[int] = None) -> bool:
+    """Заявка записана в таблицу: помечает локальную копию и снимает задание с очереди отправки."""
+    try:
+        conn = sqlite3.connect(get_db_path())
+        cursor = conn.cursor()
+        _mark_synced(cursor, app_id, sheet_row)
+        cursor.execute('DELETE FROM submission_queue WHERE app_id = ?', (app_id,))
+        conn.commit()
+        conn.close()
+        bump_data_generation()
+        return True
+
+    except Exception as e:
+        logger.error(f"Ошибка при завершении отправки заявки {app_id}: {e}")
+        return False
+
+# Сколько секунд незавершенное решение считается выполняющимся (дальше его можно перехватить -
+# например, если бот перезапустился посреди записи в таблицу)
+DECISION_CLAIM_TTL = 300
+
+def claim_decisions(app_keys: List[str], status: str, decided_by: str, reason: Optional[str] = None) -> Dict[str, Dict]:
+    """
+    Занимает заявки под решение руководителя (state = 'pending') одной транзакцией.
+    Возвращает уже существующие решения по заявкам, которые занять не удалось: app_key -> запись.
+    """
+    now = to_epoch(datetime.now())
+    try:
+        conn = sqlite3.connect(get_db_path(), isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        existing = {}
+        cursor.execute('BEGIN IMMEDIATE')
+        committed = False
+        try:
+            for app_key in app_keys:
+                cursor.execute(
+                    "INSERT INTO admin_decisions (app_key, status, decided_by, reason, state, updated_ts) "
+                    "VALUES (?, ?, ?, ?, 'pending', ?) "
+                    "ON CONFLICT(app_key) DO UPDATE SET status = excluded.status, decided_by = excluded.decided_by, "
+                    "reason = excluded.reason, updated_ts = excluded.updated_ts "
+                    "WHERE admin_decisions.state = 'pending' AND admin_decisions.updated_ts < ?",
+                    (app_key, status, decided_by, reason, now, now - DECISION_CLAIM_TTL)
+                )
+                if not cursor.rowcount:
+                    cursor.execute('SELECT * FROM admin_decisions WHERE app_key = ?', (app_key,))
+                    existing[app_key] = dict(cursor.fetchone())
+            cursor.execute('COMMIT')
+            committed = True
+        finally:
+            # При ошибке не оставляем часть заявок занятыми: вызывающий считает занятыми все
+            if not committed:
+                cursor.execute('ROLLBACK')
+            conn.close()
+        return existing
+
+    except Exception as e:
+        logger.error(f"Ошибка при записи решения '{status}' по заявкам {app_keys}: {e}")
+        # Без записи решения действие не выполняется: считаем все заявки занятыми
+        return {app_key: {'app_key': app_key, 'status': None, 'decided_by': None, 'state': 'error'} for app_key in app_keys}
+
+def is_decision_active(decision: Optional[Dict]) -> bool:
+    """Решение принято или еще выполняется (незавершенное решение старше DECISION_CLAIM_TTL считается брошенным)."""
+    if not decision:
+        return False
+    if decision.get('state') != 'pending':
+        return True
+    return (decision.get('updated_ts') or 0) >= to_epoch(datetime.now()) - DECISION_CLAIM_TTL
+
+def finish_decisions(app_keys: List[str], success: bool) -> bool:
+    """Завершает решения, занятые claim_decisions: при успехе фиксирует их, при ошибке снимает."""
+    if not app_keys:
+        return True
+    placeholders = ', '.join('?' for _ in app_keys)
+    try:
+        conn = sqlite3.connect(get_db_path())
+        cursor = conn.cursor()
+        if success:
+            cursor.execute(
+                f"UPDATE admin_decisions SET state = 'done', updated_ts = ? WHERE app_key IN ({placeholders})",
+                (to_epoch(datetime.now()), *app_keys)
+            )
+        else:
+            cursor.execute(f"DELETE FROM admin_decisions WHERE state = 'pending' AND app_key IN ({placeholders})", app_keys)
+        conn.commit()
+        conn.close()
+        return True
+
+    except Exception as e:
+        logger.error(f"Ошибка при завершении решений по заявкам {app_keys}: {e}")
+        return False
+
+def get_decision(app_key: str) -> Optional[Dict]:
+    """Решение руководителя по заявке (в том числе еще выполняющееся) или None."""
+    try:
+        conn = sqlite3.connect(get_db_path())
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM admin_decisions WHERE app_key = ?', (app_key,))
+        row = cursor.fetchone()
+        conn.close()
+        return dict(row) if row else None
+
+    except Exception as e:
+        logger.error(f"Ошибка при чтении решения по заявке {app_key}: {e}")
+        return None
+
+def update_application_statuses_local(public_ids: List[str], status: str,
+                                      legacy_rows: Optional[List[int]] = None) -> bool:
+    """
+    Обновляет статус нескольких заявок одной транзакцией.
+    Заявки ищутся по постоянному ID (номер строки с последней синхронизации мог устареть);
+    legacy_rows - номера строк заявок, у которых ID еще нет.
+    """
+    legacy_rows = [sheet_row for sheet_row in (legacy_rows or []) if sheet_row is not None]
+    try:
+        conn = sqlite3.connect(get_db_path())
+        cursor = conn.cursor()
+        now = datetime.now()
+        decided_ts = to_epoch(now) if status in FINAL_STATUSES else None
+        values = (status, now.strftime(TIMESTAMP_FORMAT), decided_ts)
+        set_clause = 'UPDATE applications SET status = ?, updated_at = ?, decided_ts = COALESCE(decided_ts, ?)'
+        cursor.executemany(f'{set_clause} WHERE public_id = ?', [(*values, public_id) for public_id in public_ids])
+        cursor.executemany(f'{set_clause} WHERE sheet_row = ?', [(*values, sheet_row) for sheet_row in legacy_rows])
+
+        tg_ids = set()
+        for column, keys in (('public_id', public_ids), ('sheet_row', legacy_rows)):
+            if keys:
+                placeholders = ', '.join('?' for _ in keys)
+                cursor.execute(f'SELECT DISTINCT tg_user_id FROM applications WHERE {column} IN ({placeholders})', list(keys))
+                tg_ids.update(row[0] for row in cursor.fetchall())
+        if tg_ids:
+            _refresh_user_stats(cursor, list(tg_ids))
+        conn.commit()
+        conn.close()
+        bump_data_generation()
+        return True
+
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении статуса заявок {public_ids} (строки без ID: {legacy_rows}) в локальной БД: {e}")
+        return False
+
+def get_pending_applications() -> List[Dict]:
+    """Заявки "На согласовании", уже записанные в таблицу (старые сверху)."""
+    try:
+        conn = sqlite3.connect(get_db_path())
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT * FROM applications WHERE status = 'На согласовании' AND sheet_row IS NOT NULL "
+            "ORDER BY created_ts, id"
+        )
+        rows = [dict(row) for row in cursor.fetchall()]
+        conn.close()
+        return rows
+
+    except Exception as e:
+        logger.error(f"Ошибка при получении заявок на согласовании: {e}")
+        return []
+
+def count_applications(user_id: Optional[str] = None) -> int:
+    """Количество заявок пользователя (или всех заявок, если user_id не указан)."""
+    try:
+        conn = sqlite3.connect(get_db_path())
+        cursor = conn.cursor()
+        if user_id:
+            cursor.execute('SELECT COUNT(*) FROM applications WHERE tg_user_id = ?', (user_id,))
+        else:
+            cursor.execute('SELECT COUNT(*) FROM applications')
+        total = cursor.fetchone()[0]
+        conn.close()
+        return total
+
+    except Exception as e:
+        logger.error(f"Ошибка при подсчете заявок: {e}")
+        return 0
+
+def get_applications_page(user_id: Optional[str] = None, after_id: Optional[int] = None,
+                          before_id: Optional[int] = None, limit: int = 7) -> List[Dict]:
+    """
+    Постраничная выборка заявок (новые сверху) по ключу (created_ts, id).
+    after_id - id последней заявки предыдущей страницы (листаем вперед),
+    before_id - id первой заявки текущей страницы (листаем назад).
+    Если заявка-курсор исчезла из БД, возвращает пустой список.
+    """
+    try:
+        conn = sqlite3.connect(get_db_path())
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        where, params = [], []
+        if user_id:
+            where.append('tg_user_id = ?')
+            params.append(user_id)
+
+        anchor_id = after_id if after_id is not None else before_id
+        if anchor_id is not None:
+            cursor.execute('SELECT created_ts FROM applications WHERE id = ?', (anchor_id,))
+            anchor = cursor.fetchone()
+            if not anchor:
+                conn.close()
+                return []
+            where.append(f"(created_ts, id) {'<' if after_id is not None else '>'} (?, ?)")
+            params.extend([anchor['created_ts'], anchor_id])
+
+        order = 'ASC' if before_id is not None else 'DESC'
+        sql = 'SELECT * FROM applications'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += f' ORDER BY created_ts {order}, id {order} LIMIT ?'
+        params.append(limit)
+
+        cursor.execute(sql, params)
+        rows = [dict(row) for row in cursor.fetchall()]
+        conn.close()
+
+        if before_id is not None:
+            rows.reverse()
+        return rows
+
+    except Exception as e:
+        logger.error(f"Ошибка при постраничной выборке заявок: {e}")
+        return []
+
+def iter_applications(user_id: Optional[str] = None, include_archive: bool = True,
+                      batch_size: int = 500) -> Iterator[Dict]:
+    """
+    Построчно отдает заявки (новые сверху) вместе с архивом, не загружая всю выборку в память.
+    Используется для экспорта: строки читаются из курсора пачками по batch_size.
+    """
+    conn = None
+    try:
+        conn = sqlite3.connect(get_db_path())
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        where, params = '', []
+        if user_id:
+            where, params = ' WHERE tg_user_id = ?', [user_id]
+
+        tables = ['applications']
+        if include_archive:
+            tables += _archive_tables(cursor)
+
+        columns = ', '.join(_table_columns(cursor, 'applications'))
+        sql = ' UNION ALL '.join(f'SELECT {columns} FROM {table}{where}' for table in tables)
+        sql += ' ORDER BY created_ts DESC'
+        cursor.execute(sql, params * len(tables))
+
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(row)
+
+    except Exception as e:
+        logger.error(f"Ошибка при чтении заявок для экспорта: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+def get_application(app_id: int) -> Optional[Dict]:
+    """Одна заявка из рабочей таблицы по id."""
+    try:
+        conn = sqlite3.connect(get_db_path())
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM applications WHERE id = ?', (app_id,))
+        row = cursor.fetchone()
+        conn.close()
+        return dict(row) if row else None
+
+    except Exception as e:
+        logger.error(f"Ошибка при получении заявки {app_id}: {e}")
+        return None
+
+def load_application_snapshot() -> Optional[List[tuple]]:
+    """
+    Все заявки рабочей таблицы и архива в виде (строка, в_архиве) - источник для поискового индекса.
+    Возвращает None при ошибке (чтобы не затереть уже построенный индекс пустым снимком).
+    """
+    try:
+        conn = sqlite3.connect(get_db_path())
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        snapshot = []
+        for table in ['applications'] + _archive_tables(cursor):
+            cursor.execute(f'SELECT * FROM {table}')
+            archived = table != 'applications'
+            snapshot.extend((dict(row), archived) for row in cursor.fetchall())
+        conn.close()
+        return snapshot
+
+    except Exception as e:
+        logger.error(f"Ошибка при чтении снимка заявок: {e}")
+        return None
+
+def _assign_missing_public_ids(all_records: List[Dict]) -> int:
+    """
+    Выдает постоянные ID заявкам таблицы, у которых их еще нет (поданным до появления колонки
+    или внесенным вручную), и записывает их в таблицу одним пакетным запросом.
+    При успехе ID проставляются и в all_records. Возвращает количество выданных ID.
+    """
+    import g_sheets
+    from models import new_public_id
+
+    missing = {
+        i + 2: new_public_id()
+        for i, record in enumerate(all_records)
+        if record.get(SheetCols.OWNER_LAST_NAME_COL) and not str(record.get(SheetCols.APP_ID) or '').strip()
+    }
+    if not missing:
+        return 0
+    if not g_sheets.ensure_column(SheetCols.APP_ID) or not g_sheets.update_rows_batch({sheet_row: {SheetCols.APP_ID: public_id} for sheet_row, public_id in missing.items()}):
+        logger.warning(f"Не удалось записать ID для {len(missing)} заявок - повторим при следующей синхронизации")
+        return 0
+    for sheet_row, public_id in missing.items():
+        all_records[sheet_row - 2][SheetCols.APP_ID] = public_id
+    logger.info(f"Выданы постоянные ID {len(missing)} заявкам таблицы")
+    return len(missing)
+
+def sync_with_google_sheets() -> bool:
+    """
+    Синхронизация локальной БД с Google Sheets (фоновая задача).
+    Зеркалирует все заявки из таблицы в applications одной транзакцией:
+    строки с google_sheets_synced = 1 - это копия таблицы, строки с 0 - заявки,
+    которые еще не удалось отправить в таблицу.
+    """
+    global LAST_SYNC_AT, _LAST_SYNC_DIGEST
+    import g_sheets
+    from models import Application
+
+    # Заявки, которые бот записал в таблицу после этого момента, могут отсутствовать в прочитанных данных
+    read_started_ts = to_epoch(datetime.now())
+    all_records = g_sheets.get_sheet_data()
+    if not all_records:
+        # Пустой ответ почти всегда означает ошибку API - не затираем зеркало
+        logger.warning("Синхронизация пропущена: не удалось получить данные из Google Sheets")
+        return False
+
+    _assign_missing_public_ids(all_records)
+
+    rows = []
+    for i, record in enumerate(all_records):
+        if not record.get(SheetCols.OWNER_LAST_NAME_COL):
+            continue  # строки регистрации, а не заявки
+        # номер строки в таблице: +1 заголовок, +1 нумерация с единицы
+        app = Application.from_sheet_record(record, sheet_row=i + 2)
+        rows.append((
+            app.sheet_row,
+            app.public_id or None,
+            app.tg_user_id,
+            app.owner_last_name,
+            app.owner_first_name,
+            app.card_number,
+            app.card_type,
+            app.amount,
+            app.category,
+            app.frequency,
+            app.issue_location,
+            app.reason,
+            str(app.status),
+            app.initiator_fio,
+            app.initiator_username,
+            app.created_at_text,
+            app.created_ts,
+        ))
+
+    try:
+        conn = sqlite3.connect(get_db_path())
+        cursor = conn.cursor()
+
+        # Заявки, уже перенесенные в архив, обратно в рабочую таблицу не возвращаем
+        archived_ids, archived_legacy = _archived_app_keys(cursor)
+        if archived_ids or archived_legacy:
+            rows = [
+                row for row in rows
+                if row[1] not in archived_ids and _legacy_app_key(row[15], row[2], row[5]) not in archived_legacy
+            ]
+
+        # Строка таблицы могла достаться другой заявке (таблицу пересортировали) - освобождаем номер,
+        # заявка, которая его держала, получит свой номер ниже по ID или будет удалена как устаревшая
+        cursor.executemany(
+            'UPDATE applications SET sheet_row = NULL WHERE sheet_row = ? AND public_id IS NOT ?',
+            [(row[0], row[1]) for row in rows]
+        )
+        columns = '''(sheet_row, public_id, tg_user_id, owner_last_name, owner_first_name, card_number,
+             card_type, amount, category, frequency, issue_location, reason, status,
+             initiator_fio, initiator_username, created_at, created_ts, google_sheets_synced)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1)'''
+        updates = '''
+                sheet_row = excluded.sheet_row,
+                public_id = excluded.public_id,
+                tg_user_id = excluded.tg_user_id,
+                owner_last_name = excluded.owner_last_name,
+                owner_first_name = excluded.owner_first_name,
+                card_number = excluded.card_number,
+                card_type = excluded.card_type,
+                amount = excluded.amount,
+                category = excluded.category,
+                frequency = excluded.frequency,
+                issue_location = excluded.issue_location,
+                reason = excluded.reason,
+                status = excluded.status,
+                initiator_fio = excluded.initiator_fio,
+                initiator_username = excluded.initiator_username,
+                created_at = excluded.created_at,
+                created_ts = excluded.created_ts,
+                google_sheets_synced = 1'''
+        # Заявки сопоставляются по постоянному ID (локальная копия отправленной заявки сливается со строкой
+        # таблицы), заявки без ID - по номеру строки
+        cursor.executemany(
+            f'INSERT INTO applications {columns} ON CONFLICT(public_id) WHERE public_id IS NOT NULL DO UPDATE SET {updates}',
+            [row for row in rows if row[1]]
+        )
+        cursor.executemany(
+            f'INSERT INTO applications {columns} ON CONFLICT(sheet_row) DO UPDATE SET {updates}',
+            [row for row in rows if not row[1]]
+        )
+        # Строки, которые в таблице перестали быть заявками (очищены вручную), и копии, оставшиеся без строки.
+        # Заявки, записанные ботом после чтения таблицы, не трогаем - их просто нет в прочитанных данных
+        valid_rows = {row[0] for row in rows}
+        cursor.execute(
+            'SELECT id, sheet_row FROM applications WHERE google_sheets_synced = 1 AND COALESCE(synced_ts, 0) < ?',
+            (read_started_ts,)
+        )
+        stale = [(r[0],) for r in cursor.fetchall() if r[1] not in valid_rows]
+        cursor.executemany('DELETE FROM applications WHERE id = ?', stale)
+        # Таблицу могли править вручную, поэтому агрегаты пересчитываются целиком
+        _refresh_user_stats(cursor)
+
+        conn.commit()
+        conn.close()
+
+        LAST_SYNC_AT = datetime.now()
+        digest = hash(tuple(rows))
+        if digest != _LAST_SYNC_DIGEST:
+            _LAST_SYNC_DIGEST = digest
+            bump_data_generation()
+        logger.info(f"Синхронизация с Google Sheets завершена: {len(rows)} заявок в зеркале")
+        return True
+
+    except Exception as e:
+        logger.error(f"Ошибка при синхронизации с Google Sheets: {e}")
+        return False
+
+def _window_counts(cursor, since: datetime) -> Dict:
+    """Количество новых/одобренных/отклоненных заявок, поданных после since."""
+    cursor.execute('''
+        SELECT COUNT(*),
+               COALESCE(SUM(status = 'Одобрено'), 0),
+               COALESCE(SUM(status = 'Отклонено'), 0)
+        FROM applications
+        WHERE created_ts > ?
+    ''', (to_epoch(since),))
+    new, approved, rejected = cursor.fetchone()
+    return {'new': new, 'approved': approved, 'rejected': rejected}
+
+def get_report_snapshot() -> Dict:
+    """
+    Собирает все цифры для отчетов из локального зеркала за одну транзакцию чтения,
+    чтобы части одного отчета не расходились между собой.
+    """
+    try:
+        conn = sqlite3.connect(get_db_path(), isolation_level=None)
+        cursor = conn.cursor()
+        now = datetime.now()
+
+        cursor.execute('BEGIN')
+        try:
+            cursor.execute('SELECT COUNT(*) FROM applications')
+            total = cursor.fetchone()[0]
+
+            cursor.execute("SELECT COUNT(*) FROM applications WHERE status = 'На согласовании'")
+            pending = cursor.fetchone()[0]
+
+            day = _window_counts(cursor, now - timedelta(days=1))
+            week = _window_counts(cursor, now - timedelta(days=7))
+
+            cursor.execute('SELECT status, COUNT(*) FROM applications GROUP BY status')
+            by_status = dict(cursor.fetchall())
+
+            cursor.execute('SELECT card_type, COUNT(*) FROM applications GROUP BY card_type')
+            by_card_type = dict(cursor.fetchall())
+
+            archived = 0
+            for table in _archive_tables(cursor):
+                cursor.execute(f'SELECT COUNT(*) FROM {table}')
+                archived += cursor.fetchone()[0]
+        finally:
+            cursor.execute('COMMIT')
+            conn.close()
+
+        return {
+            'generated_at': now,
+            'synced_at': LAST_SYNC_AT,
+            'total': total,
+            'pending': pending,
+            'last_24h': day,
+            'last_7d': week,
+            'by_status': by_status,
+            'by_card_type': by_card_type,
+            'archived': archived,
+        }
+
+    except Exception as e:
+        logger.error(f"Ошибка при получении данных для отчетов: {e}")
+        return {}
+
+# === СТАТИСТИКА ИНИЦИАТОРОВ ===
+
+def _refresh_user_stats(cursor, tg_ids: Optional[List[str]] = None) -> None:
+    """
+    Пересчитывает агрегаты user_stats/user_category_stats по рабочей таблице и архиву.
+    Без tg_ids пересчитываются все инициаторы (после синхронизации), иначе только указанные.
+    """
+    where, params = '', []
+    if tg_ids is not None:
+        tg_ids = [str(tg_id) for tg_id in tg_ids if tg_id]
+        if not tg_ids:
+            return
+        placeholders = ', '.join('?' for _ in tg_ids)
+        where, params = f' WHERE tg_user_id IN ({placeholders})', tg_ids
+        cursor.execute(f'DELETE FROM user_stats WHERE tg_id IN ({placeholders})', tg_ids)
+        cursor.execute(f'DELETE FROM user_category_stats WHERE tg_id IN ({placeholders})', tg_ids)
+    else:
+        cursor.execute('DELETE FROM user_stats')
+        cursor.execute('DELETE FROM user_category_stats')
+
+    tables = ['applications'] + _archive_tables(cursor)
+    source = ' UNION ALL '.join(
+        f'SELECT tg_user_id, card_type, category, status, created_ts, decided_ts FROM {table}{where}'
+        for table in tables
+    )
+    all_params = params * len(tables)
+
+    cursor.execute(f'''
+        INSERT INTO user_stats (tg_id, total, barter, approved, rejected, decided, decision_seconds, updated_at)
+        SELECT tg_user_id, COUNT(*),
+               COALESCE(SUM(card_type = 'Бартер'), 0),
+               COALESCE(SUM(status = 'Одобрено'), 0),
+               COALESCE(SUM(status = 'Отклонено'), 0),
+               COALESCE(SUM(decided_ts IS NOT NULL AND created_ts > 0), 0),
+               COALESCE(SUM(CASE WHEN created_ts > 0 THEN decided_ts - created_ts END), 0),
+               CURRENT_TIMESTAMP
+        FROM ({source})
+        GROUP BY tg_user_id
+    ''', all_params)
+    cursor.execute(f'''
+        INSERT INTO user_category_stats (tg_id, category, count)
+        SELECT tg_user_id, category, COUNT(*)
+        FROM ({source})
+        WHERE category IS NOT NULL AND category != ''
+        GROUP BY tg_user_id, category
+    ''', all_params)
+
+def get_user_stats(tg_id: Optional[str] = None) -> Optional[Dict]:
+    """
+    Статистика инициатора из предрассчитанных агрегатов (или по всем инициаторам, если tg_id не указан).
+    Возвращает None, если заявок нет или произошла ошибка.
+    """
+    try:
+        conn = sqlite3.connect(get_db_path())
+        cursor = conn.cursor()
+
+        columns = 'total, barter, approved, rejected, decided, decision_seconds'
+        if tg_id:
+            cursor.execute(f'SELECT {columns} FROM user_stats WHERE tg_id = ?', (tg_id,))
+            row = cursor.fetchone()
+            cursor.execute(
+                'SELECT category FROM user_category_stats WHERE tg_id = ? ORDER BY count DESC LIMIT 1',
+                (tg_id,)
+            )
+        else:
+            sums = ', '.join(f'COALESCE(SUM({col}), 0)' for col in columns.split(', '))
+            cursor.execute(f'SELECT {sums} FROM user_stats')
+            row = cursor.fetchone()
+            cursor.execute('''
+                SELECT category FROM user_category_stats
+                GROUP BY category ORDER BY SUM(count) DESC LIMIT 1
+            ''')
+        top = cursor.fetchone()
+        conn.close()
+
+        if not row or not row[0]:
+            return None
+
+        total, barter, approved, rejected, decided, decision_seconds = row
+        return {
+            'total': total,
+            'barter': barter,
+            'discount': total - barter,
+            'approved': approved,
+            'rejected': rejected,
+            'pending': total - approved - rejected,
+            'approval_rate': approved / (approved + rejected) if approved + rejected else None,
+            'avg_decision_seconds': decision_seconds / decided if decided else None,
+            'top_category': top[0] if top else None,
+        }
+
+    except Exception as e:
+        logger.error(f"Ошибка при получении статистики инициатора {tg_id}: {e}")
+        return None
 
 # === СИСТЕМА УВЕДОМЛЕНИЙ ===
 
@@ -309,52 +1334,103 @@ def should_send_reminder(last_activity: datetime) -> bool:
     days_inactive = (datetime.now() - last_activity).days
     return days_inactive >= 7  # Напоминание через неделю неактивности
 
-def get_users_for_reminder() -> List[Dict]:
-    """Получает пользователей, которым нужно отправить напоминание."""
+def claim_reminder_batch(wave: str, limit: int = 200, inactive_days: int = 7) -> List[Dict]:
+    """
+    Выбирает очередную порцию неактивных пользователей одним запросом по индексу last_activity
+    и в той же транзакции записывает их в reminder_log со статусом 'pending'.
+    Пользователь, уже попавший в эту волну (даже если бот упал до отправки),
+    повторно не выбирается - так напоминание никогда не уходит дважды.
+    Неудачная отправка ('failed') не считается напоминанием: такой пользователь попадет в следующую волну.
+    """
+    conn = None
     try:
-        db_path = get_db_path()
-        conn = sqlite3.connect(db_path)
+        conn = sqlite3.connect(get_db_path(), isolation_level=None)
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
-        
-        week_ago = datetime.now() - timedelta(days=7)
-        
+
+        border = datetime.now() - timedelta(days=inactive_days)
+        cursor.execute('BEGIN IMMEDIATE')
         cursor.execute('''
-            SELECT * FROM users 
-            WHERE last_activity < ? 
+            SELECT tg_id, fio FROM users u
+            WHERE last_activity < ?
+              AND NOT EXISTS (SELECT 1 FROM reminder_log r WHERE r.tg_id = u.tg_id AND r.wave = ?)
+              AND NOT EXISTS (SELECT 1 FROM reminder_log r WHERE r.tg_id = u.tg_id AND r.sent_at > ? AND r.status != 'failed')
             ORDER BY last_activity ASC
-        ''', (week_ago,))
-        
-        rows = cursor.fetchall()
-        conn.close()
-        
-        return [dict(row) for row in rows]
-        
+            LIMIT ?
+        ''', (border, wave, border, limit))
+        users = [dict(row) for row in cursor.fetchall()]
+
+        cursor.executemany(
+            "INSERT INTO reminder_log (tg_id, wave, status, sent_at) VALUES (?, ?, 'pending', ?)",
+            [(user['tg_id'], wave, datetime.now()) for user in users]
+        )
+        cursor.execute('COMMIT')
+        return users
+
     except Exception as e:
-        logger.error(f"Ошибка при получении пользователей для напоминания: {e}")
+        logger.error(f"Ошибка при выборке пользователей для напоминания: {e}")
+        # Без отката пользователи остались бы занятыми в этой волне без отправки
+        if conn is not None and conn.in_transaction:
+            conn.rollback()
         return []
+    finally:
+        if conn is not None:
+            conn.close()
 
-def update_user_activity(tg_id: str) -> bool:
-    """Обновляет время последней активности пользователя."""
+def record_reminder_results(wave: str, results: List[tuple]) -> bool:
+    """Сохраняет результаты отправки порции напоминаний одной транзакцией. results: (tg_id, status, error)."""
     try:
-        db_path = get_db_path()
-        conn = sqlite3.connect(db_path)
+        conn = sqlite3.connect(get_db_path())
         cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE users 
-            SET last_activity = ? 
-            WHERE tg_id = ?
-        ''', (datetime.now(), tg_id))
-        
+        cursor.executemany(
+            'UPDATE reminder_log SET status = ?, error = ?, sent_at = ? WHERE tg_id = ? AND wave = ?',
+            [(status, error, datetime.now(), tg_id, wave) for tg_id, status, error in results]
+        )
         conn.commit()
         conn.close()
         return True
-        
+
     except Exception as e:
-        logger.error(f"Ошибка при обновлении активности пользователя {tg_id}: {e}")
+        logger.error(f"Ошибка при сохранении результатов напоминаний: {e}")
         return False
 
+# Буфер последней активности (tg_id -> время), который сбрасывается в БД пачкой
+_ACTIVITY_BUFFER: Dict[str, datetime] = {}
+_ACTIVITY_LOCK = threading.Lock()
+
+def record_user_activity(tg_id: str) -> None:
+    """Запоминает активность пользователя в памяти. В БД она попадет при следующем сбросе буфера."""
+    with _ACTIVITY_LOCK:
+        _ACTIVITY_BUFFER[str(tg_id)] = datetime.now()
+
+def flush_activity_buffer() -> int:
+    """Записывает накопленную активность одной транзакцией. Возвращает число обновленных пользователей."""
+    with _ACTIVITY_LOCK:
+        if not _ACTIVITY_BUFFER:
+            return 0
+        pending = dict(_ACTIVITY_BUFFER)
+        _ACTIVITY_BUFFER.clear()
+
+    try:
+        conn = sqlite3.connect(get_db_path())
+        cursor = conn.cursor()
+        cursor.executemany(
+            'UPDATE users SET last_activity = ? WHERE tg_id = ?',
+            [(seen_at, tg_id) for tg_id, seen_at in pending.items()]
+        )
+        conn.commit()
+        conn.close()
+        return len(pending)
+
+    except Exception as e:
+        logger.error(f"Ошибка при сбросе буфера активности ({len(pending)} пользователей): {e}")
+        # Возвращаем записи в буфер, не затирая более свежую активность
+        with _ACTIVITY_LOCK:
+            for tg_id, seen_at in pending.items():
+                if _ACTIVITY_BUFFER.get(tg_id, seen_at) <= seen_at:
+                    _ACTIVITY_BUFFER[tg_id] = seen_at
+        return 0
+
 def cleanup_old_cache() -> None:
     """Очищает устаревший кэш из памяти."""
     try:
@@ -401,45 +1477,3 @@ def backup_local_db() -> bool:
     except Exception as e:
         logger.error(f"Ошибка при создании резервной копии БД: {e}")
         return False
-
-def get_statistics() -> dict:
-    """
-    Возвращает статистику по заявкам из локальной базы данных.
-    """
-    try:
-        db_path = get_db_path()
-        
-        if not os.path.exists(db_path):
-            return {"error": "База данных не найдена"}
-        
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        # Общее количество заявок
-        cursor.execute("SELECT COUNT(*) FROM applications")
-        total = cursor.fetchone()[0]
-        
-        # Статистика по статусам
-        cursor.execute("SELECT status, COUNT(*) FROM applications GROUP BY status")
-        status_stats = dict(cursor.fetchall())
-        
-        # Статистика по типам карт
-        cursor.execute("SELECT card_type, COUNT(*) FROM applications GROUP BY card_type")
-        card_type_stats = dict(cursor.fetchall())
-        
-        # Статистика по категориям
-        cursor.execute("SELECT category, COUNT(*) FROM applications GROUP BY category")
-        category_stats = dict(cursor.fetchall())
-        
-        conn.close()
-        
-        return {
-            'total': total,
-            'by_status': status_stats,
-            'by_card_type': card_type_stats,
-            'by_category': category_stats
-        }
-        
-    except Exception as e:
-        logger.error(f"Ошибка при получении статистики: {e}")
-        return {"error": str(e)}